@@ -51,8 +51,7 @@ class ProjectileSpell(item.SpellItem):
         for steps in range(1, 1 + self.reach):
             x1 += step_x
             y1 += step_y
-            tile = dmap.tile_at((x1, y1))
-            if tile is None or not tile.passable:
+            if not dmap.is_passable((x1, y1)):
                 break
             if (x1, y1) in dmap.entities:
                 ent = dmap.entities[(x1, y1)]
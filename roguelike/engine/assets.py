@@ -79,13 +79,18 @@ class Sprites:
                color: Tuple[float, float, float, float] = (1, 1, 1, 1),
                angle: float = 0)\
                -> sprite.Sprite:
-        texture = Textures.instance.textures[tex_name]
+        # Textures are missing when running headless
+        texture = Textures.instance.textures.get(tex_name)
         if size is None:
-            t_size = texture.size
+            t_size = (0, 0) if texture is None else texture.size
         else:
             t_size = size
         spr = sprite.Sprite(
-            texture, offset, t_size, color, angle * math.pi / 180)
+            cast(mgl.Texture, texture),
+            offset,
+            t_size,
+            color,
+            angle * math.pi / 180)
         self.sprites[spr_name] = spr
         return spr
     
@@ -211,6 +216,8 @@ class Sounds:
         self.set_volume(self.volume + (.1 if up else -.1))
     
     def play_music(self, pat: str, fadeout: int = 500) -> None:
+        if not pg.mixer.get_init():
+            return
         pat = asset_path(os.path.join('music', pat))
         if pat == self.song and pg.mixer.music.get_busy():
             return
@@ -278,7 +285,11 @@ variables: Dict[str, Any] = collections.defaultdict(lambda: None)
 persists: Dict[str, Any] = collections.defaultdict(lambda: None)
 running = True
 
-def load_assets(renderer: 'Renderer', source: str) -> None:
+def load_assets(renderer: Optional['Renderer'], source: str) -> None:
+    """Loads every asset file listed in source
+    Without a renderer, no textures, sounds or voices are loaded, so the
+    game's data can be used headless. Sprites then have no texture.
+    """
     global residuals
     with open(asset_path(source)) as file:
         tdata: Dict[str, Any] = json.load(file)
@@ -288,15 +299,22 @@ def load_assets(renderer: 'Renderer', source: str) -> None:
             fdata: Dict[str, Any] = json.load(file)
         residuals[filename] = fdata
         logging.debug(f'Loaded asset file {filename}')
-    Textures.load_textures(renderer,
-                           cast(Dict[str, Dict[str, str]],
-                           residuals.pop('textures')))
+    textures = cast(Dict[str, Dict[str, str]], residuals.pop('textures'))
+    if renderer is not None:
+        Textures.load_textures(renderer, textures)
+    else:
+        Textures.instance = Textures()
     Sprites.load_sprites(cast(Dict[str, Dict[str, Any]],
                          residuals.pop('sprites')))
     Animations.load_animations(cast(Dict[str, Any],
                                residuals.pop('animations')))
-    Sounds.load_sounds(residuals.pop('sounds'))
-    Voice.load(residuals.pop('phonemes'))
+    sounds = residuals.pop('sounds')
+    phonemes = residuals.pop('phonemes')
+    if renderer is not None:
+        Sounds.load_sounds(sounds)
+        Voice.load(phonemes)
+    else:
+        Sounds.instance = Sounds()
 
 def save_path(dirname=GAME_DIR_NAME, savefile='save'):
     if hasattr(sys, 'frozen'):
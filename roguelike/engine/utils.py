@@ -1,8 +1,11 @@
 from collections import deque
+from dataclasses import dataclass
 from enum import Enum
 import heapq
 import math
-import random
+import sys
+import threading
+import time
 from typing import (
     Any,
     Dict,
@@ -14,6 +17,7 @@ from typing import (
     Tuple
 )
 
+import numba # type: ignore
 import numpy as np
 from numpy import typing as npt
 from PIL import Image # type: ignore
@@ -23,6 +27,9 @@ from roguelike.engine import assets
 Pos = Tuple[int, int]
 Grid = Tuple[Pos, npt.NDArray[np.int32]]
 
+# Same as in wfc, compiled code isn't cached by frozen builds
+_JIT_CACHE = not getattr(sys, 'frozen', False)
+
 _grid_cache: Dict[str, Grid] = {}
 def load_grid(imgname: str) -> Grid:
     """Loads a paletted image as a grid of integers, cached by name"""
@@ -63,96 +70,312 @@ def manhattan_dist(from_: Pos, to: Pos) -> int:
 def diag_dist(from_: Pos, to: Pos) -> int:
     return max(abs(from_[0] - to[0]), abs(from_[1] - to[1]))
 
-AS_State = Tuple[float, float, Pos, Pos]
+@numba.njit(cache=_JIT_CACHE)
+def _heap_less(heap_f: npt.NDArray[np.float64],
+               heap_g: npt.NDArray[np.float64],
+               heap_xy: npt.NDArray[np.int64],
+               i: int,
+               j: int) -> bool:
+    if heap_f[i] != heap_f[j]:
+        return heap_f[i] < heap_f[j]
+    if heap_g[i] != heap_g[j]:
+        return heap_g[i] < heap_g[j]
+    return heap_xy[i] < heap_xy[j]
+
+@numba.njit(cache=_JIT_CACHE)
+def _heap_swap(heap_f: npt.NDArray[np.float64],
+               heap_g: npt.NDArray[np.float64],
+               heap_xy: npt.NDArray[np.int64],
+               i: int,
+               j: int) -> None:
+    heap_f[i], heap_f[j] = heap_f[j], heap_f[i]
+    heap_g[i], heap_g[j] = heap_g[j], heap_g[i]
+    heap_xy[i], heap_xy[j] = heap_xy[j], heap_xy[i]
+
+@numba.njit(cache=_JIT_CACHE)
+def _a_star_kernel(costs: npt.NDArray[np.float64],
+                   width: int,
+                   start: int,
+                   goal: int,
+                   max_cost: float,
+                   g: npt.NDArray[np.float64],
+                   parents: npt.NDArray[np.int64],
+                   stamps: npt.NDArray[np.int64],
+                   generation: int,
+                   heap_f: npt.NDArray[np.float64],
+                   heap_g: npt.NDArray[np.float64],
+                   heap_xy: npt.NDArray[np.int64]) -> int:
+    """A-star over flat indices, with a binary heap in the heap_ arrays
+    g and parents are only valid where stamps is generation
+    Returns 1 if goal was reached, 0 if not and -1 if the heap filled up
+    """
+    num_cells = len(costs)
+    goal_x, goal_y = goal % width, goal // width
+    g[start] = 0
+    parents[start] = -1
+    stamps[start] = generation
+    heap_f[0] = abs(start % width - goal_x) + abs(start // width - goal_y)
+    heap_g[0] = 0
+    heap_xy[0] = start
+    size = 1
+    while size > 0:
+        cost, xy = heap_g[0], heap_xy[0]
+        # Pop the top, sifting the last entry down from it
+        size -= 1
+        _heap_swap(heap_f, heap_g, heap_xy, 0, size)
+        i = 0
+        while True:
+            child = 2 * i + 1
+            if child >= size:
+                break
+            if child + 1 < size\
+                    and _heap_less(heap_f, heap_g, heap_xy, child + 1, child):
+                child += 1
+            if not _heap_less(heap_f, heap_g, heap_xy, child, i):
+                break
+            _heap_swap(heap_f, heap_g, heap_xy, i, child)
+            i = child
+        if cost > g[xy]:
+            # Got here more cheaply since this was pushed
+            continue
+        if xy == goal:
+            return 1
+        x = xy % width
+        for k in range(4):
+            if k == 0:
+                n_xy = xy - width
+            elif k == 1:
+                n_xy = xy + width
+            elif k == 2:
+                n_xy = xy - 1 if x > 0 else -1
+            else:
+                n_xy = xy + 1 if x + 1 < width else -1
+            if n_xy < 0 or n_xy >= num_cells:
+                continue
+            n_cost = cost + costs[n_xy]
+            if not np.isfinite(n_cost) or n_cost > max_cost:
+                continue
+            if stamps[n_xy] == generation and n_cost >= g[n_xy]:
+                continue
+            g[n_xy] = n_cost
+            parents[n_xy] = xy
+            stamps[n_xy] = generation
+            if size == len(heap_xy):
+                return -1
+            heap_f[size] = n_cost + abs(n_xy % width - goal_x)\
+                + abs(n_xy // width - goal_y)
+            heap_g[size] = n_cost
+            heap_xy[size] = n_xy
+            # Sift the new entry up
+            i = size
+            size += 1
+            while i > 0:
+                parent = (i - 1) // 2
+                if not _heap_less(heap_f, heap_g, heap_xy, i, parent):
+                    break
+                _heap_swap(heap_f, heap_g, heap_xy, i, parent)
+                i = parent
+    return 0
+
+class PathWorkspace:
+    """Reusable arrays for a_star on maps of one shape, so that repeated
+    searches allocate nothing but their paths
+    Scores and parents are over flat indices, and are only valid for
+    cells stamped with the generation of the current search, so nothing
+    has to be cleared between searches.
+    shape: (h, w) of the maps to search
+    """
+    def __init__(self, shape: Tuple[int, int]):
+        self.shape = shape
+        num_cells = shape[0] * shape[1]
+        self.g = np.empty(num_cells, dtype=np.float64)
+        self.parents = np.empty(num_cells, dtype=np.int64)
+        self.stamps = np.zeros(num_cells, dtype=np.int64)
+        self.generation = 0
+        # With a consistent heuristic, each cell is pushed at most once
+        # from each of its neighbors
+        self._alloc_heap(4 * num_cells + 1)
+    
+    def _alloc_heap(self, capacity: int) -> None:
+        self.heap_f = np.empty(capacity, dtype=np.float64)
+        self.heap_g = np.empty(capacity, dtype=np.float64)
+        self.heap_xy = np.empty(capacity, dtype=np.int64)
+    
+    def search(self,
+               costs: npt.NDArray[np.float64],
+               from_: Pos,
+               to: Pos,
+               max_cost: Optional[float]=None) -> Optional[List[Pos]]:
+        """Same as a_star"""
+        if costs.shape != self.shape:
+            raise ValueError(f'{costs.shape} is not the shape of this '
+                             f'workspace, {self.shape}')
+        width = self.shape[1]
+        if not (0 <= to[0] < width and 0 <= to[1] < self.shape[0]):
+            return None
+        flat_costs = np.ascontiguousarray(costs, dtype=np.float64).reshape(-1)
+        start = from_[1] * width + from_[0]
+        goal = to[1] * width + to[0]
+        while True:
+            self.generation += 1
+            found = _a_star_kernel(flat_costs,
+                                   width,
+                                   start,
+                                   goal,
+                                   math.inf if max_cost is None
+                                   else float(max_cost),
+                                   self.g,
+                                   self.parents,
+                                   self.stamps,
+                                   self.generation,
+                                   self.heap_f,
+                                   self.heap_g,
+                                   self.heap_xy)
+            if found >= 0:
+                break
+            # Costs below 1 make the heuristic inconsistent
+            self._alloc_heap(2 * len(self.heap_xy))
+        if found == 0:
+            return None
+        path: List[Pos] = []
+        xy = goal
+        while xy >= 0:
+            y, x = divmod(int(xy), width)
+            path.append((x, y))
+            xy = self.parents[xy]
+        path.reverse()
+        return path
 
 def a_star(costs: npt.NDArray[np.float64],
            from_: Pos,
            to: Pos,
-           max_cost: Optional[float]=None) -> Optional[List[Pos]]:
+           max_cost: Optional[float]=None,
+           workspace: Optional[PathWorkspace]=None) -> Optional[List[Pos]]:
     """Using A-star to calculate the shortest path from from_ to to
     Manhattan distance is used as the heuristic
     costs: row-major sequence of floats with the cost to enter each tile
     from_: starting point of search
     to: goal/end point of search
     max_cost: ignore paths that excede this value if it is provided
+    workspace: optional PathWorkspace of the shape of costs, to reuse
+        between searches
     Returns a list of tiles stepped on along the path, or None
     """
-    size = costs.shape[::-1]
-    frontier: List[AS_State] = []
-    backtrack: Dict[Pos, Pos] = {}
-    visited = {from_}
-    heapq.heappush(frontier, (0, 0, from_, (0, 0)))
+    if workspace is None:
+        workspace = PathWorkspace(costs.shape)
+    return workspace.search(costs, from_, to, max_cost)
+
+@numba.njit(cache=_JIT_CACHE)
+def _bfs_kernel(passable: npt.NDArray[np.bool_],
+                width: int,
+                sources: npt.NDArray[np.int64],
+                dists: npt.NDArray[np.float64]) -> None:
+    """Unit cost distances from flat indices sources into flat dists,
+    keeping whatever is already lower
+    """
+    num_cells = len(dists)
+    # Every cell is queued at most once after the sources
+    queue = np.empty(num_cells + len(sources), dtype=np.int64)
+    head = tail = 0
+    for xy in sources:
+        dists[xy] = 0
+        queue[tail] = xy
+        tail += 1
+    while head < tail:
+        xy = queue[head]
+        head += 1
+        dist = dists[xy] + 1
+        x = xy % width
+        for i in range(4):
+            if i == 0:
+                n_xy = xy - width
+            elif i == 1:
+                n_xy = xy + width
+            elif i == 2:
+                n_xy = xy - 1 if x > 0 else -1
+            else:
+                n_xy = xy + 1 if x + 1 < width else -1
+            if 0 <= n_xy < num_cells and passable[n_xy]\
+                    and dist < dists[n_xy]:
+                dists[n_xy] = dist
+                queue[tail] = n_xy
+                tail += 1
+
+@numba.njit(cache=_JIT_CACHE)
+def _djikstra_kernel(costs: npt.NDArray[np.float64],
+                     width: int,
+                     sources: npt.NDArray[np.int64],
+                     dists: npt.NDArray[np.float64]) -> None:
+    """Same as _bfs_kernel with the cost to enter each cell"""
+    num_cells = len(dists)
+    frontier = [(0.0, xy) for xy in sources]
+    for xy in sources:
+        dists[xy] = 0
+    heapq.heapify(frontier)
     while len(frontier) > 0:
-        estimate, cost, current, previous = heapq.heappop(frontier)
-        backtrack[current] = previous
-        if current == to:
-            path = [current]
-            while current != from_:
-                previous = backtrack[current]
-                path.append(previous)
-                current = previous
-            path.reverse()
-            return path
-        x, y = current
-        next_steps = [e.value for e in CardinalDirections]
-        random.shuffle(next_steps)
-        for step in next_steps:
-            step = current[0] + step[0], current[1] + step[1]
-            if step in visited:
-                continue
-            x, y = step
-            if x < 0 or x >= size[0]:
-                continue
-            if y < 0 or y >= size[1]:
-                continue
-            heuristic = manhattan_dist(step, to)
-            n_cost = cost + costs[y, x]
-            if not math.isfinite(n_cost):
+        cost, xy = heapq.heappop(frontier)
+        if cost > dists[xy]:
+            continue
+        x = xy % width
+        for i in range(4):
+            if i == 0:
+                n_xy = xy - width
+            elif i == 1:
+                n_xy = xy + width
+            elif i == 2:
+                n_xy = xy - 1 if x > 0 else -1
+            else:
+                n_xy = xy + 1 if x + 1 < width else -1
+            if n_xy < 0 or n_xy >= num_cells:
                 continue
-            if max_cost is None or cost <= max_cost:
-                heapq.heappush(frontier,
-                               (heuristic + n_cost, n_cost, step, current))
-                visited.add(step)
-    return None
+            new_cost = cost + costs[n_xy]
+            if np.isfinite(new_cost) and new_cost < dists[n_xy]:
+                dists[n_xy] = new_cost
+                heapq.heappush(frontier, (new_cost, n_xy))
 
 def populate_djikstra(costs: npt.NDArray[np.float64],
                       starting_points: Iterable[Pos],
                       start_costs: Optional[
-                        npt.NDArray[np.float64]] = None)\
+                        npt.NDArray[np.float64]] = None,
+                      out: Optional[npt.NDArray[np.float64]] = None)\
                     -> npt.NDArray[np.float64]:
     """Populates each tile with a djikstra distance
     costs: row-major sequence of floats with the cost to enter each tile
     starting_points: points to update with cost of 0
     start_costs: optional previously calculated cost table,
         set all to infinity if None
+    out: optional array to write the costs to, to reuse between calls.
+        Defaults to start_costs when it's already an array of floats,
+        or else a new array.
     Returns a row-major sequence of the total costs to each each tile
         from the starting points
     """
-    size = costs.shape[::-1]
-    if start_costs is None:
-        # start_costs = [float('inf')] * (size[0] * size[1])
-        start_costs = np.full(costs.shape, float('inf'), dtype=float)
+    costs = np.asanyarray(costs, dtype=float)
+    if out is None:
+        if start_costs is None:
+            out = np.full(costs.shape, float('inf'), dtype=float)
+        else:
+            out = np.asanyarray(start_costs, dtype=float)
+    elif start_costs is None:
+        out.fill(float('inf'))
+    elif start_costs is not out:
+        out[...] = start_costs
+    dists = np.ascontiguousarray(out, dtype=float)
+    width = costs.shape[1]
+    sources = np.array([y * width + x for x, y in starting_points],
+                       dtype=np.int64)
+    finite = np.isfinite(costs)
+    # Entering any tile costs 1 or is impossible for most maps
+    if np.all(costs[finite] == 1):
+        _bfs_kernel(finite.ravel(), width, sources, dists.reshape(-1))
     else:
-        start_costs = np.asanyarray(start_costs, dtype=float)
-    frontier: List[Tuple[float, Pos]] =\
-        list(map(lambda point: (0, point), starting_points))
-    for x, y in starting_points:
-        start_costs[y, x] = 0
-    while len(frontier) > 0:
-        cost, pos = heapq.heappop(frontier)
-        x0, y0 = pos
-        for direction in CardinalDirections:
-            x, y = x0 + direction.value[0], y0 + direction.value[1]
-            if x < 0 or x >= size[0] or y < 0 or y >= size[1]:
-                continue
-            old_cost = start_costs[y, x]
-            new_cost = cost + costs[y, x]
-            if not math.isfinite(new_cost):
-                continue
-            if new_cost < old_cost:
-                start_costs[y, x] = new_cost
-                heapq.heappush(frontier, (new_cost, (x, y)))
-    return start_costs
+        _djikstra_kernel(np.ascontiguousarray(costs).reshape(-1),
+                         width,
+                         sources,
+                         dists.reshape(-1))
+    if dists is not out:
+        out[...] = dists
+    return out
 
 def trace_djikstra(start: Pos, dists: npt.NDArray[np.float64]) -> List[Pos]:
     """Get a path from a specified starting point to a local minimum"""
@@ -174,6 +397,196 @@ def trace_djikstra(start: Pos, dists: npt.NDArray[np.float64]) -> List[Pos]:
         path.append(min_neighbor)
         head = min_neighbor
 
+class UnionFind:
+    """Disjoint sets of the integers below size, merged in near constant
+    time with path halving and union by size
+    """
+    def __init__(self, size: int):
+        self.parents = list(range(size))
+        self.sizes = [1] * size
+        self.count = size # Number of disjoint sets
+    
+    def find(self, item: int) -> int:
+        parents = self.parents
+        while parents[item] != item:
+            parents[item] = parents[parents[item]]
+            item = parents[item]
+        return item
+    
+    def union(self, a: int, b: int) -> bool:
+        """Merges the sets of a and b, returns whether they were disjoint"""
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return False
+        if self.sizes[a] < self.sizes[b]:
+            a, b = b, a
+        self.parents[b] = a
+        self.sizes[a] += self.sizes[b]
+        self.count -= 1
+        return True
+
+class DeadlineExceeded(Exception):
+    """Raised when work runs past its Deadline or the Deadline is
+    cancelled
+    """
+
+# Values of Deadline.flag once it is cancelled or its timer has expired it
+_CANCELLED = -1
+_EXPIRED = -2
+
+class Deadline:
+    """A time by which to give up on some work, which can also be cancelled
+    before then from another thread or process
+    The flag is an array, so that compiled code can poll it. It holds ticket
+    until the Deadline is cancelled, or expired by its timer. Deadlines can
+    share a flag in shared memory, where writing another ticket cancels the
+    work of every Deadline holding the old one.
+    A Deadline pickles as the time it has left, without its flag.
+    seconds: time from now, None to only give up when cancelled
+    flag: array of one int64 to poll, a new one by default
+    ticket: value of flag while the work should carry on, a non-negative int
+    """
+    def __init__(self,
+                 seconds: Optional[float]=None,
+                 flag: Optional[npt.NDArray[np.int64]]=None,
+                 ticket: int=0):
+        self.expires = None if seconds is None\
+            else time.monotonic() + seconds
+        self.flag = np.full(1, ticket, dtype=np.int64) if flag is None\
+            else flag
+        self.ticket = ticket
+    
+    def __reduce__(self) -> Tuple[Any, ...]:
+        return Deadline, (0 if self.flag[0] != self.ticket
+                          else self.remaining(),)
+    
+    def cancel(self) -> None:
+        if self.flag[0] == self.ticket:
+            self.flag[0] = _CANCELLED
+    
+    def _expire(self) -> None:
+        if self.flag[0] == self.ticket:
+            self.flag[0] = _EXPIRED
+    
+    def cancelled(self) -> bool:
+        """Whether the work was called off, rather than ran out of time"""
+        return self.flag[0] != self.ticket and self.flag[0] != _EXPIRED
+    
+    def remaining(self) -> Optional[float]:
+        """Seconds left, None if there is no time limit"""
+        if self.expires is None:
+            return None
+        return max(0., self.expires - time.monotonic())
+    
+    def expired(self) -> bool:
+        return self.flag[0] != self.ticket\
+            or (self.expires is not None and time.monotonic() >= self.expires)
+    
+    def check(self) -> None:
+        if self.expired():
+            raise DeadlineExceeded('Deadline exceeded')
+    
+    def timer(self) -> Optional[threading.Timer]:
+        """Starts a timer that sets the flag once this expires, for code
+        that can only poll the flag. Cancel the timer when done.
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return None
+        timer = threading.Timer(remaining, self._expire)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+class DistanceField:
+    """Unit cost distances to the nearest of a growing set of sources, for
+    placing things as far as possible from everything placed so far
+    Adding sources only relaxes the cells that get closer to them, with a
+    breadth first search from the new sources. The farthest cell is kept
+    at the top of a max-heap, where entries for cells that have since got
+    closer are skipped when they reach the top.
+    passable: (h, w) array of whether each cell can be entered
+    """
+    def __init__(self, passable: npt.NDArray[np.bool_]):
+        self.shape = passable.shape
+        self.width = passable.shape[1]
+        self.passable: List[bool] = passable.ravel().tolist()
+        # Cells that farthest never returns
+        self.excluded = [not p for p in self.passable]
+        self.dists = [math.inf] * len(self.passable)
+        # Negated distance and index of each cell that got closer
+        self.heap: List[Tuple[float, int]] = []
+    
+    def add_sources(self, points: Iterable[Pos]) -> None:
+        width, dists, passable, heap = \
+            self.width, self.dists, self.passable, self.heap
+        num_cells = len(dists)
+        frontier: deque[int] = deque()
+        for x, y in points:
+            xy = y * width + x
+            if dists[xy] > 0:
+                dists[xy] = 0
+                frontier.append(xy)
+                heapq.heappush(heap, (0, xy))
+        while len(frontier) > 0:
+            xy = frontier.popleft()
+            dist = dists[xy] + 1
+            x = xy % width
+            for n_xy in (xy - width, xy + width,
+                         xy - 1 if x > 0 else -1,
+                         xy + 1 if x + 1 < width else -1):
+                if 0 <= n_xy < num_cells and passable[n_xy]\
+                        and dist < dists[n_xy]:
+                    dists[n_xy] = dist
+                    frontier.append(n_xy)
+                    heapq.heappush(heap, (-dist, n_xy))
+    
+    def exclude(self, mask: npt.NDArray[np.bool_]) -> None:
+        """Stops farthest from returning the cells where mask is True"""
+        for xy in np.flatnonzero(mask).tolist():
+            self.excluded[xy] = True
+    
+    def farthest(self) -> Optional[Tuple[Pos, float]]:
+        """The reachable cell farthest from the sources and its distance,
+        the first in row-major order on ties
+        """
+        heap = self.heap
+        while len(heap) > 0:
+            neg_dist, xy = heap[0]
+            if self.excluded[xy] or -neg_dist != self.dists[xy]:
+                heapq.heappop(heap)
+                continue
+            y, x = divmod(xy, self.width)
+            return (x, y), -neg_dist
+        return None
+    
+    def distances(self) -> npt.NDArray[np.float64]:
+        """The distances as an (h, w) array"""
+        return np.array(self.dists, dtype=float).reshape(self.shape)
+    
+    def trace(self, start: Pos) -> List[Pos]:
+        """Same as trace_djikstra on the distances"""
+        width, dists = self.width, self.dists
+        height = len(dists) // width
+        path: List[Pos] = [start]
+        head = start
+        while True:
+            min_neighbor = head
+            min_dist = dists[head[1] * width + head[0]]
+            for direction in CardinalDirections:
+                x = head[0] + direction.value[0]
+                y = head[1] + direction.value[1]
+                if x < 0 or x >= width or y < 0 or y >= height:
+                    continue
+                dist = dists[y * width + x]
+                if dist < min_dist:
+                    min_dist = dist
+                    min_neighbor = x, y
+            if min_neighbor == head:
+                return path
+            path.append(min_neighbor)
+            head = min_neighbor
+
 def clear_blockage(dists: npt.NDArray[np.float64]) ->\
         npt.NDArray[np.bool_]:
     """Returns a copy of dists where any grids that potentially block
@@ -204,61 +617,132 @@ def clear_blockage(dists: npt.NDArray[np.float64]) ->\
     blockage |= left & right & ~up & ~down
     return blockage
 
+@numba.njit(cache=_JIT_CACHE)
+def _label_kernel(passable: npt.NDArray[np.bool_],
+                  labels: npt.NDArray[np.int32]) -> int:
+    """Two-pass labelling of 4-connected components into labels
+    The first pass gives each cell the label of its up or left neighbor,
+    recording where the two differ with union-find, and the second
+    renumbers the labels in row-major order of their first cell
+    Returns the number of components
+    """
+    height, width = passable.shape
+    parents = np.empty(height * width, dtype=np.int32)
+    count = 0
+    for y in range(height):
+        for x in range(width):
+            if not passable[y, x]:
+                labels[y, x] = -1
+                continue
+            up = labels[y - 1, x] if y > 0 else -1
+            left = labels[y, x - 1] if x > 0 else -1
+            if up < 0 and left < 0:
+                parents[count] = count
+                labels[y, x] = count
+                count += 1
+            elif up < 0:
+                labels[y, x] = left
+            elif left < 0:
+                labels[y, x] = up
+            else:
+                labels[y, x] = left
+                while parents[up] != up:
+                    parents[up] = parents[parents[up]]
+                    up = parents[up]
+                while parents[left] != left:
+                    parents[left] = parents[parents[left]]
+                    left = parents[left]
+                # Keep the lowest root, so roots come first in row-major
+                if up < left:
+                    parents[left] = up
+                elif left < up:
+                    parents[up] = left
+    final = np.full(count, -1, dtype=np.int32)
+    components = 0
+    for y in range(height):
+        for x in range(width):
+            label = labels[y, x]
+            if label < 0:
+                continue
+            while parents[label] != label:
+                parents[label] = parents[parents[label]]
+                label = parents[label]
+            if final[label] < 0:
+                final[label] = components
+                components += 1
+            labels[y, x] = final[label]
+    return components
+
+@dataclass
+class Components:
+    """Connected components of a grid
+    labels: (h, w) component of each cell, -1 for cells outside any.
+        Components are numbered in row-major order of their first cell.
+    sizes: number of cells in each component
+    boxes: [x, y, width, height] of the bounding box of each component
+    """
+    labels: npt.NDArray[np.int32]
+    sizes: npt.NDArray[np.int64]
+    boxes: npt.NDArray[np.int32]
+    
+    def __len__(self) -> int:
+        return len(self.sizes)
+    
+    def largest(self) -> int:
+        """The largest component, the first of them on ties"""
+        return int(self.sizes.argmax())
+    
+    def cells(self, label: int) -> npt.NDArray[np.int64]:
+        """(n, 2) array of the x, y of each cell of a component, in
+        row-major order
+        """
+        x, y, w, h = self.boxes[label].tolist()
+        ys, xs = np.nonzero(self.labels[y:y + h, x:x + w] == label)
+        return np.stack((xs + x, ys + y), axis=1)
+    
+    def choose(self,
+               label: int,
+               rng: Optional[np.random.Generator]=None) -> Pos:
+        """A random cell of a component"""
+        x, y, w, h = self.boxes[label].tolist()
+        members = np.flatnonzero(self.labels[y:y + h, x:x + w] == label)
+        dy, dx = divmod(int(members[np.random.default_rng(rng)
+                                    .integers(len(members))]), w)
+        return x + dx, y + dy
+
+def label_components(passable: npt.NDArray[np.bool_]) -> Components:
+    """Labels the 4-connected components of the True cells of an (h, w)
+    array
+    """
+    passable = np.ascontiguousarray(passable, dtype=np.bool_)
+    labels = np.empty(passable.shape, dtype=np.int32)
+    count = _label_kernel(passable, labels)
+    flat = labels.ravel()
+    cells = np.flatnonzero(flat >= 0)
+    members = flat[cells]
+    ys, xs = np.divmod(cells, passable.shape[1])
+    sizes = np.bincount(members, minlength=count)
+    x0 = np.full(count, passable.shape[1], dtype=np.int64)
+    y0 = np.full(count, passable.shape[0], dtype=np.int64)
+    x1 = np.zeros(count, dtype=np.int64)
+    y1 = np.zeros(count, dtype=np.int64)
+    np.minimum.at(x0, members, xs)
+    np.minimum.at(y0, members, ys)
+    np.maximum.at(x1, members, xs)
+    np.maximum.at(y1, members, ys)
+    boxes = np.stack((x0, y0, x1 - x0 + 1, y1 - y0 + 1), axis=1)\
+        .astype(np.int32)
+    return Components(labels, sizes, boxes)
+
 def group(size: Pos,
           passable: Sequence[bool]) -> List[Set[Pos]]:
     """Partition a map into groups of reachable tiles from each other
     passable: a row-major sequence of bools, True iff passable
-    Returns a list of sets of the positions of all tiles in each group
+    Returns a list of sets of the positions of all tiles in each group,
+        in row-major order of the first tile of each group
+    Prefer label_components, which doesn't build a tuple per tile
     """
-    # Initialize groups
-    counts: List[Set[Pos]] = [] # Points in each group
-    group_ids: List[int] = [] # Group peresnt at each point
-    for xy, p in enumerate(passable):
-        if not p:
-            group_ids.append(-1)
-            continue
-        group_ids.append(len(counts))
-        counts.append({divmod(xy, size[0])[::-1]})
-    
-    # Iterate over each unprocessed group until all joined
-    igroup = 0
-    ogroup = 0
-    while True:
-        # Identify next input group to use
-        while igroup < len(counts) and len(counts[igroup]) == 0:
-            igroup += 1
-        if igroup == len(counts):
-            # Complete
-            break
-        # Reassign to the lowest empty group
-        if igroup != ogroup:
-            counts[ogroup] = counts[igroup]
-            counts[igroup] = set()
-            for x, y in counts[ogroup]:
-                xy = y * size[0] + x
-                group_ids[xy] = ogroup
-        group = counts[ogroup]
-        starting_point = next(iter(group))
-        
-        # Flood fill
-        frontier = deque([starting_point])
-        while len(frontier) > 0:
-            x0, y0 = frontier.pop()
-            for direction in CardinalDirections:
-                x, y = x0 + direction.value[0], y0 + direction.value[1]
-                if x < 0 or x >= size[0] or y < 0 or y >= size[1]:
-                    continue
-                xy = y * size[0] + x
-                if not passable[xy]:
-                    continue
-                old_group = group_ids[xy]
-                if old_group == ogroup:
-                    group_ids[xy] = ogroup
-                    continue
-                counts[old_group].remove((x, y))
-                group_ids[xy] = ogroup
-                frontier.append((x, y))
-                counts[ogroup].add((x, y))
-        igroup += 1
-        ogroup += 1
-    return counts[:ogroup]
+    components = label_components(
+        np.asarray(passable, dtype=np.bool_).reshape(size[::-1]))
+    return [set(map(tuple, components.cells(i).tolist()))
+            for i in range(len(components))]
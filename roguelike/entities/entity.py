@@ -493,17 +493,17 @@ class EnemyEntity(ActingEntity):
                      chase_radius: int) -> bool:
         state = cast('DungeonMapState', state)
         my_anim = self.anim
-        path = state.dungeon_map.a_star(cast(Pos, tuple(self.dungeon_pos)),
-                                        player_pos,
-                                        chase_radius)
-        if path is None:
+        next_step = state.dungeon_map.chase_step(
+            cast(Pos, tuple(self.dungeon_pos)),
+            player_pos,
+            chase_radius)
+        if next_step is None:
             # Player cannot be reached, just sit still
             return False
-        if len(path) < 3:
+        if next_step == player_pos:
             # Player is within one square
             self.melee_attack(state, state.dungeon_map.player)
             return True
-        next_step = path[1]
         # Animations and motion
         anim_state = sprite.AnimState.WALK
         prop = None
@@ -74,7 +74,10 @@ class Populator:
         self.so_far = [0] * len(self.spawns)
     
     """Puts something optional and interesting into a level"""
-    def populate(self, pos: Pos) -> Optional[Tuple[Pos, Type, Dict[str, Any]]]:
+    def populate(self,
+                 pos: Pos,
+                 rng: Optional[np.random.Generator]=None)\
+            -> Optional[Tuple[Pos, Type, Dict[str, Any]]]:
         options = [i for i, spn in enumerate(self.spawns)\
             if (self.so_far[i] < spn.limit or spn.limit < 0)\
             and eval_preds(spn.predicates)]
@@ -82,7 +85,8 @@ class Populator:
             return None
         weights = np.array([self.spawns[i].weight for i in options],
                            dtype=float)
-        choice = np.random.choice(options, p=weights/weights.sum())
+        choice = np.random.default_rng(rng).choice(options,
+                                                   p=weights/weights.sum())
         spawn = spawns[self.spawns[choice].spawn_name]
         if spawn.spawn_class is None:
             return None
@@ -1,3 +1,5 @@
+import multiprocessing
+
 import moderngl as mgl
 import pygame as pg
 
@@ -7,10 +9,13 @@ from roguelike import (
 )
 from roguelike.engine import assets
 
-pg.init()
-ico = pg.image.load(assets.asset_path('icon.png'))
-pg.display.set_icon(ico)
-pg.display.set_caption(settings.NAME)
-screen = pg.display.set_mode(settings.SCREEN_SIZE, pg.DOUBLEBUF | pg.OPENGL)
-gl_ctx = mgl.create_context(require=330)
-game.gameloop(screen, gl_ctx, settings.MAX_FPS)
\ No newline at end of file
+if __name__ == '__main__':
+    # Level generation workers are spawned, and re-run this module
+    multiprocessing.freeze_support()
+    pg.init()
+    ico = pg.image.load(assets.asset_path('icon.png'))
+    pg.display.set_icon(ico)
+    pg.display.set_caption(settings.NAME)
+    screen = pg.display.set_mode(settings.SCREEN_SIZE, pg.DOUBLEBUF | pg.OPENGL)
+    gl_ctx = mgl.create_context(require=330)
+    game.gameloop(screen, gl_ctx, settings.MAX_FPS)
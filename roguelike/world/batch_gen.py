@@ -0,0 +1,259 @@
+"""Generates many levels headless, without a display or GL context, and
+reports how long they took and what came out of them
+
+Run as python -m roguelike.world.batch_gen --help
+"""
+import argparse
+import collections
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import os
+import sys
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Tuple
+)
+
+import numpy as np
+
+from roguelike.engine import (
+    assets,
+    utils
+)
+# world_gen has to be imported before the modules that it imports import
+from roguelike.world import (
+    world_gen,
+    dungeon
+)
+from roguelike.entities import (
+    npc,
+    spawn
+)
+from roguelike.bag import (
+    armor,
+    charms,
+    consumables,
+    keys,
+    spells,
+    weapons
+)
+
+Pos = Tuple[int, int]
+LevelRecord = Dict[str, Any]
+
+PERCENTILES = (50, 90, 99, 100)
+# Palette indices of what is marked on dumped maps, past any tile index
+PLAYER_MARK = 42 # Cyan
+KEY_MARK = 67 # Magenta
+EXIT_MARK = 187 # Yellow
+SPAWN_MARK = 211 # Red
+
+def init_headless(difficulty: int=0) -> None:
+    """Loads what generating and populating levels needs, the same way as
+    game.init but without a renderer
+    """
+    assets.load_assets(None, 'assets.json')
+    dungeon.init_tiles()
+    consumables.init_items()
+    keys.init_items()
+    spells.init_items()
+    weapons.init_items()
+    armor.init_items()
+    charms.init_items()
+    npc.init_chats()
+    world_gen.init_generators()
+    spawn.init()
+    assets.variables['coins'] = 0
+    assets.variables['difficulty'] = difficulty
+
+def level_seeds(seed: int, count: int) -> List[int]:
+    sequence = np.random.SeedSequence(seed)
+    return [int(s) >> 1 for s in sequence.generate_state(count, np.uint64)]
+
+def dump_level(layout: world_gen.LevelLayout,
+               spawner: dungeon.DungeonMapSpawner,
+               fname: str) -> None:
+    """Saves the tiles of a level as a paletted image, with what was placed
+    on it marked
+    """
+    grid = layout.tiles.astype(np.int32)
+    for (x, y), _, __ in spawner.spawns:
+        grid[y, x] = SPAWN_MARK
+    for x, y in layout.key_positions:
+        grid[y, x] = KEY_MARK
+    grid[layout.exit_pos[1], layout.exit_pos[0]] = EXIT_MARK
+    grid[layout.player_pos[1], layout.player_pos[0]] = PLAYER_MARK
+    utils.save_grid(grid, fname)
+
+def generate_level(name: str,
+                   size: Pos,
+                   seed: int,
+                   png_dir: Optional[str]=None) -> LevelRecord:
+    """Generates and populates one level, bypassing the level cache and the
+    generation service so that every stage is timed here
+    """
+    record: LevelRecord = {'world': name, 'seed': seed}
+    gen = world_gen.world_generators[name]
+    try:
+        key_item, key_count = gen.choose_exit(seed)
+        layout = gen.layout_generator().generate_layout(size,
+                                                        key_item,
+                                                        key_count,
+                                                        seed)
+        spawner = gen.populate_layout(layout)
+    except Exception as err:
+        record['error'] = f'{type(err).__name__}: {err}'
+        return record
+    stats = layout.stats
+    passable = gen.tile_properties.passable[layout.tiles]
+    dists = utils.DistanceField(passable)
+    dists.add_sources((layout.player_pos,))
+    reachable = np.isfinite(dists.distances())
+    exit_dist = dists.distances()[layout.exit_pos[1], layout.exit_pos[0]]
+    spawns = collections.Counter(ent_cls.__name__
+                                 for _, ent_cls, __ in spawner.spawns)
+    record.update({
+        'times': dict(stats.times),
+        'total': sum(stats.times.values()),
+        'counts': dict(stats.counts),
+        'connectivity': float(reachable.sum() / max(passable.sum(), 1)),
+        'exit_distance': float(exit_dist) if np.isfinite(exit_dist)
+                         else None,
+        'spawns': dict(spawns)
+    })
+    if png_dir is not None:
+        dump_level(layout,
+                   spawner,
+                   os.path.join(png_dir,
+                                f'{name}_{size[0]}x{size[1]}_{seed}.png'))
+    return record
+
+def percentiles(values: Sequence[float]) -> Dict[str, float]:
+    if len(values) == 0:
+        return {}
+    points = np.percentile(values, PERCENTILES)
+    return {f'p{p}': float(v) for p, v in zip(PERCENTILES, points)}
+
+def summarize(records: Iterable[LevelRecord]) -> Dict[str, Any]:
+    """Aggregate metrics of the levels of each world"""
+    by_world: Dict[str, List[LevelRecord]] = collections.defaultdict(list)
+    for record in records:
+        by_world[record['world']].append(record)
+    summary: Dict[str, Any] = {}
+    for name, world_records in by_world.items():
+        done = [r for r in world_records if 'error' not in r]
+        errors = collections.Counter(r['error'] for r in world_records
+                                     if 'error' in r)
+        stage_times: Dict[str, List[float]] = collections.defaultdict(list)
+        counts: Dict[str, int] = collections.Counter()
+        spawns: Dict[str, int] = collections.Counter()
+        for record in done:
+            for stage, seconds in record['times'].items():
+                stage_times[stage].append(seconds)
+            counts.update(record['counts'])
+            spawns.update(record['spawns'])
+        exit_dists = [r['exit_distance'] for r in done
+                      if r['exit_distance'] is not None]
+        connectivity = [r['connectivity'] for r in done]
+        levels = max(len(done), 1)
+        summary[name] = {
+            'levels': len(world_records),
+            'errors': dict(errors),
+            'total_time': percentiles([r['total'] for r in done]),
+            'stage_times': {stage: percentiles(times)
+                            for stage, times in stage_times.items()},
+            'connectivity': {
+                'mean': float(np.mean(connectivity)) if done else None,
+                'min': min(connectivity, default=None),
+                'unreachable_exits': len(done) - len(exit_dists)
+            },
+            'exit_distance': percentiles(exit_dists),
+            'mean_counts': {k: v / levels for k, v in counts.items()},
+            'mean_spawns': {k: v / levels for k, v in spawns.items()}
+        }
+    return summary
+
+def run_batch(names: Sequence[str],
+              size: Pos,
+              seeds: Sequence[int],
+              workers: int=1,
+              difficulty: int=0,
+              png_dir: Optional[str]=None) -> List[LevelRecord]:
+    """Generates a level of each world for each seed
+    With more than 1 worker, levels are generated in a process pool of
+    that many headless processes
+    """
+    jobs = [(name, size, seed, png_dir) for name in names for seed in seeds]
+    if workers <= 1:
+        return [generate_level(*job) for job in jobs]
+    with concurrent.futures.ProcessPoolExecutor(
+            workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_headless,
+            initargs=(difficulty,)) as pool:
+        chunksize = max(1, len(jobs) // (workers * 8))
+        return list(pool.map(generate_level,
+                             *zip(*jobs),
+                             chunksize=chunksize))
+
+def main(argv: Optional[Sequence[str]]=None) -> None:
+    parser = argparse.ArgumentParser(
+        description='Generate levels headless and report metrics')
+    parser.add_argument('worlds', nargs='*',
+                        help='worlds to generate, defaults to all of them')
+    parser.add_argument('-n', '--count', type=int, default=100,
+                        help='levels to generate for each world')
+    parser.add_argument('-s', '--size', type=int, nargs=2, default=(20, 20),
+                        metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('-d', '--difficulty', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed from which each level seed is derived')
+    parser.add_argument('-j', '--workers', type=int,
+                        default=os.cpu_count() or 1)
+    parser.add_argument('-o', '--out',
+                        help='write the metrics as JSON here, '
+                        'instead of to stdout')
+    parser.add_argument('--records',
+                        help='write the metrics of every level as JSON '
+                        'lines here')
+    parser.add_argument('--png-dir',
+                        help='dump an image of every level here')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.WARNING)
+
+    init_headless(args.difficulty)
+    names = args.worlds or list(world_gen.world_generators)
+    for name in names:
+        if name not in world_gen.world_generators:
+            parser.error(f'{name} is not a valid world')
+    if args.png_dir is not None:
+        os.makedirs(args.png_dir, exist_ok=True)
+    records = run_batch(names,
+                        tuple(args.size),
+                        level_seeds(args.seed, args.count),
+                        args.workers,
+                        args.difficulty,
+                        args.png_dir)
+    if args.records is not None:
+        with open(args.records, 'w') as file:
+            for record in records:
+                file.write(json.dumps(record) + '\n')
+    summary = summarize(records)
+    if args.out is not None:
+        with open(args.out, 'w') as file:
+            json.dump(summary, file, indent=2)
+    else:
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+
+if __name__ == '__main__':
+    main()
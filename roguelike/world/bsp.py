@@ -1,7 +1,7 @@
 import logging
-import random
 from typing import (
     List,
+    Optional,
     Set,
     Tuple
 )
@@ -18,10 +18,12 @@ def bsp(size: Pos,
         inside: int,
         outside: int,
         border: int,
-        join: bool) -> IArray:
+        join: bool,
+        rng: Optional[np.random.Generator]=None) -> IArray:
+    rng = np.random.default_rng(rng)
     width, height = size
     array = np.full((height, width), outside, dtype=np.int32)
-    boxes = partition(size, min_room_size)
+    boxes = partition(size, min_room_size, rng)
     for box in boxes:
         logging.debug(f'Box: {box}')
         for y in range(box[3]):
@@ -37,46 +39,56 @@ def bsp(size: Pos,
             center = box[0] + box[2] // 2, box[1] + box[3] // 2
             groups.append({center})
         while len(groups) > 1:
-            i = random.randint(0, len(groups) - 2)
-            j = random.randint(i + 1, len(groups) - 1)
+            i = int(rng.integers(0, len(groups) - 1))
+            j = int(rng.integers(i + 1, len(groups)))
             set_i = groups[i]
             set_j = groups[j]
-            box_i = random.choice(list(set_i))
-            box_j = random.choice(list(set_j))
-            tunnel(array, box_i, box_j, inside, outside, border)
+            box_i = _choice(list(set_i), rng)
+            box_j = _choice(list(set_j), rng)
+            tunnel(array, box_i, box_j, inside, outside, border, rng)
             set_i.update(set_j)
             groups.pop(j)
     return array
 
+def _choice(options: List[Pos], rng: np.random.Generator) -> Pos:
+    """random.choice from a generator, without turning the positions into
+    an array
+    """
+    return options[int(rng.integers(len(options)))]
+
 def partition(size: Pos,
-              min_room_size: Pos) -> List[Box]:
+              min_room_size: Pos,
+              rng: Optional[np.random.Generator]=None) -> List[Box]:
+    rng = np.random.default_rng(rng)
     wide_enough = size[0] > min_room_size[0] * 2
     tall_enough = size[1] > min_room_size[1] * 2
     if wide_enough:
         if tall_enough:
             # choose a random direction
-            horizontal = random.randint(0, 1) == 0
+            horizontal = rng.integers(2) == 0
         else:
             horizontal = True
     elif tall_enough:
         horizontal = False
     else:
-        width = random.randint(min_room_size[0], size[0])
-        height = random.randint(min_room_size[1], size[1])
-        x = random.randint(0, size[0] - width)
-        y = random.randint(0, size[1] - height)
+        width = int(rng.integers(min_room_size[0], size[0] + 1))
+        height = int(rng.integers(min_room_size[1], size[1] + 1))
+        x = int(rng.integers(0, size[0] - width + 1))
+        y = int(rng.integers(0, size[1] - height + 1))
         return [[x, y, width, height]]
     if horizontal:
-        split = random.randint(min_room_size[0], size[0] - min_room_size[0])
-        left = partition((split, size[1]), min_room_size)
-        right = partition((size[0] - split, size[1]), min_room_size)
+        split = int(rng.integers(min_room_size[0],
+                                 size[0] - min_room_size[0] + 1))
+        left = partition((split, size[1]), min_room_size, rng)
+        right = partition((size[0] - split, size[1]), min_room_size, rng)
         for box in right:
             box[0] += split
         return left + right
     else:
-        split = random.randint(min_room_size[1], size[1] - min_room_size[1])
-        top = partition((size[0], split), min_room_size)
-        bottom = partition((size[0], size[1] - split), min_room_size)
+        split = int(rng.integers(min_room_size[1],
+                                 size[1] - min_room_size[1] + 1))
+        top = partition((size[0], split), min_room_size, rng)
+        bottom = partition((size[0], size[1] - split), min_room_size, rng)
         for box in bottom:
             box[1] += split
         return top + bottom
@@ -86,15 +98,22 @@ def tunnel(array: IArray,
            to: Pos,
            inside: int,
            outside: int,
-           border: int) -> None:
+           border: int,
+           rng: Optional[np.random.Generator]=None) -> List[Pos]:
+    """Digs an L-shaped tunnel of inside between two points, lined with
+    border where it passes outside
+    Returns the positions dug, which may repeat
+    """
     logging.debug(f'Tunneling from {from_} to {to}')
-    x_first = random.randint(0, 1) == 0
+    x_first = np.random.default_rng(rng).integers(2) == 0
+    dug: List[Pos] = []
     x = from_[0]
     if x_first:
         x0 = min(from_[0], to[0])
         x1 = max(from_[0], to[0])
         for x in range(x0, x1 + 1):
             array[from_[1], x] = inside
+            dug.append((x, from_[1]))
             if from_[1] > 0\
                     and array[from_[1] - 1, x] == outside:
                 array[from_[1] - 1, x] = border
@@ -106,6 +125,7 @@ def tunnel(array: IArray,
     y1 = max(from_[1], to[1])
     for y in range(y0, y1 + 1):
         array[y, x] = inside
+        dug.append((x, y))
         if x > 0 and array[y, x - 1] == outside:
             array[y, x - 1] = border
         if x + 1 < array.shape[1] and array[y, x + 1] == outside:
@@ -115,9 +135,11 @@ def tunnel(array: IArray,
         x1 = max(from_[0], to[0])
         for x in range(x0, x1 + 1):
             array[to[1], x] = inside
+            dug.append((x, to[1]))
             if to[1] > 0\
                     and array[to[1] - 1, x] == outside:
                 array[to[1] - 1, x] = border
             if to[1] + 1 < array.shape[0]\
                     and array[to[1] + 1, x] == outside:
-                array[to[1] + 1, x] = border
\ No newline at end of file
+                array[to[1] + 1, x] = border
+    return dug
@@ -17,8 +17,11 @@ def run(grid: IArray,
         num: int,
         corners: bool = True,
         border: bool = True) -> None:
-    """Apply a cellular automaton to a 2D grid"""
-    is_full = np.vectorize(full.__contains__)
+    """Apply a cellular automaton to a 2D grid
+    Each iteration counts the full neighbors of every cell at once, with the
+    grid padded by a cell that is full if border is True
+    """
+    full_values = np.array(sorted(full), dtype=grid.dtype)
     neighbors: Tuple[Tuple[int, int], ...] = (
         (0, 1),
         (0, -1),
@@ -33,18 +36,15 @@ def run(grid: IArray,
             (-1, -1)
         )
         neighbors += ord_neighbors
+    height, width = grid.shape
     for _ in range(num):
-        filled = np.where(is_full(grid), 1, 0)
-        for y in range(grid.shape[0]):
-            for x in range(grid.shape[1]):
-                population = 0
-                for dx, dy in neighbors:
-                    if x + dx < 0 or x + dx >= grid.shape[1]\
-                            or y + dy < 0 or y + dy >= grid.shape[0]:
-                        population += 1 if border else 0
-                        continue
-                    population += filled[y + dy, x + dx]
-                if population < clear_below:
-                    grid[y, x] = clear_with
-                elif population >= fill_from:
-                    grid[y, x] = fill_with
\ No newline at end of file
+        filled = np.pad(np.isin(grid, full_values).astype(np.int32),
+                        1,
+                        constant_values=1 if border else 0)
+        population = np.zeros(grid.shape, dtype=np.int32)
+        for dx, dy in neighbors:
+            population += filled[1 + dy:1 + dy + height,
+                                 1 + dx:1 + dx + width]
+        fill = population >= fill_from
+        grid[population < clear_below] = clear_with
+        grid[fill & (population >= clear_below)] = fill_with
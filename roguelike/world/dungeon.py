@@ -7,7 +7,6 @@ from enum import Enum
 import heapq
 import logging
 import math
-import random
 from typing import (
     cast,
     Any,
@@ -23,6 +22,7 @@ from typing import (
 )
 
 import numpy as np
+import numpy.typing as npt
 import pygame as pg
 
 from roguelike.engine import (
@@ -46,7 +46,10 @@ Pos = Tuple[int, int]
 
 if TYPE_CHECKING:
     from roguelike.engine.renderer import Renderer
-    from roguelike.world.world_gen import WorldGenerator
+    from roguelike.world.world_gen import (
+        GenerationStats,
+        WorldGenerator
+    )
 
 class RandomAnimType(Enum):
     GLOBAL      = 0
@@ -66,6 +69,56 @@ class DungeonTile:
 
 tiles: Dict[str, DungeonTile] = {}
 
+@dataclass
+class TileProperties:
+    """Properties of each tile of a tile list as arrays, so a whole grid of
+    tile indices can be looked up with one indexing operation
+    Each array has an extra entry at the end for index -1, which is no
+    tile at all
+    """
+    passable: npt.NDArray[np.bool_]
+    offset_type: npt.NDArray[np.int32]
+    offset_power: npt.NDArray[np.float64]
+    
+    def anim_offsets(self,
+                     indices: npt.NDArray[np.int64],
+                     origin: Tuple[int, int]) -> npt.NDArray[np.float64]:
+        """How far ahead the animation of each tile in a window of tile
+        indices is, by its position in the world
+        origin: world position of indices[0, 0]
+        """
+        ys, xs = np.indices(indices.shape)
+        xs += origin[0]
+        ys += origin[1]
+        offset_type = self.offset_type[indices]
+        phases = np.select(
+            [offset_type == RandomAnimType.X.value,
+             offset_type == RandomAnimType.Y.value,
+             offset_type == RandomAnimType.X_PLUS_Y.value,
+             offset_type == RandomAnimType.X_MINUS_Y.value,
+             offset_type == RandomAnimType.RANDOM.value],
+            [xs, ys, xs + ys, xs - ys, np.random.random(indices.shape)],
+            0.)
+        return phases * self.offset_power[indices]
+
+# Properties of each tile list, by the identities of its tiles
+_tile_properties: Dict[Tuple[int, ...], TileProperties] = {}
+
+def tile_properties(tile_list: Sequence[DungeonTile]) -> TileProperties:
+    """The properties of a tile list, built once per list"""
+    key = tuple(map(id, tile_list))
+    if key in _tile_properties:
+        return _tile_properties[key]
+    props = TileProperties(
+        np.array([tile.passable for tile in tile_list] + [False],
+                 dtype=np.bool_),
+        np.array([tile.offset_type.value for tile in tile_list]
+                 + [RandomAnimType.GLOBAL.value], dtype=np.int32),
+        np.array([tile.offset_power for tile in tile_list] + [0.],
+                 dtype=np.float64))
+    _tile_properties[key] = props
+    return props
+
 def init_tiles() -> None:
     """Called to initialize tiles from assets"""
     tile_res = assets.residuals['tiles']
@@ -90,6 +143,10 @@ class DungeonMapSpawner:
     spawns: MutableSequence[Tuple[Tuple[int, int], Type, Dict[str, Any]]] =\
         field(default_factory=list)
     border: int = -1
+    # Size of the level the exit leads to
+    next_size: Optional[Tuple[int, int]] = None
+    # How long generating the level took and what it did
+    stats: Optional['GenerationStats'] = None
     
     def spawn_map(self, old_player: 'player.PlayerEntity'=None):
         dungeon_map = DungeonMap(self.size,
@@ -126,6 +183,7 @@ class DungeonMap:
                  border: int = -1):
         self.size = size
         self.tiles = tiles
+        self.properties = tile_properties(tiles)
         self.tile_map: List[int] = []
         self.foreground: Dict[Tuple[int, int], int] =\
             defaultdict(lambda: -1)
@@ -133,6 +191,13 @@ class DungeonMap:
         self.player: player.PlayerEntity = None # type: ignore
         self.vignette_color = vignette_color
         self.border = border
+        self.path_workspace = utils.PathWorkspace(size[::-1])
+        # Distances from the player for chasing, while the player is at
+        # player_field_pos and nothing that stays put moves
+        self.player_field = np.full(size[::-1], np.inf)
+        self.player_field_pos: Optional[Tuple[int, int]] = None
+        # Breaks ties between equally good moves
+        self.rng = np.random.default_rng()
     
     @staticmethod
     def _manhattan_dist(from_: Tuple[int, int], to: Tuple[int, int]) -> int:
@@ -152,30 +217,116 @@ class DungeonMap:
         the grid-based world. Distance increments by 1 at each step, and
         the entity can step in the 4 cardinal direction
         """
-        cost = []
-        for y in range(self.size[1]):
-            cost.append([1 if self.is_free((x, y)) or (x, y) == to\
-                     else float('inf') for x in range(self.size[0])])
-        return utils.a_star(np.array(cost),
+        cost = np.where(self.passable_mask(), 1., np.inf)
+        for pos, ent in self.entities.items():
+            if not ent.passable:
+                cost[pos[::-1]] = np.inf
+        if 0 <= to[0] < self.size[0] and 0 <= to[1] < self.size[1]:
+            cost[to[::-1]] = 1
+        return utils.a_star(cost,
                             from_,
                             to,
-                            None if maxdist < 0 else maxdist)
+                            None if maxdist < 0 else maxdist,
+                            self.path_workspace)
     
-    def tile_at(self, pos: Tuple[int, int]) -> Optional[DungeonTile]:
+    def distances_to_player(self,
+                            player_pos: Tuple[int, int]) ->\
+            npt.NDArray[np.float64]:
+        """Distance from each (y, x) to player_pos, shared by everything
+        chasing the player and only recalculated when the player moves
+        or the map changes
+        Entities that take actions aren't obstacles here, since they
+        move during the turn. They step around each other instead.
+        """
+        if self.player_field_pos != player_pos:
+            cost = np.where(self.passable_mask(), 1., np.inf)
+            for pos, ent in self.entities.items():
+                if not ent.passable and not ent.actionable:
+                    cost[pos[::-1]] = np.inf
+            utils.populate_djikstra(cost, (player_pos,),
+                                    out=self.player_field)
+            self.player_field_pos = player_pos
+        return self.player_field
+    
+    def chase_step(self,
+                   from_: Tuple[int, int],
+                   player_pos: Tuple[int, int],
+                   maxdist: int = -1) -> Optional[Tuple[int, int]]:
+        """Where an entity at from_ should go to chase the player, down
+        distances_to_player
+        Returns player_pos if from_ is next to the player, and None if
+        the player is farther than maxdist, can't be reached, or every
+        step toward them is taken
+        When every step closer is taken, by whatever got there first
+        this turn, steps to a free tile as far away instead, to get
+        around it. Ties are broken at random, so chasers don't all line up
+        along the same axis.
+        """
+        dists = self.distances_to_player(player_pos)
+        dist = dists[from_[1], from_[0]]
+        if not math.isfinite(dist) or 0 <= maxdist < dist:
+            return None
+        if dist <= 1:
+            return player_pos
+        closer: List[Tuple[int, int]] = []
+        sidesteps: List[Tuple[int, int]] = []
+        for direction in utils.CardinalDirections:
+            x = from_[0] + direction.value[0]
+            y = from_[1] + direction.value[1]
+            if x < 0 or x >= self.size[0] or y < 0 or y >= self.size[1]:
+                continue
+            step_dist = dists[y, x]
+            if step_dist > dist or (x, y) in self.entities\
+                    or not self.is_passable((x, y)):
+                continue
+            (closer if step_dist < dist else sidesteps).append((x, y))
+        for steps in (closer, sidesteps):
+            if len(steps) > 0:
+                return steps[int(self.rng.integers(len(steps)))]
+        return None
+    
+    def tile_index(self, pos: Tuple[int, int]) -> int:
+        """Index of the tile at pos, -1 for none"""
         if pos[0] < 0 or pos[0] >= self.size[0]:
-            index = self.border
+            return self.border
         elif pos[1] < 0 or pos[1] >= self.size[1]:
-            index = self.border
-        else:
-            pindex = pos[1] * self.size[0] + pos[0]
-            index = self.tile_map[pindex]
+            return self.border
+        return self.tile_map[pos[1] * self.size[0] + pos[0]]
+    
+    def tile_at(self, pos: Tuple[int, int]) -> Optional[DungeonTile]:
+        index = self.tile_index(pos)
         if index == -1:
             return None
         return self.tiles[index]
     
+    def passable_mask(self) -> npt.NDArray[np.bool_]:
+        """Whether the tile at each (y, x) is passable, ignoring entities"""
+        grid = np.reshape(self.tile_map, self.size[::-1])
+        return self.properties.passable[grid]
+    
+    def tile_window(self,
+                    origin: Tuple[int, int],
+                    size: Tuple[int, int]) -> npt.NDArray[np.int64]:
+        """Indices of the tiles at each (y, x) of the (w, h) window at origin,
+        the border outside of the map
+        """
+        window = np.full(size[::-1], self.border, dtype=np.int64)
+        left = max(origin[0], 0)
+        right = min(origin[0] + size[0], self.size[0])
+        if left < right:
+            for y in range(max(origin[1], 0),
+                           min(origin[1] + size[1], self.size[1])):
+                row = y * self.size[0]
+                window[y - origin[1], left - origin[0]:right - origin[0]] =\
+                    self.tile_map[row + left:row + right]
+        return window
+    
+    def is_passable(self, pos: Tuple[int, int]) -> bool:
+        """Whether the tile at pos is passable, ignoring entities"""
+        return bool(self.properties.passable[self.tile_index(pos)])
+    
     def is_free(self, pos: Tuple[int, int]) -> bool:
-        tile = self.tile_at(pos)
-        if tile is None or not tile.passable:
+        if not self.is_passable(pos):
             return False
         any_ent = self.entities.get(pos, None)
         if any_ent is not None:
@@ -192,6 +343,8 @@ class DungeonMap:
         if ent is None:
             return False
         self.entities[to] = ent
+        if not ent.actionable:
+            self.player_field_pos = None
         ent.dungeon_pos = list(to)
         return True
     
@@ -200,12 +353,14 @@ class DungeonMap:
         if not self.is_free(check_pos):
             return False
         self.entities[check_pos] = ent
+        self.player_field_pos = None
         return True
     
     def remove_entity(self, ent: entity.Entity) -> None:
         check_pos = cast(Pos, tuple(ent.dungeon_pos))
         if self.entities.get(check_pos, None) is ent:
             self.entities.pop(check_pos)
+            self.player_field_pos = None
 
 class DungeonMapState(gamestate.GameState):
     """Gamestate for traversing a dungeon
@@ -230,6 +385,7 @@ class DungeonMapState(gamestate.GameState):
         self.tile_size = kwargs.pop('tile_size')
         self.starting_generator = kwargs.pop('base_generator')
         self.starting_size = kwargs.pop('base_size')
+        self.generator: 'WorldGenerator' = self.starting_generator
         super().__init__(*args, **kwargs)
         self.camera = tween.AnimatableMixin()
         self.particles: List[particle.DungeonParticle] = []
@@ -242,6 +398,7 @@ class DungeonMapState(gamestate.GameState):
                       size: Tuple[int, int],
                       **kwargs) -> None:
         spawner = gen.generate_world(size, **kwargs)
+        self.generator = gen
         self.load_spawner(spawner)
     
     def load_spawner(self, spawner: DungeonMapSpawner) -> None:
@@ -250,12 +407,23 @@ class DungeonMapState(gamestate.GameState):
     def enter_loaded_room(self) -> None:
         self.dungeon_map = self.dungeon_map_spec.spawn_map(
             self.dungeon_map.player)
+        self.prefetch_next()
+    
+    def prefetch_next(self) -> None:
+        """Starts building the level behind this one's exit, which is one
+        difficulty up
+        """
+        next_size = self.dungeon_map_spec.next_size
+        if next_size is not None:
+            self.generator.prefetch(next_size,
+                                    (assets.variables['difficulty'] or 0) + 1)
     
     def respawn(self):
         logging.debug('Respawning')
         self.generate_from(self.starting_generator, self.starting_size)
         self.dungeon_map = self.dungeon_map_spec.spawn_map()
         self.blackout = 0.
+        self.prefetch_next()
     
     def render_gamestate(self,
                          delta_time: float,
@@ -289,27 +457,27 @@ class DungeonMapState(gamestate.GameState):
             
             stack_fbo = renderer.push_fbo()
             stack_fbo.clear(0, 0, 0, 1)
-            for y in range(start_tile_y, start_tile_y + num_tiles_y):
-                for x in range(start_tile_x, start_tile_x + num_tiles_x):
-                    tile = self.dungeon_map.tile_at((x, y))
-                    if tile is not None:
+            origin = (start_tile_x, start_tile_y)
+            indices = self.dungeon_map.tile_window(origin,
+                                                   (num_tiles_x, num_tiles_y))
+            offsets = self.dungeon_map.properties.anim_offsets(indices,
+                                                               origin)
+            for y, index_row, offset_row in zip(
+                    range(start_tile_y, start_tile_y + num_tiles_y),
+                    indices.tolist(),
+                    offsets.tolist()):
+                for x, index, dt in zip(
+                        range(start_tile_x, start_tile_x + num_tiles_x),
+                        index_row,
+                        offset_row):
+                    if index != -1:
+                        tile = self.dungeon_map.tiles[index]
                         if tile.special_render:
                             tile.render(delta_time, # type: ignore
                                         renderer,
                                         (x, y),
                                         self.tile_size)
                         else:
-                            dt = 0.
-                            if tile.offset_type == RandomAnimType.X:
-                                dt += x * tile.offset_power
-                            elif tile.offset_type == RandomAnimType.Y:
-                                dt += y * tile.offset_power
-                            elif tile.offset_type == RandomAnimType.X_PLUS_Y:
-                                dt += (x + y) * tile.offset_power
-                            elif tile.offset_type == RandomAnimType.X_MINUS_Y:
-                                dt += (x - y) * tile.offset_power
-                            elif tile.offset_type == RandomAnimType.RANDOM:
-                                dt += random.random() * tile.offset_power
                             tile.anim.render(renderer,
                                              (x * self.tile_size - adj_x,
                                               y * self.tile_size - adj_y),
@@ -482,7 +650,12 @@ class DungeonMapState(gamestate.GameState):
         """
         player_pos = cast(Tuple[int, int],
                           tuple(self.dungeon_map.player.dungeon_pos))
-        entities = tuple(self.dungeon_map.entities.values())
+        # Nearest to the player first, so that those chasing the player
+        # don't wait behind others that are about to move out of the way
+        dists = self.dungeon_map.distances_to_player(player_pos)
+        entities = sorted(self.dungeon_map.entities.values(),
+                          key=lambda ent: dists[ent.dungeon_pos[1],
+                                                ent.dungeon_pos[0]])
         for ent in entities:
             if ent.actionable:
                 actor = cast(entity.ActingEntity, ent)
@@ -0,0 +1,248 @@
+"""Builds level layouts in a worker process, so that the game keeps running
+while a level generates and the next level can be started ahead of time
+"""
+import concurrent.futures
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+from typing import (
+    Any,
+    Dict,
+    Optional,
+    Tuple,
+    TYPE_CHECKING
+)
+
+import numpy as np
+import numpy.typing as npt
+
+from roguelike.engine import (
+    assets,
+    utils
+)
+from roguelike.world import (
+    wfc,
+    world_gen
+)
+
+if TYPE_CHECKING:
+    from roguelike.world.world_gen import (
+        LayoutGenerator,
+        LevelLayout,
+        WorldGenerator
+    )
+
+Pos = Tuple[int, int]
+LayoutKey = Tuple[str, Pos]
+# Settings of a world and whether each of its tiles is passable
+LayoutSource = Tuple[Dict[str, Any], npt.NDArray[np.bool_]]
+
+# Worker side state
+_layout_sources: Dict[str, LayoutSource] = {}
+_layout_generators: Dict[str, 'LayoutGenerator'] = {}
+
+def _init_worker(sources: Dict[str, LayoutSource]) -> None:
+    _layout_sources.update(sources)
+
+def _layout_generator(name: str) -> 'LayoutGenerator':
+    if name not in _layout_generators:
+        value, passable_tiles = _layout_sources[name]
+        features = list(map(world_gen.parse_wall_feature,
+                            value.get('features', [])))
+        _layout_generators[name] = world_gen.LayoutGenerator(
+            world_gen.parse_wall_generator(value['wall']),
+            features,
+            world_gen.parse_tile_generator(value['tile']),
+            passable_tiles,
+            value.get('boredom', 16),
+            world_gen.parse_wall_generator(value['fallback'])
+                if 'fallback' in value else None)
+    return _layout_generators[name]
+
+def _generate_layout(name: str,
+                     size: Pos,
+                     key_item: Optional[str],
+                     key_count: int,
+                     seed: int,
+                     seconds: Optional[float],
+                     cancel: wfc.SharedArray,
+                     ticket: int) -> 'LevelLayout':
+    deadline = utils.Deadline(seconds, wfc.attach_array(cancel), ticket)
+    return _layout_generator(name).generate_layout(size,
+                                                   key_item,
+                                                   key_count,
+                                                   seed,
+                                                   deadline)
+
+class GenerationService:
+    """Hands out level layouts from a single worker process
+
+    The worker is started lazily, and generation falls back to this process
+    if it cannot be started or dies. It builds one level at a time, so
+    starting another cancels the one it is building, through a flag in
+    shared memory that the worker's Deadline polls.
+    """
+    def __init__(self) -> None:
+        self.executor: Optional[concurrent.futures.Executor] = None
+        self.broken = False
+        self.pending: Dict[LayoutKey,
+                           'concurrent.futures.Future[LevelLayout]'] = {}
+        self.memory: Optional[shared_memory.SharedMemory] = None
+        self.cancel: Optional[wfc.SharedArray] = None
+        # Ticket of the worker's current job
+        self.ticket = 0
+
+    def _pool(self) -> Optional[concurrent.futures.Executor]:
+        if self.executor is None and not self.broken:
+            sources: Dict[str, LayoutSource] = {}
+            for name, value in assets.residuals['worldgen'].items():
+                gen = world_gen.world_generators[name]
+                sources[name] = (value, gen.tile_properties.passable)
+            try:
+                if self.memory is None:
+                    self.memory, self.cancel = wfc.share_array(
+                        np.full(1, self.ticket, dtype=np.int64))
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    1,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_worker,
+                    initargs=(sources,))
+            except (OSError, NotImplementedError) as err:
+                logging.warning(f'Generating levels in process: {err}')
+                self.broken = True
+        return self.executor
+
+    def _cancel_job(self) -> None:
+        """Stops the worker's current job, if it is still running"""
+        self.ticket += 1
+        if self.cancel is not None:
+            wfc.attach_array(self.cancel)[0] = self.ticket
+
+    def _submit(self,
+                gen: 'WorldGenerator',
+                size: Pos,
+                key_item: Optional[str],
+                key_count: int,
+                seed: int,
+                deadline: Optional[utils.Deadline])\
+            -> Optional['concurrent.futures.Future[LevelLayout]']:
+        pool = self._pool() if gen.name else None
+        if pool is None:
+            return None
+        # Rather than have this wait for a level nobody is waiting on
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        self._cancel_job()
+        try:
+            return pool.submit(_generate_layout,
+                               gen.name,
+                               size,
+                               key_item,
+                               key_count,
+                               seed,
+                               None if deadline is None
+                                   else deadline.remaining(),
+                               self.cancel,
+                               self.ticket)
+        except concurrent.futures.BrokenExecutor as err:
+            logging.warning(f'Level generation worker died: {err}')
+            self.broken = True
+            self.executor = None
+            return None
+
+    def prefetch(self,
+                 gen: 'WorldGenerator',
+                 size: Pos,
+                 seed: int,
+                 deadline: Optional[utils.Deadline]=None) -> None:
+        """Starts building a level in the background, forgetting any other
+        level that was being prefetched
+        deadline: when the level should switch to its fallback walls
+        """
+        key = (gen.name, size)
+        if key in self.pending:
+            return
+        key_item, key_count = gen.choose_exit(seed)
+        future = self._submit(gen, size, key_item, key_count, seed, deadline)
+        if future is not None:
+            logging.debug(f'Prefetching {gen.name} at {size[0]}x{size[1]}')
+            self.pending[key] = future
+
+    def layout(self,
+               gen: 'WorldGenerator',
+               size: Pos,
+               seed: Optional[int]=None,
+               deadline: Optional[utils.Deadline]=None) -> 'LevelLayout':
+        """Gets a level layout, preferring a prefetched one as long as the
+        exit it was built for could still be chosen
+        seed: only use a prefetched layout with this seed, if given
+        deadline: how long to wait for the worker, after which the level is
+            built here with the fallback walls
+        A level that fails in the worker is built here instead
+        """
+        timeout = None if deadline is None else deadline.remaining()
+        future = self.pending.pop((gen.name, size), None)
+        if future is not None:
+            try:
+                layout = future.result(timeout)
+            except concurrent.futures.TimeoutError:
+                logging.debug('Prefetched level is taking too long')
+                self._cancel_job()
+            except (concurrent.futures.CancelledError,
+                    utils.DeadlineExceeded):
+                pass
+            except concurrent.futures.BrokenExecutor as err:
+                logging.warning(f'Level generation worker died: {err}')
+                self.broken = True
+                self.executor = None
+            except Exception as err:
+                logging.warning(f'Prefetching a level failed: {err!r}')
+            else:
+                if seed is not None and layout.seed != seed:
+                    logging.debug('Prefetched level has another seed')
+                elif gen.exit_allowed(layout.key_item, layout.key_count):
+                    return layout
+                else:
+                    logging.debug('Prefetched level has a stale exit')
+        seed = world_gen.level_seed(seed)
+        key_item, key_count = gen.choose_exit(seed)
+        future = None
+        if deadline is None or not deadline.expired():
+            future = self._submit(gen, size, key_item, key_count, seed,
+                                  deadline)
+        if future is not None:
+            try:
+                return future.result(None if deadline is None
+                                     else deadline.remaining())
+            except concurrent.futures.TimeoutError:
+                # The worker is busy, or didn't fall back in time
+                logging.debug('Level generation worker is taking too long')
+                future.cancel()
+                self._cancel_job()
+            except concurrent.futures.BrokenExecutor as err:
+                logging.warning(f'Level generation worker died: {err}')
+                self.broken = True
+                self.executor = None
+            except Exception as err:
+                logging.warning('Building a level in the worker failed, '
+                                f'building it here: {err!r}')
+        return gen.layout_generator().generate_layout(size,
+                                                      key_item,
+                                                      key_count,
+                                                      seed,
+                                                      deadline)
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self._cancel_job()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        self.pending.clear()
+        if self.memory is not None:
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
+            self.cancel = None
+
+service = GenerationService()
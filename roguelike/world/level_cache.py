@@ -0,0 +1,142 @@
+"""Keeps the layouts of seeded levels on disk, so that a level that was
+generated before can be loaded instead of generated again
+"""
+import hashlib
+import logging
+import os
+import zipfile
+from typing import (
+    List,
+    Optional,
+    Tuple,
+    TYPE_CHECKING
+)
+
+import numpy as np
+import numpy.typing as npt
+
+from roguelike.engine import assets
+from roguelike.world import world_gen
+
+if TYPE_CHECKING:
+    from roguelike.world.world_gen import LevelLayout
+
+Pos = Tuple[int, int]
+
+LEVEL_CACHE_DIR = 'level_cache' # Under the save directory
+LEVEL_CACHE_BYTES = 16 * 2**20
+# Bump when generation changes, so that stale levels are never loaded
+LEVEL_CACHE_VERSION = 4
+
+def level_key(name: str,
+              size: Pos,
+              difficulty: int,
+              seed: int,
+              config: str) -> str:
+    """Name of the cached level generated from these
+    config: hash of the generator's settings
+    """
+    digest = hashlib.sha1(repr((LEVEL_CACHE_VERSION,
+                                name,
+                                tuple(size),
+                                difficulty,
+                                seed,
+                                config)).encode())
+    return digest.hexdigest()
+
+def _positions(positions: List[Pos]) -> npt.NDArray[np.int32]:
+    return np.array(positions, dtype=np.int32).reshape(-1, 2)
+
+def _unpositions(array: npt.NDArray[np.int32]) -> List[Pos]:
+    return [(int(x), int(y)) for x, y in array.tolist()]
+
+def _pos(array: npt.NDArray[np.int32]) -> Pos:
+    x, y = array.tolist()
+    return int(x), int(y)
+
+class LevelCache:
+    """Level layouts stored as .npz files in a directory
+    The least recently used files are deleted once they take up more than
+    max_bytes. Loading a file touches it, so modification times double as
+    the usage order.
+    """
+    def __init__(self, cache_dir: str, max_bytes: int=LEVEL_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.npz')
+
+    def load(self, key: str) -> Optional['LevelLayout']:
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as cached:
+                key_item = str(cached['key_item'])
+                layout = world_gen.LevelLayout(
+                    int(cached['seed']),
+                    _pos(cached['size']),
+                    cached['tiles'],
+                    _pos(cached['player_pos']),
+                    key_item if cached['has_key'] else None,
+                    int(cached['key_count']),
+                    _unpositions(cached['key_positions']),
+                    _pos(cached['exit_pos']),
+                    _pos(cached['next_size']),
+                    _pos(cached['dummy_pos']),
+                    _unpositions(cached['boring_positions']))
+            os.utime(path)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            logging.warning(f'Discarding unreadable level cache {path}')
+            return None
+        logging.debug(f'Loaded level from {path}')
+        return layout
+
+    def store(self, key: str, layout: 'LevelLayout') -> None:
+        path = self.path(key)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = f'{path}.{os.getpid()}.tmp'
+            with open(temp_path, 'wb') as file:
+                np.savez_compressed(
+                    file,
+                    seed=np.uint64(layout.seed),
+                    size=np.array(layout.size, dtype=np.int32),
+                    tiles=layout.tiles.astype(np.int32),
+                    player_pos=np.array(layout.player_pos, dtype=np.int32),
+                    has_key=layout.key_item is not None,
+                    key_item=np.str_(layout.key_item or ''),
+                    key_count=layout.key_count,
+                    key_positions=_positions(layout.key_positions),
+                    exit_pos=np.array(layout.exit_pos, dtype=np.int32),
+                    next_size=np.array(layout.next_size, dtype=np.int32),
+                    dummy_pos=np.array(layout.dummy_pos, dtype=np.int32),
+                    boring_positions=_positions(layout.boring_positions))
+            os.replace(temp_path, path)
+        except OSError:
+            logging.warning(f'Could not write level cache {path}')
+            return
+        self.evict()
+
+    def evict(self) -> None:
+        """Deletes the least recently used levels until the rest fit"""
+        try:
+            entries: List[Tuple[float, int, str]] = []
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith('.npz'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError:
+            return
+        total = sum(size for _, size, __ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+cache = LevelCache(assets.save_path(savefile=LEVEL_CACHE_DIR))
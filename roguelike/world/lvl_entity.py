@@ -98,8 +98,9 @@ def warp(state: dungeon.DungeonMapState,
             max(assets.persists['highests'].get(world_type_name, 0),\
                 assets.variables['difficulty'])
         saving.save_game(world_type_name, _state.dungeon_map.player)
+        deadline = world_type.deadline()
         def _thrd():
-            _state.generate_from(world_type, size)
+            _state.generate_from(world_type, size, deadline=deadline)
         thread = threading.Thread(target = _thrd)
         thread.start()
         anim = tween.Animation([
@@ -109,6 +110,8 @@ def warp(state: dungeon.DungeonMapState,
         _state.begin_animation(anim)
         _state.lock()
         while thread.is_alive():
+            if not assets.running:
+                deadline.cancel()
             yield True
         _state.unlock()
         _state.enter_loaded_room()
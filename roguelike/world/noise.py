@@ -1,4 +1,5 @@
 from typing import (
+    Optional,
     Sequence,
     Tuple
 )
@@ -11,10 +12,13 @@ IArray = npt.NDArray[np.int32]
 
 def white(size: Pos,
           tiles: Sequence[int],
-          weights: Sequence[float]) -> IArray:
+          weights: Sequence[float],
+          rng: Optional[np.random.Generator]=None) -> IArray:
     weights_arr = np.asanyarray(weights, dtype=float)
     weights_arr /= weights_arr.sum()
-    return np.random.choice(tiles, size=size[::-1], p=weights_arr)
+    return np.random.default_rng(rng).choice(tiles,
+                                             size=size[::-1],
+                                             p=weights_arr)
 
 def _perlin_gradient(x: float, y: float) -> float:
     x0, y0 = int(x), int(y)
@@ -9,6 +9,7 @@ def save_game(world_type_name: str, player: 'PlayerEntity') -> None:
     current_save: Dict[str, Any] =\
         assets.persists['current'].setdefault(world_type_name, {})
     current_save['difficulty'] = assets.variables['difficulty']
+    current_save['seed'] = assets.variables['seed']
     current_save['hp'] = player.hp
     current_save['mp'] = player.mp
     inv_dict: Dict['BaseItem', int] = {}
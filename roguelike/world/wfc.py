@@ -5,14 +5,27 @@ Wave function collapse utilities
 from collections import (
     deque
 )
-from dataclasses import dataclass
+from concurrent import futures
+from dataclasses import (
+    dataclass,
+    field
+)
+import hashlib
+import heapq
 import logging
 import math
-import random
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import sys
 import time
+import weakref
+import zipfile
 from typing import (
+    cast,
     Any,
     Collection,
+    Deque,
     Dict,
     Generator,
     List,
@@ -38,6 +51,11 @@ OffsetRule = Sequence[TileState]
 History = Tuple[int, TileState, bool] # Position and previous valid states
 Pattern = npt.NDArray[np.int32]
 PKey = bytes
+Wave = npt.NDArray[np.bool_] # Cells x patterns
+Bitmask = npt.NDArray[np.uint64] # Packed along the last axis
+
+class CollapseError(Exception):
+    """Raised when a wave can't be collapsed within the solver's budget"""
 
 def pattern_at(size: Pos,
                data: Pattern,
@@ -119,11 +137,65 @@ def rotated(size: Pos, data: npt.NDArray[np.int32], num_rotations: int) ->\
         ctr += 1
 
 def valid_overlap(left: Pattern, right: Pattern, offset: Pos) -> bool:
-    """TODO test if two patterns can have an adjacency at a given offset
-    Note that as adjacencies are symmetric, I can cut the calls to this
-    function in half
+    """Test if right can be placed at offset from left, i.e. if the two
+    patterns agree wherever they overlap
+    Note that as adjacencies are symmetric, right at offset from left is
+    valid iff left at the reverse offset from right is
+    """
+    pattern_size = cast(Pos, left.shape[::-1])
+    invoff = (-offset[0], -offset[1])
+    return np.array_equal(offset_pattern(left, pattern_size, offset),
+                          offset_pattern(right, pattern_size, invoff))
+
+def pattern_windows(array: npt.NDArray[np.int32],
+                    pattern_size: Pos,
+                    cyclic: bool) -> npt.NDArray[np.int32]:
+    """Strided view of the pattern at each position of a 2D array, indexed
+    by [y, x] of the position and then [y, x] within the pattern
     """
-    pass
+    if cyclic:
+        array = np.pad(array,
+                       ((0, pattern_size[1] - 1), (0, pattern_size[0] - 1)),
+                       mode='wrap')
+    return np.lib.stride_tricks.sliding_window_view(array,
+                                                    pattern_size[::-1])
+
+def overlap_segments(patterns: npt.NDArray[np.int32],
+                     pattern_size: Pos,
+                     offset: Pos) -> npt.NDArray[np.int32]:
+    """The part of each pattern in a stack that would overlap with another
+    pattern at offset, flattened to one row per pattern
+    """
+    segments = offset_pattern(patterns.transpose((1, 2, 0)),
+                              pattern_size,
+                              offset)
+    return segments.transpose((2, 0, 1)).reshape((len(patterns), -1))
+
+def unique_rows(rows: npt.NDArray[np.int32]) -> Tuple[
+        npt.NDArray[np.int32],
+        npt.NDArray[np.int64],
+        npt.NDArray[np.int64],
+        npt.NDArray[np.int64]]:
+    """Same as np.unique(rows, axis=0) with the index, inverse and counts
+    Rows of small enough values are packed into a single integer first,
+    which is much faster to sort than whole rows
+    """
+    low = rows.min(initial=0)
+    base = int(rows.max(initial=0)) - int(low) + 1
+    if rows.shape[1] * math.log2(max(base, 2)) < 63:
+        places = base ** np.arange(rows.shape[1] - 1, -1, -1, dtype=np.int64)
+        keys = (rows - low).astype(np.int64) @ places
+        _, firsts, inverse, counts = np.unique(keys,
+                                               return_index=True,
+                                               return_inverse=True,
+                                               return_counts=True)
+        return rows[firsts], firsts, inverse.reshape(-1), counts
+    uniques, firsts, inverse, counts = np.unique(rows,
+                                                 axis=0,
+                                                 return_index=True,
+                                                 return_inverse=True,
+                                                 return_counts=True)
+    return uniques, firsts, inverse.reshape(-1), counts
 
 def find_adjacencies(size: Pos,
                      data: npt.NDArray[np.int32],
@@ -135,96 +207,178 @@ def find_adjacencies(size: Pos,
                                                       List[List[TileState]],
                                                       npt.NDArray[np.int32]]:
     """Break apart provided data into patterns of a specified size
-    Performs no rotations/reflections
+    Patterns are taken from the data and num_rotations alternating
+    reflections and rotations of it, and numbered in order of appearance
+    Two patterns are adjacent at an offset iff they have a valid overlap
     Returns (Pattern to ID map,
              ID to Pattern map,
              Pattern ID list,
              Adjacency rule list,
              Count of each pattern)
-    
-    TODO this function is not working how I really want it to
-    I need to check valid overlaps instead of just positioning of patterns
-    Like this, many valid adjacencies are never registered
-    Still not sure about rotations though. I'll work on it after
-    Would probably reduce backtracking, dunno how speed would change
     """
-    # Initialize some vars
-    pattern_ids: Dict[PKey, int] = {}
-    patterns: List[Pattern] = []
-    ids_at: List[int] = []
     array = np.asanyarray(data, dtype=int).reshape(size[::-1])
-    counts_list: List[int] = []
-    
-    # Determine all offsets used
-    offsets: List[Pos] = gen_offsets(pattern_size)
+    pattern_w, pattern_h = pattern_size
     
-    intersections: List[Dict[PKey, Set[int]]] = [{} for _ in offsets]
-    
-    # Empty adjacencies list
-    adjacencies: List[List[Set[int]]] =\
-        [[] for _ in offsets]
-    
-    # Rotations
+    # Every pattern of every rotation, one row each
+    windows = []
     rot_gen = rotated(size, array, num_rotations)
-    
     for rot_i in range(num_rotations + 1):
-        # Get rotated params
-        size, array = next(rot_gen)
-        # Cache and ID all patterns
-        end_x = size[0] - (0 if cyclic else pattern_size[0] - 1)
-        end_y = size[1] - (0 if cyclic else pattern_size[1] - 1)
-        for y in range(end_y):
-            for x in range(end_x):
-                pattern = pattern_at(size, array, pattern_size, (x, y))
-                pattern_key = pattern.tobytes()
-                if pattern_key not in pattern_ids:
-                    patterns.append(pattern)
-                    pattern_num = pattern_ids[pattern_key] = len(pattern_ids)
-                    ids_at.append(pattern_num)
-                    counts_list.append(1)
-                    for adj_off in adjacencies:
-                        adj_off.append(set())
-                    for i, offset in enumerate(offsets):
-                        invoff = (-offset[0], -offset[1])
-                        segment = offset_pattern(pattern, pattern_size, invoff)
-                        segkey = segment.tobytes()
-                        intersections[i]\
-                            .setdefault(segkey, set())\
-                            .add(pattern_num)
-                else:
-                    pattern_num = pattern_ids[pattern_key]
-                    ids_at.append(pattern_num)
-                    counts_list[pattern_num] += 1
-        
-    # Identify adjacencies
-    for pattern_i, pattern in enumerate(patterns):
-        for offset_i, offset in enumerate(offsets):
-            adjs = adjacencies[offset_i][pattern_i]
-            segment = offset_pattern(pattern, pattern_size, offset)
-            segkey = segment.tobytes()
-            adjs.update(intersections[offset_i][segkey])
-        # for y0 in range(end_y):
-            # for x0 in range(end_x):
-                # xy = y0 * end_x + x0
-                # pattern_id = ids_at[xy]
-                # for offset_i, offset in enumerate(offsets):
-                    # x = x0 + offset[0]
-                    # y = y0 + offset[1]
-                    # if cyclic:
-                        # x %= size[0]
-                        # y %= size[1]
-                    # else:
-                        # if x < 0 or x >= end_x or y < 0 or y >= end_y:
-                            # continue # Next offset
-                    # xy = y * end_x + x
-                    # adj_pattern_id = ids_at[xy]
-                    # adjacencies[offset_i][pattern_id].add(adj_pattern_id)
+        _, rot_array = next(rot_gen)
+        windows.append(pattern_windows(rot_array, pattern_size, cyclic)
+                       .reshape((-1, pattern_w * pattern_h)))
+    all_windows = np.concatenate(windows)
+    
+    # Dedup, but keep IDs in order of first appearance
+    uniques, firsts, inverse, counts = unique_rows(all_windows)
+    order = np.argsort(firsts)
+    ranks = np.empty_like(order)
+    ranks[order] = np.arange(len(order))
+    pattern_arr = uniques[order].reshape((-1, pattern_h, pattern_w))
+    patterns: List[Pattern] = list(pattern_arr)
+    pattern_ids: Dict[PKey, int] =\
+        {pattern.tobytes(): i for i, pattern in enumerate(patterns)}
+    ids_at: List[int] = ranks[inverse].tolist()
+    
+    # Identify adjacencies by matching the overlapping segments of each
+    # pattern against the reverse segments of all others
+    adjacencies: List[List[Set[int]]] = []
+    for offset in gen_offsets(pattern_size):
+        invoff = (-offset[0], -offset[1])
+        segments = np.concatenate((
+            overlap_segments(pattern_arr, pattern_size, offset),
+            overlap_segments(pattern_arr, pattern_size, invoff)))
+        _, __, segment_ids, ___ = unique_rows(segments)
+        left_ids = segment_ids[:len(patterns)]
+        right_ids = segment_ids[len(patterns):]
+        by_segment: Dict[int, List[int]] = {}
+        for pattern_i, segment_id in enumerate(right_ids.tolist()):
+            by_segment.setdefault(segment_id, []).append(pattern_i)
+        adjacencies.append([set(by_segment.get(segment_id, ()))
+                            for segment_id in left_ids.tolist()])
     
     return (pattern_ids,
             patterns,
             ids_at,
             adjacencies,
-            np.array(counts_list, dtype=np.int32))
+            counts[order].astype(np.int32))
+
+def pack_states(states: Wave) -> Bitmask:
+    """Packs the last axis of a boolean array into 64-bit words"""
+    num_states = states.shape[-1]
+    num_words = (num_states + 63) // 64
+    padded = np.zeros(states.shape[:-1] + (num_words * 64,), dtype=np.bool_)
+    padded[..., :num_states] = states
+    return np.packbits(padded, axis=-1, bitorder='little').view(np.uint64)
+
+def unpack_states(bits: Bitmask, num_states: int) -> Wave:
+    """Reverses pack_states"""
+    unpacked = np.unpackbits(bits.view(np.uint8), axis=-1, bitorder='little')
+    return unpacked[..., :num_states].astype(np.bool_)
+
+# Number of set bits in each possible byte
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.int32)
+
+def neighbor_table(size: Pos, offsets: Sequence[Pos]) -> npt.NDArray[np.int32]:
+    """Returns the flat index of each cell's neighbor at each offset, or -1
+    where that neighbor would be out of bounds
+    """
+    ys, xs = np.divmod(np.arange(size[0] * size[1]), size[0])
+    table = np.full((size[0] * size[1], len(offsets)), -1, dtype=np.int32)
+    for offset_i, (dx, dy) in enumerate(offsets):
+        x, y = xs + dx, ys + dy
+        in_bounds = (x >= 0) & (y >= 0) & (x < size[0]) & (y < size[1])
+        table[in_bounds, offset_i] = (y * size[0] + x)[in_bounds]
+    return table
+
+def opposite_offsets(offsets: Sequence[Pos]) -> List[int]:
+    """Returns the index of the reverse of each offset"""
+    return [list(offsets).index((-dx, -dy)) for dx, dy in offsets]
+
+def adjacency_table(allowed_adjacencies: Sequence[TileRule],
+                    num_patterns: int) -> npt.NDArray[np.bool_]:
+    """Converts adjacency rules to a boolean table where [offset, i, j] is
+    True iff pattern j may be at that offset from pattern i
+    """
+    table = np.zeros((len(allowed_adjacencies), num_patterns, num_patterns),
+                     dtype=np.bool_)
+    for offset_i, offset_rules in enumerate(allowed_adjacencies):
+        for pattern_i, adjs in enumerate(offset_rules):
+            table[offset_i, pattern_i, list(adjs)] = True
+    return table
+
+def adjacency_masks(allowed_adjacencies: Sequence[TileRule],
+                    num_patterns: int) -> Bitmask:
+    """Converts adjacency rules to a packed table indexed by
+    [offset, pattern] whose bits are the patterns allowed at that offset
+    """
+    return pack_states(adjacency_table(allowed_adjacencies, num_patterns))
+
+# Bump whenever find_adjacencies changes what it produces
+ANALYSIS_VERSION = 1
+
+def analysis_key(size: Pos,
+                 data: npt.NDArray[np.int32],
+                 pattern_size: Pos,
+                 cyclic: bool,
+                 num_rotations: int) -> str:
+    """Digest identifying the result of a find_adjacencies call"""
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(data, dtype=np.int32).tobytes())
+    digest.update(repr((ANALYSIS_VERSION,
+                        tuple(size),
+                        tuple(pattern_size),
+                        bool(cyclic),
+                        num_rotations)).encode())
+    return digest.hexdigest()
+
+def cached_adjacencies(size: Pos,
+                       data: npt.NDArray[np.int32],
+                       pattern_size: Pos,
+                       cyclic: bool = False,
+                       num_rotations: int = 7,
+                       cache_dir: Optional[str] = None)\
+                        -> Tuple[List[Pattern],
+                                 List[List[TileState]],
+                                 npt.NDArray[np.int32]]:
+    """Same as find_adjacencies, but only returns the patterns, adjacency
+    rules and weights, and stores them in cache_dir so that later calls
+    with the same arguments can skip the analysis
+    """
+    if cache_dir is None:
+        _, patterns, __, adjacencies, weights = find_adjacencies(
+            size, data, pattern_size, cyclic, num_rotations)
+        return patterns, adjacencies, weights
+    key = analysis_key(size, data, pattern_size, cyclic, num_rotations)
+    path = os.path.join(cache_dir, f'{key}.npz')
+    if os.path.exists(path):
+        try:
+            with np.load(path) as cached:
+                patterns_arr = cached['patterns']
+                masks = cached['adjacencies']
+                weights = cached['weights']
+            num_patterns = len(patterns_arr)
+            table = unpack_states(masks, num_patterns)
+            adjacencies = [[set(np.flatnonzero(row).tolist())
+                            for row in offset_table]
+                           for offset_table in table]
+            logging.debug(f'Loaded WFC analysis from {path}')
+            return list(patterns_arr), adjacencies, weights
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            logging.warning(f'Discarding unreadable WFC cache {path}')
+    _, patterns, __, adjacencies, weights = find_adjacencies(
+        size, data, pattern_size, cyclic, num_rotations)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as file:
+            np.savez(file,
+                     patterns=np.array(patterns, dtype=np.int32),
+                     adjacencies=adjacency_masks(adjacencies, len(patterns)),
+                     weights=np.asanyarray(weights, dtype=np.int32))
+        os.replace(temp_path, path)
+    except OSError:
+        logging.warning(f'Could not write WFC cache {path}')
+    return patterns, adjacencies, weights
 
 def patterns_containing(tiles: Collection[int],
                         patterns: List[Pattern]) -> TileState:
@@ -234,101 +388,411 @@ def patterns_containing(tiles: Collection[int],
     return set(filter(lambda i: patterns[i][0, 0] in tiles,
                       range(len(patterns))))
 
-@numba.njit(numba.int32[:](numba.int32[:],
-                           numba.types.ListType(
-                               numba.types.ListType(numba.int32)),
-                           numba.types.ListType(
-                               numba.types.ListType(numba.int32)),
-                           numba.int32[:],
-                           numba.int32[:, :],
-                           numba.int32[:]), debug=True)
-def _fast_wfc_tile(pat_size, adj_list_lst, states_lst, size, offsets, weights):
-    """Probably won't even use this because it appears to be slower somehow"""
-    history = [(numba.int32(0),
-               {numba.int32(0)},
-               numba.bool_(False)) for _ in range(0)]
-    num_offsets = offsets.shape[0]
-    states = [{numba.int32(0)} for _ in range(0)]
-    for lst in states_lst:
-        states.append(set(lst))
-    adj_list = [{numba.int32(0)} for _ in range(0)]
-    for lst in adj_list_lst:
-        adj_list.append(set(lst))
-        
-    while True:
-        min_ent = math.inf
-        min_pos = [0 for _ in range(0)]
-        for xy, state in enumerate(states):
-            num_pos = len(state)
-            if num_pos == 1:
+# Compiled kernels are cached next to the source, which frozen builds don't
+# ship, so they are recompiled on every run there instead
+_JIT_CACHE = not getattr(sys, 'frozen', False)
+
+# Results of _wfc_kernel
+JIT_COLLAPSED = 0
+JIT_OVER_BUDGET = 1
+JIT_IMPOSSIBLE = 2
+JIT_CANCELLED = 3
+
+# Cancellation flag for kernels that can't be cancelled
+_NEVER_CANCEL = np.zeros(1, dtype=np.int64)
+
+@numba.njit(cache=_JIT_CACHE)
+def _jit_bit_index(bit: int) -> int:
+    """Index of the only bit set in a word"""
+    index = 0
+    if bit >> np.uint64(32):
+        index += 32
+        bit >>= np.uint64(32)
+    if bit >> np.uint64(16):
+        index += 16
+        bit >>= np.uint64(16)
+    if bit >> np.uint64(8):
+        index += 8
+        bit >>= np.uint64(8)
+    if bit >> np.uint64(4):
+        index += 4
+        bit >>= np.uint64(4)
+    if bit >> np.uint64(2):
+        index += 2
+        bit >>= np.uint64(2)
+    if bit >> np.uint64(1):
+        index += 1
+    return index
+
+@numba.njit(cache=_JIT_CACHE)
+def _jit_cell_stats(row: Bitmask,
+                    weights: npt.NDArray[np.float64],
+                    log_weights: npt.NDArray[np.float64])\
+                        -> Tuple[int, float, float]:
+    """Number of patterns set in a packed row, the sum of their weights and
+    the sum of weight * log(weight)
+    """
+    count = 0
+    sum_w = 0.0
+    sum_wlogw = 0.0
+    for word_i in range(row.shape[0]):
+        word = row[word_i]
+        while word != 0:
+            low = word & (~word + np.uint64(1))
+            word ^= low
+            pattern = word_i * 64 + _jit_bit_index(low)
+            count += 1
+            sum_w += weights[pattern]
+            sum_wlogw += log_weights[pattern]
+    return count, sum_w, sum_wlogw
+
+@numba.njit(cache=_JIT_CACHE)
+def _jit_propagate(wave: Bitmask,
+                   masks: Bitmask,
+                   neighbors: npt.NDArray[np.int32],
+                   cells: npt.NDArray[np.int64]) -> bool:
+    """Propagates the constraints of the given cells through a packed wave
+    in place, returns False if a contradiction was reached
+    """
+    num_words = wave.shape[1]
+    num_offsets = neighbors.shape[1]
+    one = np.uint64(1)
+    valid = np.empty(num_words, dtype=np.uint64)
+    stack = list(cells)
+    while len(stack) > 0:
+        head = stack.pop()
+        for delta_i in range(num_offsets):
+            n_xy = np.int64(neighbors[head, delta_i])
+            if n_xy < 0:
                 continue
-            elif num_pos == 0:
-                resolved = False
-                while len(history) > 0:
-                    pos, state, choice = history.pop()
-                    if choice:
-                        valid = state.difference(states[pos])
-                        if len(valid) == 0:
-                            continue # Keep backtracking to last choice
-                        states[pos] = valid
-                        state = valid
-                        resolved = True
+            valid[:] = 0
+            changed = True
+            for word_i in range(num_words):
+                word = wave[head, word_i]
+                while word != 0 and changed:
+                    low = word & (~word + one)
+                    word ^= low
+                    pattern = word_i * 64 + _jit_bit_index(low)
+                    changed = False
+                    for other_i in range(num_words):
+                        valid[other_i] |= masks[delta_i, pattern, other_i]
+                        if wave[n_xy, other_i] & ~valid[other_i]:
+                            changed = True
+                if not changed:
+                    break
+            if not changed:
+                continue
+            wave[n_xy] &= valid
+            if not wave[n_xy].any():
+                return False
+            stack.append(n_xy)
+    return True
+
+# Releases the GIL, so that a timer can cancel it from another thread
+@numba.njit(cache=_JIT_CACHE, nogil=True)
+def _wfc_kernel(wave: Bitmask,
+                masks: Bitmask,
+                neighbors: npt.NDArray[np.int32],
+                weights: npt.NDArray[np.float64],
+                seed: int,
+                max_contradictions: int,
+                cancel: npt.NDArray[np.int64],
+                ticket: int,
+                propagated: bool,
+                counters: npt.NDArray[np.int64]) -> int:
+    """Collapses a packed wave in place, the same way as the bitset engine
+    with history backtracking
+    wave: (cells, words) packed states of each cell
+    masks: (offsets, patterns, words) packed patterns allowed at each offset
+    neighbors: (cells, offsets) neighbor of each cell, -1 if out of bounds
+    weights: weight of each pattern
+    max_contradictions: contradictions before giving up, -1 for no limit
+    cancel: checked before each collapse, gives up once cancel[0] != ticket
+    propagated: whether the constraints of the wave are already propagated
+    counters: counters[0] is incremented for each contradiction
+    Returns JIT_COLLAPSED, JIT_OVER_BUDGET, JIT_IMPOSSIBLE or JIT_CANCELLED
+    """
+    np.random.seed(seed)
+    num_cells, num_words = wave.shape
+    num_offsets = neighbors.shape[1]
+    num_patterns = weights.shape[0]
+    one = np.uint64(1)
+    log_weights = weights * np.log(weights)
+    counts = np.zeros(num_cells, dtype=np.int64)
+    sums_w = np.zeros(num_cells)
+    sums_wlogw = np.zeros(num_cells)
+    versions = np.zeros(num_cells, dtype=np.int64)
+    noise = np.random.random(num_cells) * 1e-6
+    heap = [(0.0, 0, 0) for _ in range(0)]
+    
+    # Position, previous states and whether it was a choice
+    trail_cells = np.empty(1024, dtype=np.int64)
+    trail_states = np.empty((1024, num_words), dtype=np.uint64)
+    trail_choices = np.empty(1024, dtype=np.bool_)
+    trail_len = 0
+    
+    stack = [0 for _ in range(0)]
+    for xy in range(num_cells):
+        count, sum_w, sum_wlogw = _jit_cell_stats(wave[xy],
+                                                  weights,
+                                                  log_weights)
+        counts[xy] = count
+        sums_w[xy] = sum_w
+        sums_wlogw[xy] = sum_wlogw
+        if count == 0:
+            return JIT_IMPOSSIBLE
+        if count < num_patterns and not propagated:
+            stack.append(xy)
+        if count > 1:
+            heapq.heappush(heap, (math.log(sum_w) - sum_wlogw / sum_w
+                                  + noise[xy], 0, xy))
+    
+    valid = np.empty(num_words, dtype=np.uint64)
+    contradictions = 0
+    recording = False # The input constraints can't be backtracked
+    while True:
+        # Propagate
+        consistent = True
+        while len(stack) > 0 and consistent:
+            head = stack.pop()
+            for delta_i in range(num_offsets):
+                n_xy = np.int64(neighbors[head, delta_i])
+                if n_xy < 0:
+                    continue
+                # Union of the patterns allowed by each pattern of the
+                # head, stopping as soon as it covers the neighbor
+                valid[:] = 0
+                changed = True
+                for word_i in range(num_words):
+                    word = wave[head, word_i]
+                    while word != 0 and changed:
+                        low = word & (~word + one)
+                        word ^= low
+                        pattern = word_i * 64 + _jit_bit_index(low)
+                        changed = False
+                        for other_i in range(num_words):
+                            valid[other_i] |= masks[delta_i, pattern, other_i]
+                            if wave[n_xy, other_i] & ~valid[other_i]:
+                                changed = True
+                    if not changed:
                         break
+                if not changed:
+                    continue
+                if recording:
+                    if trail_len == trail_cells.shape[0]:
+                        trail_cells = np.concatenate((trail_cells,
+                                                      trail_cells))
+                        trail_states = np.concatenate((trail_states,
+                                                       trail_states))
+                        trail_choices = np.concatenate((trail_choices,
+                                                        trail_choices))
+                    trail_cells[trail_len] = n_xy
+                    trail_states[trail_len] = wave[n_xy]
+                    trail_choices[trail_len] = False
+                    trail_len += 1
+                wave[n_xy] &= valid
+                count, sum_w, sum_wlogw = _jit_cell_stats(wave[n_xy],
+                                                          weights,
+                                                          log_weights)
+                counts[n_xy] = count
+                sums_w[n_xy] = sum_w
+                sums_wlogw[n_xy] = sum_wlogw
+                versions[n_xy] += 1
+                if count == 0:
+                    consistent = False
+                    break
+                if count > 1:
+                    heapq.heappush(heap, (math.log(sum_w) - sum_wlogw / sum_w
+                                          + noise[n_xy], versions[n_xy], n_xy))
+                stack.append(n_xy)
+        if not consistent:
+            if not recording:
+                return JIT_IMPOSSIBLE
+            contradictions += 1
+            counters[0] += 1
+            if max_contradictions >= 0 and contradictions > max_contradictions:
+                return JIT_OVER_BUDGET
+            stack.clear()
+            resolved = False
+            while trail_len > 0 and not resolved:
+                trail_len -= 1
+                pos = trail_cells[trail_len]
+                if trail_choices[trail_len]:
+                    # Try again without that choice, keeping the entry
+                    # so the ban is undone with the rest
+                    valid[:] = trail_states[trail_len] & ~wave[pos]
+                    if valid.any():
+                        trail_choices[trail_len] = False
+                        trail_len += 1
+                        wave[pos] = valid
+                        stack.append(pos)
+                        resolved = True
                     else:
-                        states[pos] = state
-                if not resolved:
-                    raise Exception("Could not collapse wave function")
-            if num_pos < min_ent:
-                min_ent = len(state)
-                min_pos = [xy]
-            elif num_pos == min_ent:
-                min_pos.append(xy)
-        if math.isinf(min_ent):
-            break
-        _i_xy = random.randint(0, len(min_pos) - 1)
-        xy = min_pos[_i_xy]
-        state = states[xy]
+                        wave[pos] = trail_states[trail_len]
+                else:
+                    wave[pos] = trail_states[trail_len]
+                count, sum_w, sum_wlogw = _jit_cell_stats(wave[pos],
+                                                          weights,
+                                                          log_weights)
+                counts[pos] = count
+                sums_w[pos] = sum_w
+                sums_wlogw[pos] = sum_wlogw
+                versions[pos] += 1
+                if count > 1:
+                    heapq.heappush(heap, (math.log(sum_w) - sum_wlogw / sum_w
+                                          + noise[pos], versions[pos], pos))
+            if not resolved:
+                return JIT_IMPOSSIBLE
+            continue
+        recording = True
+        if cancel[0] != ticket:
+            return JIT_CANCELLED
         
-        # Collapse it to a random state
-        history.append((xy, state, True))
-        # choose_from = np.array(list(state), dtype=np.int64)
-        # p = np.array([weights[i] for i in choose_from], dtype=np.int64)
-        # p = np.cumsum(p)
-        # index = np.random.randint(0, p.sum())
-        # choice = np.where(p > index, p, np.inf).argmin()
-        _i_xy = random.randint(0, len(state) - 1)
-        choice = list(state)[_i_xy]
-        states[xy] = set([choice])
+        # Find a minimum entropy position
+        xy = -1
+        while len(heap) > 0:
+            _, version, candidate = heapq.heappop(heap)
+            if version == versions[candidate] and counts[candidate] > 1:
+                xy = candidate
+                break
+        if xy < 0:
+            return JIT_COLLAPSED
         
-        # Propagate
-        frontier = [xy]
-        while len(frontier) > 0:
-            head = frontier.pop()
-            state = states[head]
-            for delta_i, delta in enumerate(offsets):
-                valid_states = set()
-                # This union of all the states is where most of the
-                # time is spent. I would like to JIT it but that
-                # poses plenty of problems on its own
-                for i in state:
-                    adj = adj_list[i * num_offsets + delta_i]
-                    valid_states.update(adj)
-                if len(valid_states) == 0:
-                    continue
-                oy, ox = divmod(head, size[0])
-                x, y = ox + delta[0],\
-                       oy + delta[1] # New XY position to check
-                if x < 0 or y < 0 or x >= size[0] or y >= size[1]:
-                    continue
-                n_xy = y * size[0] + x
-                other_state = states[n_xy]
-                intersect = other_state.intersection(valid_states)
-                if len(intersect) == len(other_state):
-                    continue
-                history.append((n_xy, other_state, False))
-                states[n_xy] = intersect
-                frontier.append(n_xy)
-    return np.array(list(map(lambda s: next(iter(s)), states)), dtype=np.int32)
+        # Collapse it to a random state
+        target = np.random.random() * sums_w[xy]
+        choice = -1
+        for word_i in range(num_words):
+            word = wave[xy, word_i]
+            while word != 0 and target >= 0:
+                low = word & (~word + one)
+                word ^= low
+                choice = word_i * 64 + _jit_bit_index(low)
+                target -= weights[choice]
+            if target < 0:
+                break
+        if trail_len == trail_cells.shape[0]:
+            trail_cells = np.concatenate((trail_cells, trail_cells))
+            trail_states = np.concatenate((trail_states, trail_states))
+            trail_choices = np.concatenate((trail_choices, trail_choices))
+        trail_cells[trail_len] = xy
+        trail_states[trail_len] = wave[xy]
+        trail_choices[trail_len] = True
+        trail_len += 1
+        wave[xy] = 0
+        wave[xy, choice // 64] = one << np.uint64(choice % 64)
+        counts[xy] = 1
+        sums_w[xy] = weights[choice]
+        sums_wlogw[xy] = log_weights[choice]
+        versions[xy] += 1
+        stack.append(xy)
+
+class EntropyQueue:
+    """Priority queue of undecided cells ordered by weighted Shannon entropy
+    The weight sums of each cell are cached and only updated for cells that
+    change, and stale heap entries are skipped as they are popped
+    wave: initial possible states of each cell
+    weights: weight of each pattern, or None to weigh them all equally
+    rng: generator for the noise that breaks ties
+    """
+    def __init__(self,
+                 wave: Wave,
+                 weights: Optional[npt.NDArray[np.int32]]=None,
+                 rng: Optional[np.random.Generator]=None):
+        num_cells, num_patterns = wave.shape
+        if weights is None:
+            weights = np.ones(num_patterns, dtype=float)
+        weights = np.asanyarray(weights, dtype=float)
+        # Weight, weight * log(weight), and 1 for each pattern
+        self.pattern_stats = np.stack((weights,
+                                       weights * np.log(weights),
+                                       np.ones(num_patterns)), axis=1)
+        # Same, but summed for each possible value of each byte of a
+        # packed row
+        num_bytes = (num_patterns + 63) // 64 * 8
+        bits = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis],
+                             axis=1, bitorder='little').astype(float)
+        padded = np.zeros((num_bytes * 8, 3), dtype=float)
+        padded[:num_patterns] = self.pattern_stats
+        self.byte_stats = np.einsum('vb,nbs->nvs',
+                                    bits,
+                                    padded.reshape((num_bytes, 8, 3)))
+        self.byte_index = np.arange(num_bytes)
+        # Sum of weights, sum of weight * log(weight), and count of states
+        # for each cell
+        self.stats = wave @ self.pattern_stats
+        self.counts = self.stats[:, 2]
+        self.versions = [0] * num_cells
+        # Breaks ties between equal entropies randomly
+        self.noise: List[float] =\
+            (np.random.default_rng(rng).random(num_cells) * 1e-6).tolist()
+        self.heap: List[Tuple[float, int, int]] = []
+        for xy, row in enumerate(self.stats.tolist()):
+            if row[2] > 1:
+                self.heap.append((self._entropy(xy, row), 0, xy))
+        heapq.heapify(self.heap)
+    
+    def _entropy(self, xy: int, row: List[float]) -> float:
+        total, log_total, _ = row
+        return math.log(total) - log_total / total + self.noise[xy]
+    
+    def entropy(self, xy: int) -> float:
+        return self._entropy(xy, self.stats[xy].tolist())
+    
+    def _push(self, cells: Sequence[int]) -> None:
+        for xy, row in zip(cells, self.stats[cells].tolist()):
+            version = self.versions[xy] + 1
+            self.versions[xy] = version
+            if row[2] > 1:
+                heapq.heappush(self.heap,
+                               (self._entropy(xy, row), version, xy))
+    
+    def remove(self, cells: Sequence[int], removed: Wave) -> None:
+        """Updates cells that lost the states in each row of removed"""
+        self.stats[cells] -= removed @ self.pattern_stats
+        self._push(cells)
+    
+    def remove_bits(self, cells: Sequence[int], removed: Bitmask) -> None:
+        """Same as remove, but with rows packed by pack_states"""
+        removed_bytes = removed.view(np.uint8)
+        self.stats[cells] -=\
+            self.byte_stats[self.byte_index, removed_bytes].sum(axis=1)
+        self._push(cells)
+    
+    def discard(self, xy: int, removed: Collection[int]) -> None:
+        """Updates a single cell that lost the states in removed"""
+        self.stats[xy] -= self.pattern_stats[list(removed)].sum(axis=0)
+        self._push([xy])
+    
+    def reset(self, xy: int, states: Wave) -> None:
+        """Recalculates a cell from scratch, e.g. after backtracking"""
+        self.stats[xy] = states @ self.pattern_stats
+        self._push([xy])
+    
+    def pop(self) -> Optional[int]:
+        """Returns the undecided cell with the lowest entropy, or None if
+        every cell is decided
+        """
+        while len(self.heap) > 0:
+            _, version, xy = heapq.heappop(self.heap)
+            if version == self.versions[xy] and self.counts[xy] > 1:
+                return xy
+        return None
+
+@dataclass
+class SolverBudget:
+    """Bounds on how long a WFC run may take
+    snapshot_interval: collapses between snapshots when backtracking with
+        snapshots
+    max_snapshots: most snapshots kept at once, the oldest are dropped
+    max_contradictions: contradictions before restarting, None for no limit
+    max_seconds: time before restarting, None for no limit
+    max_restarts: restarts before giving up
+    """
+    snapshot_interval: int = 8
+    max_snapshots: int = 16
+    max_contradictions: Optional[int] = None
+    max_seconds: Optional[float] = None
+    max_restarts: int = 4
 
 @dataclass
 class WaveFunction:
@@ -336,84 +800,141 @@ class WaveFunction:
     allowed_adjacencies: Sequence[TileRule]
     pattern_size: Pos
     weights: npt.NDArray[np.int32]
+    # Packed adjacency masks, built when first needed
+    _masks: Optional[Bitmask] = field(default=None, init=False, repr=False)
+    # Contradictions, restarts and chunk re-rolls of the last collapse
+    counts: Dict[str, int] = field(default_factory=dict, init=False,
+                                   repr=False)
+    
+    def _count(self, name: str, amount: int=1) -> None:
+        self.counts[name] = self.counts.get(name, 0) + amount
+    
+    def masks(self) -> Bitmask:
+        """Adjacency rules packed by adjacency_masks"""
+        if self._masks is None:
+            self._masks = adjacency_masks(self.allowed_adjacencies,
+                                          len(self.allowed_adjacencies[0]))
+        return self._masks
+    
+    def propagated_wave(self, size: Pos, input_states: WFMap) -> Bitmask:
+        """Packed wave of the given tile classes with their constraints
+        propagated, which can be passed to wfc_tile as the starting wave
+        """
+        num_patterns = len(self.allowed_adjacencies[0])
+        wave = pack_states(
+            self._class_masks()[np.asanyarray(input_states, dtype=int)])
+        constrained = unpack_states(wave, num_patterns).sum(axis=1)\
+            < num_patterns
+        if not _jit_propagate(wave,
+                              self.masks(),
+                              neighbor_table(size,
+                                             gen_offsets(self.pattern_size)),
+                              np.flatnonzero(constrained)):
+            raise CollapseError("Could not collapse wave function")
+        return wave
     
     def wfc_tile(self,
                  size: Pos,
                  input_states: WFMap,
                  use_jit: Optional[bool]=None,
-                 use_weights: bool=True) -> List[int]:
+                 use_weights: bool=True,
+                 engine: str='set',
+                 backtrack: str='history',
+                 budget: Optional[SolverBudget]=None,
+                 wave: Optional[Bitmask]=None,
+                 rng: Optional[np.random.Generator]=None,
+                 deadline: Optional[utils.Deadline]=None) -> List[int]:
+        """Collapses a wave of the given size
+        input_states: the tile class of each position
+        use_jit: True to use the jit engine in place of set or bitset
+        engine: 'set' propagates with Python sets, 'bitset' with packed
+            bitmask arrays, 'ac4' with per-direction support counts, 'jit'
+            with packed bitmask arrays in a compiled kernel
+        backtrack: 'history' undoes removals one at a time, 'snapshot'
+            restores periodic copies of the wave (bitset engine only)
+        budget: when to give up on an attempt and restart, only used by the
+            bitset, ac4 and jit engines
+        wave: result of propagated_wave for input_states to start from, only
+            used by the bitset and jit engines
+        rng: generator to make choices with, a fresh one by default
+        deadline: raises DeadlineExceeded once it expires or is cancelled,
+            unlike budget which restarts
+        """
         assert len(self.allowed_adjacencies) > 0
-        if use_jit is None:
-            use_jit = size[0] * size[1] >= 50 * 50
+        rng = np.random.default_rng(rng)
+        self.counts = {}
+        if engine not in ('set', 'bitset', 'ac4', 'jit'):
+            raise ValueError(f'{engine} is not a valid WFC engine')
+        if use_jit is not None and use_jit != (engine == 'jit'):
+            if engine == 'jit' or engine == 'ac4':
+                raise ValueError(f'use_jit={use_jit} conflicts with the '
+                                 f'{engine} engine')
+            logging.info(f'Using the jit engine instead of {engine}')
+            engine = 'jit'
+        if engine == 'jit':
+            if backtrack != 'history':
+                raise ValueError(f'{backtrack} backtracking is not supported '
+                                 'by the jit engine')
+            return self._jit_wfc_tile(size, input_states, use_weights, budget,
+                                      wave, True, rng, deadline)
+        if engine == 'bitset':
+            return self._bitset_wfc_tile(size, input_states, use_weights,
+                                         backtrack, budget, wave, rng,
+                                         deadline)
+        if wave is not None:
+            raise ValueError('A starting wave is not supported by the '
+                             f'{engine} engine')
+        if backtrack != 'history':
+            raise ValueError(f'{backtrack} backtracking is not supported by '
+                             f'the {engine} engine')
+        if engine == 'ac4':
+            return self._ac4_wfc_tile(size, input_states, use_weights, budget,
+                                      rng, deadline)
         offsets = gen_offsets(self.pattern_size)
         history: List[History] = []
         states: List[TileState] = list(map(self.tile_classes.__getitem__,
                                            input_states))
         
         start_time = time.time_ns()
-        if use_jit:
-            _states_numba = numba.typed.List(lsttype=numba.types.ListType(
-                numba.types.ListType(numba.int32)))
-            for state in states:
-                _lst = numba.typed.List(lsttype=numba.types.ListType(
-                    numba.int32))
-                for i in state:
-                    _lst.append(i)
-                _states_numba.append(_lst)
-            _adj_numba = numba.typed.List(lsttype=numba.types.ListType(
-                numba.types.ListType(numba.int32)))
-            for state_i in range(len(self.allowed_adjacencies[0])):
-                for offset_i, offset_rules\
-                        in enumerate(self.allowed_adjacencies):
-                    _lst = numba.typed.List(lsttype=numba.types.ListType(
-                        numba.int32))
-                    for i in offset_rules[state_i]:
-                        _lst.append(i)
-                    _adj_numba.append(_lst)
-            _psize_nubma = np.array(self.pattern_size, dtype=np.int32)
-            _size_numba = np.array(size, dtype=np.int32)
-            _offsets_numba = np.array(offsets, dtype=np.int32)
-            fast_lst = _fast_wfc_tile(_psize_nubma,
-                           _adj_numba,
-                           _states_numba,
-                           _size_numba,
-                           _offsets_numba,
-                           self.weights)
-            logging.info(f'jit_time = {(time.time_ns() - start_time) * 1e-9}')
-            return list(fast_lst)
-
+        num_patterns = len(self.allowed_adjacencies[0])
+        queue = EntropyQueue(self._class_masks()[
+                                np.asanyarray(input_states, dtype=int)],
+                             self.weights if use_weights else None,
+                             rng)
+        
+        def _states_row(state: TileState) -> Wave:
+            row = np.zeros(num_patterns, dtype=np.bool_)
+            row[list(state)] = True
+            return row
+        
+        contradiction = False
         while True:
+            if deadline is not None:
+                deadline.check()
+            if contradiction:
+                self._count('contradictions')
+                resolved = False
+                while len(history) > 0:
+                    pos, state, choice = history.pop()
+                    if choice:
+                        valid = state.difference(states[pos])
+                        if len(valid) == 0:
+                            continue # Keep backtracking to last choice
+                        states[pos] = valid
+                        queue.reset(pos, _states_row(valid))
+                        resolved = True
+                        break
+                    else:
+                        states[pos] = state
+                        queue.reset(pos, _states_row(state))
+                if not resolved:
+                    raise CollapseError("Could not collapse wave function")
+                contradiction = False
             # Find a minimum entropy position
-            min_ent = float('inf')
-            min_pos = []
-            for xy, state in enumerate(states):
-                num_pos = len(state)
-                if num_pos == 1:
-                    continue
-                elif num_pos == 0:
-                    resolved = False
-                    while len(history) > 0:
-                        pos, state, choice = history.pop()
-                        if choice:
-                            valid = state.difference(states[pos])
-                            if len(valid) == 0:
-                                continue # Keep backtracking to last choice
-                            states[pos] = valid
-                            state = valid
-                            resolved = True
-                            break
-                        else:
-                            states[pos] = state
-                    if not resolved:
-                        raise Exception("Could not collapse wave function")
-                if num_pos < min_ent:
-                    min_ent = len(state)
-                    min_pos = [xy]
-                elif num_pos == min_ent:
-                    min_pos.append(xy)
-            if min_ent == float('inf'):
+            next_xy = queue.pop()
+            if next_xy is None:
                 break
-            xy = random.choice(min_pos)
+            xy = next_xy
             state = states[xy]
             
             # Collapse it to a random state
@@ -422,11 +943,13 @@ class WaveFunction:
             p = (lambda x: x/x.sum())(self.weights[choose_from])\
                 if use_weights\
                 else None
-            states[xy] = set([np.random.choice(choose_from, p=p)])
+            choice = rng.choice(choose_from, p=p)
+            states[xy] = set([choice])
+            queue.reset(xy, _states_row(states[xy]))
             
             # Propagate
             frontier = deque([xy])
-            while len(frontier) > 0:
+            while len(frontier) > 0 and not contradiction:
                 head = frontier.pop()
                 state = states[head]
                 for delta_i, delta in enumerate(offsets):
@@ -451,6 +974,793 @@ class WaveFunction:
                         continue
                     history.append((n_xy, other_state, False))
                     states[n_xy] = intersect
+                    queue.discard(n_xy, other_state.difference(intersect))
+                    if len(intersect) == 0:
+                        # Backtrack before anything else
+                        contradiction = True
+                        break
                     frontier.append(n_xy)
         logging.info(f'int_time = {(time.time_ns() - start_time) * 1e-9}')
-        return list(map(lambda s: next(iter(s)), states))
\ No newline at end of file
+        return list(map(lambda s: next(iter(s)), states))
+    
+    def wfc_chunked(self,
+                    size: Pos,
+                    input_states: WFMap,
+                    chunk_size: Pos,
+                    overlap: Optional[Pos]=None,
+                    use_weights: bool=True,
+                    backtrack: str='history',
+                    budget: Optional[SolverBudget]=None,
+                    max_rerolls: int=3,
+                    engine: str='jit',
+                    rng: Optional[np.random.Generator]=None,
+                    deadline: Optional[utils.Deadline]=None,
+                    edge_class: Optional[int]=None) -> List[int]:
+        """Collapses a wave one chunk at a time, so the cost grows with the number of chunks rather than the map area
+        Each chunk's window reaches overlap cells back into the chunks
+        already collapsed, which are re-rolled along with it, and a ring
+        pattern_size - 1 wide around that, which is kept fixed as a
+        constraint. A chunk that can't be collapsed is re-rolled along with
+        the collapsed chunks around it, above and to either side, reaching
+        one more chunk back each time, up to max_rerolls times. Structures
+        like long corridors can commit chunks to what only fails several
+        chunks later. After that the whole map is restarted, up to the
+        budget's max_restarts times.
+        chunk_size: 2-tuple of the largest width and height of each chunk
+        overlap: 2-tuple of how far windows reach back into collapsed cells,
+            defaults to pattern_size - 1
+        engine: 'jit' or 'bitset', see wfc_tile
+        rng: generator to make choices with, a fresh one by default
+        deadline: raises DeadlineExceeded once it expires or is cancelled
+        edge_class: tile class that the uncollapsed outer edge of each window
+            is restricted to, usually the class the edges of the map are.
+            Chunks then only commit to what can be closed off like the
+            edge of the map, instead of to structures that can't end.
+        """
+        if engine not in ('bitset', 'jit'):
+            raise ValueError(f'{engine} is not a valid chunked WFC engine')
+        if engine == 'jit' and backtrack != 'history':
+            raise ValueError(f'{backtrack} backtracking is not supported by '
+                             'the jit engine')
+        if budget is None:
+            budget = SolverBudget()
+        rng = np.random.default_rng(rng)
+        self.counts = {}
+        solve = (lambda size, input_states, use_weights, budget, wave:\
+                    self._jit_wfc_tile(size, input_states, use_weights,
+                                       budget, wave, False, rng, deadline))\
+            if engine == 'jit' else\
+            (lambda size, input_states, use_weights, budget, wave:\
+                self._bitset_wfc_tile(size, input_states, use_weights,
+                                      backtrack, budget, wave, rng,
+                                      deadline))
+        w, h = size
+        margin_x, margin_y = self.pattern_size[0] - 1, self.pattern_size[1] - 1
+        if overlap is None:
+            overlap = (margin_x, margin_y)
+        num_patterns = len(self.allowed_adjacencies[0])
+        states = np.asanyarray(input_states, dtype=int).reshape(h, w)
+        class_masks = pack_states(self._class_masks())
+        one_hot = pack_states(np.eye(num_patterns, dtype=np.bool_))
+        # Split the map evenly, so the last chunk isn't a thin sliver
+        # squeezed against the edge of the map
+        xs = np.linspace(0, w, -(-w // chunk_size[0]) + 1).astype(int)
+        ys = np.linspace(0, h, -(-h // chunk_size[1]) + 1).astype(int)
+        for attempt in range(budget.max_restarts + 1):
+            if attempt > 0:
+                logging.debug('Restarting chunked WFC')
+                self._count('restarts')
+            result = np.full((h, w), -1, dtype=np.int64)
+            if self._collapse_chunks(result, states, xs, ys, overlap,
+                                     max_rerolls, class_masks, one_hot,
+                                     use_weights, budget, solve,
+                                     edge_class):
+                return result.ravel().tolist()
+        raise CollapseError("Could not collapse wave function")
+    
+    def _collapse_chunks(self,
+                         result: npt.NDArray[np.int64],
+                         states: npt.NDArray[np.int64],
+                         xs: npt.NDArray[np.int64],
+                         ys: npt.NDArray[np.int64],
+                         overlap: Pos,
+                         max_rerolls: int,
+                         class_masks: Bitmask,
+                         one_hot: Bitmask,
+                         use_weights: bool,
+                         budget: SolverBudget,
+                         solve: Any,
+                         edge_class: Optional[int]) -> bool:
+        """One attempt of wfc_chunked, collapsing into result
+        Returns whether every chunk was collapsed
+        """
+        h, w = result.shape
+        margin_x, margin_y = self.pattern_size[0] - 1, self.pattern_size[1] - 1
+        for cy, cy1 in zip(ys[:-1], ys[1:]):
+            for cx, cx1 in zip(xs[:-1], xs[1:]):
+                for reroll in range(max_rerolls + 1):
+                    # Re-rolls back off by whole chunks, which releases the
+                    # cells collapsed by previous rows past either edge
+                    back_x = overlap[0] + reroll * (cx1 - cx)
+                    back_y = overlap[1] + reroll * (cy1 - cy)
+                    x0 = max(0, cx - back_x - margin_x)
+                    y0 = max(0, cy - back_y - margin_y)
+                    x1 = min(w, cx1 + reroll * (cx1 - cx) + margin_x)
+                    y1 = min(h, cy1 + margin_y)
+                    window = result[y0:y1, x0:x1]
+                    window_states = states[y0:y1, x0:x1]
+                    # Cells that could affect or be affected by cells outside
+                    # the window. Collapsed ones constrain the chunk, the
+                    # rest are left for later chunks
+                    ring = np.zeros(window.shape, dtype=np.bool_)
+                    if x0 > 0:
+                        ring[:, :margin_x] = True
+                    if y0 > 0:
+                        ring[:margin_y] = True
+                    if x1 < w:
+                        ring[:, window.shape[1] - margin_x:] = True
+                    if y1 < h:
+                        ring[window.shape[0] - margin_y:] = True
+                    if edge_class is not None:
+                        edge = np.zeros(window.shape, dtype=np.bool_)
+                        if x1 < w:
+                            edge[:, -1] = True
+                        if y1 < h:
+                            edge[-1] = True
+                        window_states = np.where(edge & (window < 0),
+                                                 edge_class,
+                                                 window_states)
+                    wave = class_masks[window_states]
+                    fixed = ring & (window >= 0)
+                    wave[fixed] = one_hot[window[fixed]]
+                    try:
+                        tiles = solve((x1 - x0, y1 - y0),
+                                      window_states.ravel(),
+                                      use_weights,
+                                      budget,
+                                      wave.reshape(-1, wave.shape[-1]))
+                    except CollapseError:
+                        logging.debug(f'Re-rolling WFC chunk at {(cx, cy)}')
+                        self._count('rerolls')
+                        continue
+                    # Keep the chunk and the collapsed cells it re-rolled,
+                    # but leave the rest of the window to later chunks
+                    keep = ~ring & (window >= 0)
+                    keep[cy - y0:cy1 - y0, cx - x0:cx1 - x0] = True
+                    window[keep] = np.reshape(tiles, window.shape)[keep]
+                    break
+                else:
+                    return False
+        return True
+    
+    def _class_masks(self) -> Wave:
+        """Boolean table of which patterns belong to each tile class"""
+        num_patterns = len(self.allowed_adjacencies[0])
+        masks = np.zeros((len(self.tile_classes), num_patterns),
+                         dtype=np.bool_)
+        for class_i, tile_class in enumerate(self.tile_classes):
+            masks[class_i, list(tile_class)] = True
+        return masks
+    
+    def _jit_wfc_tile(self,
+                      size: Pos,
+                      input_states: WFMap,
+                      use_weights: bool=True,
+                      budget: Optional[SolverBudget]=None,
+                      wave: Optional[Bitmask]=None,
+                      propagated: bool=False,
+                      rng: Optional[np.random.Generator]=None,
+                      deadline: Optional[utils.Deadline]=None) -> List[int]:
+        """Runs _wfc_kernel, restarting it within the budget
+        The kernel can't check the time, so max_seconds is only checked
+        between attempts. A deadline cancels the kernel through its flag,
+        from a timer when it expires.
+        wave: packed states each cell is further restricted to
+        propagated: whether wave is from propagated_wave for these
+            input_states, so it can be used as is
+        rng: seeds each attempt of the kernel
+        """
+        if budget is None:
+            budget = SolverBudget()
+        rng = np.random.default_rng(rng)
+        num_patterns = len(self.allowed_adjacencies[0])
+        if wave is not None and propagated:
+            initial = wave
+        else:
+            initial = pack_states(
+                self._class_masks()[np.asanyarray(input_states, dtype=int)])
+            if wave is not None:
+                initial &= wave
+            propagated = False
+        masks = self.masks()
+        neighbors = neighbor_table(size, gen_offsets(self.pattern_size))
+        weights = self.weights.astype(np.float64) if use_weights\
+            else np.ones(num_patterns)
+        max_contradictions = -1 if budget.max_contradictions is None\
+            else budget.max_contradictions
+        
+        start_time = time.time_ns()
+        restart_by = None if budget.max_seconds is None\
+            else time.monotonic() + budget.max_seconds
+        counters = np.zeros(1, dtype=np.int64)
+        cancel = _NEVER_CANCEL if deadline is None else deadline.flag
+        ticket = 0 if deadline is None else deadline.ticket
+        timer = None if deadline is None else deadline.timer()
+        try:
+            for attempt in range(budget.max_restarts + 1):
+                collapsed = initial.copy()
+                result = _wfc_kernel(collapsed,
+                                     masks,
+                                     neighbors,
+                                     weights,
+                                     int(rng.integers(2**31)),
+                                     max_contradictions,
+                                     cancel,
+                                     ticket,
+                                     propagated,
+                                     counters)
+                self._count('contradictions', int(counters[0]))
+                counters[0] = 0
+                if deadline is not None:
+                    deadline.check()
+                if result == JIT_COLLAPSED:
+                    logging.info('jit_time = '
+                                 f'{(time.time_ns() - start_time) * 1e-9}')
+                    return unpack_states(collapsed, num_patterns)\
+                        .argmax(axis=1).tolist()
+                elif result == JIT_IMPOSSIBLE\
+                        or (restart_by is not None
+                            and time.monotonic() > restart_by):
+                    break
+                logging.debug('Restarting compiled WFC')
+                self._count('restarts')
+        finally:
+            if timer is not None:
+                timer.cancel()
+        raise CollapseError("Could not collapse wave function")
+    
+    def _bitset_wfc_tile(self,
+                         size: Pos,
+                         input_states: WFMap,
+                         use_weights: bool=True,
+                         backtrack: str='history',
+                         budget: Optional[SolverBudget]=None,
+                         wave: Optional[Bitmask]=None,
+                         rng: Optional[np.random.Generator]=None,
+                         deadline: Optional[utils.Deadline]=None)\
+            -> List[int]:
+        """Same algorithm as the set-based path, but each cell's states are
+        a row of 64-bit words, so propagating a step is a handful of ORs
+        and ANDs over the precomputed adjacency masks
+        wave: packed states each cell is further restricted to
+        """
+        if backtrack not in ('history', 'snapshot'):
+            raise ValueError(f'{backtrack} is not a valid backtracking mode')
+        if budget is None:
+            budget = SolverBudget()
+        rng = np.random.default_rng(rng)
+        num_patterns = len(self.allowed_adjacencies[0])
+        offsets = gen_offsets(self.pattern_size)
+        masks = self.masks()
+        weights = self.weights if use_weights else None
+        neighbors = neighbor_table(size, offsets)
+        
+        def _propagate(wave: Bitmask,
+                       queue: Optional[EntropyQueue],
+                       history: Optional[List[Tuple[int, Bitmask, bool]]],
+                       frontier: List[int]) -> bool:
+            """Returns False if a contradiction was reached"""
+            # States of each touched cell before propagating, so the
+            # entropy queue only has to be updated once at the end
+            touched: Dict[int, Bitmask] = {}
+            consistent = True
+            while len(frontier) > 0 and consistent:
+                head = frontier.pop()
+                present = np.flatnonzero(
+                    unpack_states(wave[head], num_patterns))
+                if len(present) == 0:
+                    continue
+                # One row of allowed patterns per offset
+                valid_states = np.bitwise_or.reduce(masks[:, present], axis=1)
+                in_bounds = neighbors[head] >= 0
+                n_xys = neighbors[head][in_bounds]
+                other_states = wave[n_xys]
+                intersects = other_states & valid_states[in_bounds]
+                changed = (intersects != other_states).any(axis=1)
+                if not changed.any():
+                    continue
+                n_xys = n_xys[changed]
+                other_states = other_states[changed]
+                intersects = intersects[changed]
+                for n_xy, other_state in zip(n_xys.tolist(), other_states):
+                    if history is not None:
+                        history.append((n_xy, other_state, False))
+                    touched.setdefault(n_xy, other_state)
+                wave[n_xys] = intersects
+                consistent = intersects.any(axis=1).all()
+                frontier.extend(n_xys.tolist())
+            if queue is not None and len(touched) > 0:
+                cells = list(touched.keys())
+                queue.remove_bits(cells, np.array(list(touched.values()))
+                                         & ~wave[cells])
+            return consistent
+        
+        start_time = time.time_ns()
+        # Apply the constraints of the input classes up front
+        initial = pack_states(
+            self._class_masks()[np.asanyarray(input_states, dtype=int)])
+        if wave is not None:
+            initial &= wave
+        constrained = unpack_states(initial, num_patterns).sum(axis=1)\
+            < num_patterns
+        if not _propagate(initial, None, None,
+                          np.flatnonzero(constrained).tolist()):
+            raise CollapseError("Could not collapse wave function")
+        
+        for attempt in range(budget.max_restarts + 1):
+            wave = initial.copy()
+            queue = EntropyQueue(unpack_states(wave, num_patterns), weights,
+                                 rng)
+            history: List[Tuple[int, Bitmask, bool]] = []
+            # Wave before a collapse, the cell collapsed, and its choice
+            snapshots: Deque[Tuple[Bitmask, int, int]] =\
+                deque(maxlen=budget.max_snapshots)
+            collapses = 0
+            contradictions = 0
+            restart_by = None if budget.max_seconds is None\
+                else time.monotonic() + budget.max_seconds
+            contradiction = False
+            while True:
+                if deadline is not None:
+                    deadline.check()
+                if restart_by is not None and time.monotonic() > restart_by:
+                    break
+                if contradiction:
+                    contradictions += 1
+                    self._count('contradictions')
+                    if budget.max_contradictions is not None\
+                            and contradictions > budget.max_contradictions:
+                        break
+                    resolved = False
+                    if backtrack == 'snapshot':
+                        while len(snapshots) > 0:
+                            # Go back to the last snapshot, without the
+                            # choice that followed it
+                            wave, pos, choice = snapshots.pop()
+                            banned = np.ones(num_patterns, dtype=np.bool_)
+                            banned[choice] = False
+                            wave[pos] &= pack_states(banned)
+                            queue = EntropyQueue(
+                                unpack_states(wave, num_patterns), weights,
+                                rng)
+                            if _propagate(wave, queue, None, [pos]):
+                                resolved = True
+                                break
+                        if not resolved:
+                            break
+                    else:
+                        while len(history) > 0:
+                            pos, state, chose = history.pop()
+                            if chose:
+                                valid = state & ~wave[pos]
+                                if valid.any():
+                                    # Try again without that choice, keeping
+                                    # the entry so the ban is undone with
+                                    # the rest
+                                    history.append((pos, state, False))
+                                    wave[pos] = valid
+                                    queue.reset(pos, unpack_states(
+                                        valid, num_patterns))
+                                    resolved = True
+                                    break
+                            wave[pos] = state
+                            queue.reset(pos,
+                                        unpack_states(state, num_patterns))
+                        if not resolved:
+                            break
+                        contradiction = not _propagate(wave, queue, history,
+                                                       [pos])
+                        continue
+                    contradiction = False
+                # Find a minimum entropy position
+                next_xy = queue.pop()
+                if next_xy is None:
+                    logging.info('bitset_time = '
+                                 f'{(time.time_ns() - start_time) * 1e-9}')
+                    return unpack_states(wave, num_patterns)\
+                        .argmax(axis=1).tolist()
+                xy = next_xy
+                state = wave[xy].copy()
+                
+                # Collapse it to a random state
+                choose_from = np.flatnonzero(
+                    unpack_states(state, num_patterns))
+                p = (lambda x: x/x.sum())(self.weights[choose_from])\
+                    if use_weights\
+                    else None
+                choice = rng.choice(choose_from, p=p)
+                if backtrack == 'snapshot':
+                    if collapses % budget.snapshot_interval == 0:
+                        snapshots.append((wave.copy(), xy, choice))
+                else:
+                    history.append((xy, state, True))
+                collapses += 1
+                chosen = np.zeros(num_patterns, dtype=np.bool_)
+                chosen[choice] = True
+                wave[xy] = pack_states(chosen)
+                queue.reset(xy, chosen)
+                
+                # Propagate
+                contradiction = not _propagate(
+                    wave, queue,
+                    history if backtrack == 'history' else None,
+                    [xy])
+            logging.debug(f'Restarting WFC after {collapses} collapses and '
+                          f'{contradictions} contradictions')
+            self._count('restarts')
+        raise CollapseError("Could not collapse wave function")
+    
+    def _ac4_wfc_tile(self,
+                      size: Pos,
+                      input_states: WFMap,
+                      use_weights: bool=True,
+                      budget: Optional[SolverBudget]=None,
+                      rng: Optional[np.random.Generator]=None,
+                      deadline: Optional[utils.Deadline]=None) -> List[int]:
+        """AC-4 style propagation
+        For each cell, direction and pattern, counts how many patterns of
+        the neighbor in that direction allow the pattern in this cell.
+        Removing a pattern only decrements the counts it contributed to,
+        and a pattern is removed once any of its counts reaches zero.
+        Backtracking re-increments the counts of each undone removal.
+        """
+        if budget is None:
+            budget = SolverBudget()
+        rng = np.random.default_rng(rng)
+        weights = self.weights if use_weights else None
+        num_patterns = len(self.allowed_adjacencies[0])
+        offsets = gen_offsets(self.pattern_size)
+        opposites = opposite_offsets(offsets)
+        table = adjacency_table(self.allowed_adjacencies, num_patterns)
+        # Compatible patterns of each offset in CSR form
+        compat_ptr: List[npt.NDArray[np.int64]] = []
+        compat_idx: List[npt.NDArray[np.int64]] = []
+        for offset_table in table:
+            compat_ptr.append(np.concatenate(
+                ([0], np.cumsum(offset_table.sum(axis=1)))))
+            compat_idx.append(np.nonzero(offset_table)[1])
+        neighbors = neighbor_table(size, offsets)
+        wave = self._class_masks()[np.asanyarray(input_states, dtype=int)]
+        queue = EntropyQueue(wave, weights, rng)
+        
+        # supports[xy, d, i]: patterns of the neighbor at offset d that allow
+        # pattern i at xy. Neighbors out of bounds never run out
+        supports = np.full((len(wave), len(offsets), num_patterns),
+                           num_patterns + 1,
+                           dtype=np.int16 if num_patterns < 2**14\
+                                else np.int32)
+        for delta_i, opposite in enumerate(opposites):
+            in_bounds = neighbors[:, delta_i] >= 0
+            supports[in_bounds, delta_i] =\
+                wave[neighbors[in_bounds, delta_i]].astype(np.int32)\
+                @ table[opposite]
+        
+        # Entries are [position, removed patterns, choice, decremented?]
+        history: List[List[Any]] = []
+        pending: List[List[Any]] = []
+        
+        def _decrement(n_supports: npt.NDArray[np.int16],
+                       delta_i: int,
+                       removed: npt.NDArray[np.int64],
+                       amount: int=1) -> None:
+            """Takes the support of the removed patterns at offset delta_i
+            away from a row of support counts
+            """
+            ptr = compat_ptr[delta_i]
+            if len(removed) == 1:
+                # Common case, the compatible patterns are all distinct
+                pattern = removed[0]
+                n_supports[compat_idx[delta_i][
+                    ptr[pattern]:ptr[pattern + 1]]] -= amount
+                return
+            starts = ptr[removed]
+            lengths = ptr[removed + 1] - starts
+            firsts = np.cumsum(lengths) - lengths
+            spans = np.repeat(starts - firsts, lengths)\
+                + np.arange(lengths.sum())
+            n_supports -= amount * np.bincount(compat_idx[delta_i][spans],
+                                               minlength=num_patterns)\
+                .astype(n_supports.dtype)
+        
+        def _ban(xy: int, removed: npt.NDArray[np.int64]) -> bool:
+            """Removes patterns from a cell, returns False on contradiction"""
+            wave[xy, removed] = False
+            entry = [xy, removed, False, False]
+            history.append(entry)
+            pending.append(entry)
+            removed_row = np.zeros(num_patterns, dtype=np.bool_)
+            removed_row[removed] = True
+            queue.remove([xy], removed_row[np.newaxis])
+            return wave[xy].any()
+        
+        def _propagate() -> bool:
+            """Returns False if a contradiction was reached"""
+            while len(pending) > 0:
+                entry = pending.pop()
+                xy, removed, _, __ = entry
+                entry[3] = True
+                for delta_i, n_xy in enumerate(neighbors[xy]):
+                    if n_xy < 0:
+                        continue
+                    opposite = opposites[delta_i]
+                    n_supports = supports[n_xy, opposite]
+                    _decrement(n_supports, delta_i, removed)
+                    dead = np.flatnonzero(wave[n_xy] & (n_supports <= 0))
+                    if len(dead) > 0 and not _ban(n_xy, dead):
+                        return False
+            return True
+        
+        def _undo(entry: List[Any]) -> None:
+            xy, removed, _, decremented = entry
+            wave[xy, removed] = True
+            if decremented:
+                for delta_i, n_xy in enumerate(neighbors[xy]):
+                    if n_xy >= 0:
+                        _decrement(supports[n_xy, opposites[delta_i]],
+                                   delta_i, removed, -1)
+            queue.reset(xy, wave[xy])
+        
+        start_time = time.time_ns()
+        # Apply the constraints of the input classes up front
+        consistent = True
+        for xy in np.flatnonzero((wave & (supports <= 0).any(axis=1))
+                                 .any(axis=1)):
+            dead = np.flatnonzero(wave[xy] & (supports[xy] <= 0).any(axis=0))
+            consistent = _ban(xy, dead) and consistent
+        if not consistent or not _propagate():
+            raise CollapseError("Could not collapse wave function")
+        history.clear()
+        initial_wave = wave.copy()
+        initial_supports = supports.copy()
+        
+        for attempt in range(budget.max_restarts + 1):
+            if attempt > 0:
+                wave = initial_wave.copy()
+                supports = initial_supports.copy()
+                queue = EntropyQueue(wave, weights, rng)
+                history.clear()
+            contradictions = 0
+            restart_by = None if budget.max_seconds is None\
+                else time.monotonic() + budget.max_seconds
+            contradiction = False
+            completed = False
+            while True:
+                if deadline is not None:
+                    deadline.check()
+                if restart_by is not None and time.monotonic() > restart_by:
+                    break
+                if contradiction:
+                    contradictions += 1
+                    self._count('contradictions')
+                    if budget.max_contradictions is not None\
+                            and contradictions > budget.max_contradictions:
+                        break
+                while contradiction:
+                    pending.clear()
+                    resolved = False
+                    while len(history) > 0:
+                        entry = history.pop()
+                        if entry[2]:
+                            # Try again without that choice
+                            resolved = True
+                            break
+                        _undo(entry)
+                    if not resolved:
+                        raise CollapseError("Could not collapse wave function")
+                    pos, choice = entry[0], entry[1]
+                    contradiction = not _ban(pos, np.array([choice]))\
+                        or not _propagate()
+                # Find a minimum entropy position
+                next_xy = queue.pop()
+                if next_xy is None:
+                    completed = True
+                    break
+                xy = next_xy
+                
+                # Collapse it to a random state
+                choose_from = np.flatnonzero(wave[xy])
+                p = (lambda x: x/x.sum())(self.weights[choose_from])\
+                    if use_weights\
+                    else None
+                choice = rng.choice(choose_from, p=p)
+                history.append([xy, choice, True, False])
+                _ban(xy, choose_from[choose_from != choice])
+                
+                # Propagate
+                contradiction = not _propagate()
+            if completed:
+                break
+            logging.debug('Restarting WFC after '
+                          f'{contradictions} contradictions')
+            self._count('restarts')
+        else:
+            raise CollapseError("Could not collapse wave function")
+        logging.info(f'ac4_time = {(time.time_ns() - start_time) * 1e-9}')
+        return wave.argmax(axis=1).tolist()
+
+@dataclass
+class SharedArray:
+    """A numpy array in shared memory, which pickles as just its name"""
+    name: str
+    shape: Tuple[int, ...]
+    dtype: str
+
+# Shared memory blocks this process has attached to, by name
+_attached: Dict[str, Tuple[shared_memory.SharedMemory, npt.NDArray[Any]]] = {}
+
+def share_array(array: npt.NDArray[Any])\
+        -> Tuple[shared_memory.SharedMemory, SharedArray]:
+    """Copies an array into a new block of shared memory"""
+    memory = shared_memory.SharedMemory(create=True,
+                                        size=max(array.nbytes, 1))
+    np.ndarray(array.shape, array.dtype, buffer=memory.buf)[...] = array
+    return memory, SharedArray(memory.name, array.shape, array.dtype.str)
+
+def attach_array(shared: SharedArray) -> npt.NDArray[Any]:
+    """Returns a view of an array in shared memory, attaching to it the first
+    time it is used in this process
+    """
+    if shared.name not in _attached:
+        memory = shared_memory.SharedMemory(name=shared.name)
+        _attached[shared.name] = (memory, np.ndarray(shared.shape,
+                                                     np.dtype(shared.dtype),
+                                                     buffer=memory.buf))
+    return _attached[shared.name][1]
+
+def _release_memory(memories: List[shared_memory.SharedMemory]) -> None:
+    for memory in memories:
+        memory.close()
+        memory.unlink()
+
+_race_pool: Optional[futures.ProcessPoolExecutor] = None
+
+def race_pool(workers: Optional[int]=None) -> futures.ProcessPoolExecutor:
+    """The process pool shared by every racer, started on first use and
+    kept for the rest of the run
+    Workers are spawned rather than forked, as the game process has a GL
+    context and other threads running
+    """
+    global _race_pool
+    if _race_pool is None:
+        _race_pool = futures.ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context('spawn'))
+    return _race_pool
+
+# Neighbor tables built by this process, by map and pattern size
+_neighbor_cache: Dict[Tuple[Pos, Pos], npt.NDArray[np.int32]] = {}
+
+def _race_attempt(tables: Dict[str, SharedArray],
+                  pattern_size: Pos,
+                  size: Pos,
+                  input_states: npt.NDArray[np.int32],
+                  seed: int,
+                  use_weights: bool,
+                  max_contradictions: int,
+                  ticket: int,
+                  wave: Optional[Bitmask]) -> Optional[npt.NDArray[np.int32]]:
+    """Runs one attempt of a race in a worker process, returns the pattern
+    of each position or None if it didn't collapse
+    wave: propagated wave to start from instead of the input classes
+    """
+    masks = attach_array(tables['masks'])
+    weights = attach_array(tables['weights'])
+    if not use_weights:
+        weights = np.ones(len(weights))
+    key = (size, pattern_size)
+    if key not in _neighbor_cache:
+        _neighbor_cache[key] = neighbor_table(size, gen_offsets(pattern_size))
+    propagated = wave is not None
+    if wave is None:
+        wave = attach_array(tables['classes'])[input_states]
+    result = _wfc_kernel(wave,
+                         masks,
+                         _neighbor_cache[key],
+                         weights,
+                         seed,
+                         max_contradictions,
+                         attach_array(tables['cancel']),
+                         ticket,
+                         propagated,
+                         np.zeros(1, dtype=np.int64))
+    if result != JIT_COLLAPSED:
+        return None
+    return unpack_states(wave, len(weights)).argmax(axis=1).astype(np.int32)
+
+class WaveFunctionRacer:
+    """Races independently seeded runs of the compiled solver in a process
+    pool and keeps the first to collapse, since a few seeds take far longer
+    than the rest
+    The tables of the wave function are copied into shared memory once, so
+    each attempt only sends the input classes and a seed
+    """
+    def __init__(self,
+                 wave_function: WaveFunction,
+                 workers: Optional[int]=None):
+        self.pattern_size = wave_function.pattern_size
+        self.workers = workers
+        num_patterns = len(wave_function.allowed_adjacencies[0])
+        memories: List[shared_memory.SharedMemory] = []
+        self.tables: Dict[str, SharedArray] = {}
+        for name, array in (
+                ('masks', adjacency_masks(wave_function.allowed_adjacencies,
+                                          num_patterns)),
+                ('classes', pack_states(wave_function._class_masks())),
+                ('weights', wave_function.weights.astype(np.float64)),
+                ('cancel', np.zeros(1, dtype=np.int64))):
+            memory, self.tables[name] = share_array(array)
+            memories.append(memory)
+        # Incremented after each race, so attempts still running give up
+        self.cancel = attach_array(self.tables['cancel'])
+        weakref.finalize(self, _release_memory, memories)
+    
+    def wfc_tile(self,
+                 size: Pos,
+                 input_states: WFMap,
+                 attempts: int,
+                 use_weights: bool=True,
+                 budget: Optional[SolverBudget]=None,
+                 wave: Optional[Bitmask]=None,
+                 rng: Optional[np.random.Generator]=None,
+                 deadline: Optional[utils.Deadline]=None) -> List[int]:
+        """Same as WaveFunction.wfc_tile with the compiled solver, but with
+        attempts seeds at once
+        budget: max_contradictions applies to each attempt, max_seconds to
+            the whole race
+        wave: result of WaveFunction.propagated_wave to start from
+        rng: draws the seed of each attempt. Whichever attempt finishes
+            first wins, so the result isn't reproducible from it
+        deadline: ends the race early, raising DeadlineExceeded. It is only
+            checked as attempts finish and when it expires.
+        """
+        if budget is None:
+            budget = SolverBudget()
+        max_contradictions = -1 if budget.max_contradictions is None\
+            else budget.max_contradictions
+        pool = race_pool(self.workers)
+        ticket = int(self.cancel[0])
+        states = np.asanyarray(input_states, dtype=np.int32)
+        start_time = time.time_ns()
+        pending = [pool.submit(_race_attempt,
+                               self.tables,
+                               self.pattern_size,
+                               size,
+                               states,
+                               seed,
+                               use_weights,
+                               max_contradictions,
+                               ticket,
+                               wave)
+                   for seed in np.random.default_rng(rng)
+                       .integers(2**31, size=attempts).tolist()]
+        timeout = budget.max_seconds
+        if deadline is not None and deadline.remaining() is not None:
+            timeout = min(timeout or math.inf, cast(float,
+                                                    deadline.remaining()))
+        try:
+            for future in futures.as_completed(pending, timeout=timeout):
+                if deadline is not None:
+                    deadline.check()
+                tiles = future.result()
+                if tiles is not None:
+                    logging.info('race_time = '
+                                 f'{(time.time_ns() - start_time) * 1e-9}')
+                    return tiles.tolist()
+        except futures.TimeoutError:
+            logging.debug('WFC race timed out')
+        finally:
+            self.cancel[0] += 1
+            for future in pending:
+                future.cancel()
+        if deadline is not None:
+            deadline.check()
+        raise CollapseError("Could not collapse wave function")
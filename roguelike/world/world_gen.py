@@ -1,13 +1,17 @@
 """
 General world generation
 """
+import contextlib
 from dataclasses import (
     dataclass,
     field
 )
+import hashlib
+import json
 import logging
-import random
+import os
 import sys
+import time
 import traceback
 from typing import (
     cast,
@@ -16,6 +20,7 @@ from typing import (
     Collection,
     Dict,
     Iterable,
+    Iterator,
     List,
     MutableSequence,
     Optional,
@@ -24,7 +29,8 @@ from typing import (
     Set,
     Tuple,
     Type,
-    TYPE_CHECKING
+    TYPE_CHECKING,
+    Union
 )
 
 import numpy as np
@@ -34,6 +40,8 @@ from roguelike.world import (
     bsp,
     cellular,
     dungeon,
+    gen_service,
+    level_cache,
     lvl_entity,
     noise,
     wfc
@@ -55,12 +63,77 @@ from roguelike.entities import (
 Pos = Tuple[int, int]
 WallGrid = npt.NDArray[np.int32]
 TileGrid = npt.NDArray[np.int32]
+Seed = Union[None, int, np.random.Generator]
 
-MAX_SIZE = 50
+MAX_SIZE = 256
+WFC_CACHE_DIR = 'wfc_cache' # Under the save directory
+INITIAL_WAVE_CACHE_SIZE = 8 # Initial waves kept by each WFC generator
+# Each stage of generating a level draws from its own stream, so that
+# changing one stage doesn't change what the others generate
+GENERATION_STAGES = ('walls', 'features', 'tiles', 'layout', 'exit', 'populate')
+
+@dataclass
+class GenerationStats:
+    """Where the time generating a level went, and how much work each stage
+    did, so that a regression can be traced to its stage
+    times: seconds spent in each stage
+    calls: how many times each stage ran
+    counts: anything else counted, like spawns placed or WFC contradictions
+    """
+    times: Dict[str, float] = field(default_factory=dict)
+    calls: Dict[str, int] = field(default_factory=dict)
+    counts: Dict[str, int] = field(default_factory=dict)
+    
+    @contextlib.contextmanager
+    def timed(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[stage] = self.times.get(stage, 0)\
+                + time.perf_counter() - start
+            self.calls[stage] = self.calls.get(stage, 0) + 1
+    
+    def count(self, name: str, amount: int=1) -> None:
+        self.counts[name] = self.counts.get(name, 0) + amount
+    
+    def update(self, other: 'GenerationStats') -> None:
+        for stage, seconds in other.times.items():
+            self.times[stage] = self.times.get(stage, 0) + seconds
+            self.calls[stage] = self.calls.get(stage, 0)\
+                + other.calls.get(stage, 0)
+        for name, amount in other.counts.items():
+            self.count(name, amount)
+    
+    def __str__(self) -> str:
+        lines = [f'{stage}: {seconds * 1000:.1f}ms'
+                 + (f' x{self.calls[stage]}' if self.calls[stage] > 1 else '')
+                 for stage, seconds in self.times.items()]
+        lines.extend(f'{name}: {amount}'
+                     for name, amount in self.counts.items())
+        return '\n'.join(lines)
+
+def level_seed(seed: Seed=None) -> int:
+    """The seed of a level, drawn from seed if it isn't already an int"""
+    if isinstance(seed, (int, np.integer)):
+        return int(seed)
+    return int(np.random.default_rng(seed).integers(2**63))
+
+def stage_rngs(seed: int) -> Dict[str, np.random.Generator]:
+    """A generator for each of GENERATION_STAGES of a level"""
+    sequences = np.random.SeedSequence(seed).spawn(len(GENERATION_STAGES))
+    return dict(zip(GENERATION_STAGES,
+                    map(np.random.default_rng, sequences)))
 
 class WallGenerator(Protocol):
-    """Assigns each space in a grid to a certain class of tile"""
-    def generate_walls(self, size: Pos) -> WallGrid:
+    """Assigns each space in a grid to a certain class of tile
+    Raises utils.DeadlineExceeded once deadline expires or is cancelled, or
+    wfc.CollapseError if a wave function can't be collapsed within budget
+    """
+    def generate_walls(self,
+                       size: Pos,
+                       rng: Optional[np.random.Generator]=None,
+                       deadline: Optional[utils.Deadline]=None) -> WallGrid:
         pass
 
 def parse_wall_generator(source: Dict[str, Any]) -> WallGenerator:
@@ -71,7 +144,15 @@ def parse_wall_generator(source: Dict[str, Any]) -> WallGenerator:
         pattern_size: Pos = cast(Pos, tuple(source['pattern_size']))
         palette = cast(List[int], source['palette'])
         border_set: Set[int] = set(source.get('border', ()))
-        return WallGeneratorWFC(size, grid, pattern_size, palette, border_set)
+        engine = cast(str, source.get('engine', 'jit'))
+        backtrack = cast(str, source.get('backtrack', 'history'))
+        budget = wfc.SolverBudget(**source.get('budget', {}))
+        chunk_size = cast(Optional[Pos], source.get('chunk_size', None))
+        if chunk_size is not None:
+            chunk_size = cast(Pos, tuple(chunk_size))
+        race = cast(int, source.get('race', 0))
+        return WallGeneratorWFC(size, grid, pattern_size, palette, border_set,
+                                engine, backtrack, budget, chunk_size, race)
     elif kind == 'bsp':
         leaf_size = cast(Pos, source['leaf_size'])
         join = cast(bool, source.get('tunnel', True))
@@ -103,21 +184,55 @@ class WallGeneratorWFC:
     sample: 1D sequence of metaclasses representing input sample
     pattern_size: 2-tuple of width and height of each pattern_size
     class_mappings: sequence containing the tile class of each metaclass
+    border: metaclasses that must line the edge of the map
+    engine: which WFC propagation engine to use, see WaveFunction.wfc_tile
+    backtrack: how the solver recovers from contradictions
+    budget: limits before the solver restarts or gives up
+    chunk_size: maps larger than this are collapsed in overlapping chunks
+        of this size with the bitset or jit engine, see
+        WaveFunction.wfc_chunked
+    race: if more than 1, maps that aren't chunked are collapsed by racing
+        this many seeds of the jit engine in a process pool, when there is
+        more than one core to race on
     """
     def __init__(self,
                  sample_size: Pos,
                  sample: WallGrid,
                  pattern_size: Pos,
                  class_mappings: Sequence[int],
-                 border: Collection[int]=()):
+                 border: Collection[int]=(),
+                 engine: str='jit',
+                 backtrack: str='history',
+                 budget: Optional[wfc.SolverBudget]=None,
+                 chunk_size: Optional[Pos]=None,
+                 race: int=0):
+        if chunk_size is not None and engine not in ('bitset', 'jit'):
+            raise ValueError(f'{engine} is not a valid chunked WFC engine')
+        if race > 1 and engine != 'jit':
+            raise ValueError(f'Only the jit engine can race, not {engine}')
         self.pattern_size = pattern_size
+        self.engine = engine
+        self.backtrack = backtrack
+        self.budget = budget
+        self.chunk_size = chunk_size
+        self.race = race
+        self.racer: Optional[wfc.WaveFunctionRacer] = None
+        # What the solver ran into generating the last map
+        self.counts: Dict[str, int] = {}
+        self._initial_waves: Dict[Pos, Tuple[List[int],
+                                             Optional[wfc.Bitmask]]] = {}
         key = (sample_size, sample.tobytes(), pattern_size)
         if key in _wfc_cache:
             self.patterns, self.adjacencies, self.weights =\
                 _wfc_cache[key]
         else:
-            _, self.patterns, __, self.adjacencies, self.weights =\
-                wfc.find_adjacencies(sample_size, sample, pattern_size, True)
+            self.patterns, self.adjacencies, self.weights =\
+                wfc.cached_adjacencies(sample_size,
+                                       sample,
+                                       pattern_size,
+                                       True,
+                                       cache_dir=assets.save_path(
+                                           savefile=WFC_CACHE_DIR))
             _wfc_cache[key] =\
                 (self.patterns, self.adjacencies, self.weights)
         all_cls = set(range(len(self.patterns)))
@@ -132,17 +247,78 @@ class WallGeneratorWFC:
                                               self.weights)
         self.class_mappings = class_mappings
     
-    def generate_walls(self, size: Pos) -> WallGrid:
+    def initial_wave(self, size: Pos) -> Tuple[List[int],
+                                               Optional[wfc.Bitmask]]:
+        """The tile class of each position of a map of the given size and,
+        unless it is chunked or uses an engine without packed waves, the
+        wave with their
+        constraints already propagated
+        Both are the same for every map of a size, and maps only grow a
+        little between levels, so the last few are kept
+        """
+        if size in self._initial_waves:
+            return self._initial_waves[size]
         classes = [0] * (size[0] * size[1])
         if len(self.border) > 0:
             for x in range(size[0]):
                 classes[x] = classes[(size[1] - 1) * size[0] + x] = 1
             for y in range(1, size[1] - 1):
                 classes[y * size[0]] = classes[y * size[0] + size[0] - 1] = 1
-        grid = self.wave_function.wfc_tile(size,
-                                           classes,
-                                           use_jit=False,
-                                           use_weights=True)
+        wave = None
+        if not self.chunked(size) and self.engine in ('bitset', 'jit'):
+            wave = self.wave_function.propagated_wave(size, classes)
+        if len(self._initial_waves) >= INITIAL_WAVE_CACHE_SIZE:
+            del self._initial_waves[next(iter(self._initial_waves))]
+        self._initial_waves[size] = (classes, wave)
+        return classes, wave
+    
+    def chunked(self, size: Pos) -> bool:
+        return self.chunk_size is not None\
+            and (size[0] > self.chunk_size[0] or size[1] > self.chunk_size[1])
+    
+    def generate_walls(self,
+                       size: Pos,
+                       rng: Optional[np.random.Generator]=None,
+                       deadline: Optional[utils.Deadline]=None) -> WallGrid:
+        if deadline is not None:
+            deadline.check()
+        classes, wave = self.initial_wave(size)
+        if self.chunked(size):
+            grid = self.wave_function.wfc_chunked(size,
+                                                  classes,
+                                                  cast(Pos, self.chunk_size),
+                                                  use_weights=True,
+                                                  backtrack=self.backtrack,
+                                                  budget=self.budget,
+                                                  engine=self.engine,
+                                                  rng=rng,
+                                                  deadline=deadline,
+                                                  edge_class=1 if self.border
+                                                  else None)
+        elif self.race > 1 and (os.cpu_count() or 1) > 1:
+            self.wave_function.counts = {'races': 1}
+            if self.racer is None:
+                self.racer = wfc.WaveFunctionRacer(self.wave_function)
+            grid = self.racer.wfc_tile(size,
+                                       classes,
+                                       self.race,
+                                       use_weights=True,
+                                       budget=self.budget,
+                                       wave=wave,
+                                       rng=rng,
+                                       deadline=deadline)
+        else:
+            grid = self.wave_function.wfc_tile(size,
+                                               classes,
+                                               use_weights=True,
+                                               engine=self.engine,
+                                               backtrack=self.backtrack,
+                                               budget=self.budget,
+                                               wave=wave,
+                                               rng=rng,
+                                               deadline=deadline)
+        self.counts = {f'wfc_{name}': amount for name, amount
+                       in self.wave_function.counts.items()}
         for i, g in enumerate(grid):
             grid[i] = self.class_mappings[self.patterns[g][0, 0]]
         return np.array(grid, dtype=np.int32).reshape(size[::-1])
@@ -158,31 +334,47 @@ class WallGeneratorBSP:
     border: int
     leaf_size: Pos
     join: bool = True
-    def generate_walls(self, size: Pos) -> WallGrid:
+    def generate_walls(self,
+                       size: Pos,
+                       rng: Optional[np.random.Generator]=None,
+                       deadline: Optional[utils.Deadline]=None) -> WallGrid:
+        # Quick enough to only check the deadline before starting
+        if deadline is not None:
+            deadline.check()
         return bsp.bsp(size,
                        self.leaf_size,
                        self.inside,
                        self.outside,
                        self.border,
-                       self.join)
+                       self.join,
+                       rng)
 
 @dataclass
 class WallGeneratorWhite:
     tiles: Sequence[int]
     weights: Sequence[float]
-    def generate_walls(self, size: Pos) -> WallGrid:
-        return noise.white(size, self.tiles, self.weights)
+    def generate_walls(self,
+                       size: Pos,
+                       rng: Optional[np.random.Generator]=None,
+                       deadline: Optional[utils.Deadline]=None) -> WallGrid:
+        if deadline is not None:
+            deadline.check()
+        return noise.white(size, self.tiles, self.weights, rng)
 
 @dataclass
 class WallGeneratorPerlin:
     tiles: Sequence[int]
     scale: Tuple[float, float]
     rectify: bool
-    def generate_walls(self, size: Pos) -> WallGrid:
+    def generate_walls(self,
+                       size: Pos,
+                       rng: Optional[np.random.Generator]=None,
+                       deadline: Optional[utils.Deadline]=None) -> WallGrid:
+        if deadline is not None:
+            deadline.check()
         dx = size[0] / self.scale[0]
         dy = size[1] / self.scale[1]
-        off_x = random.random() * 1000
-        off_y = random.random() * 1000
+        off_x, off_y = (np.random.default_rng(rng).random(2) * 1000).tolist()
         return noise.perlin(size,
                             (dx, dy),
                             self.tiles,
@@ -190,8 +382,13 @@ class WallGeneratorPerlin:
                             self.rectify)
 
 class WallFeature(Protocol):
-    """Modifies generated walls"""
-    def apply_feature(self, walls: WallGrid) -> None:
+    """Modifies generated walls
+    Raises utils.DeadlineExceeded once deadline expires or is cancelled
+    """
+    def apply_feature(self,
+                      walls: WallGrid,
+                      rng: Optional[np.random.Generator]=None,
+                      deadline: Optional[utils.Deadline]=None) -> None:
         """Modifies walls in-place"""
         pass
 
@@ -228,28 +425,37 @@ class WallFeatureDLA:
     num_shots: int
     outward: bool
     sticky: int
-    def apply_feature(self, walls: WallGrid) -> None:
+    def apply_feature(self,
+                      walls: WallGrid,
+                      rng: Optional[np.random.Generator]=None,
+                      deadline: Optional[utils.Deadline]=None) -> None:
+        rng = np.random.default_rng(rng)
+        directions = [d.value for d in utils.CardinalDirections]
+        # Walks are long, so steps are drawn in batches
+        steps: List[int] = []
         for _ in range(self.num_shots):
+            if deadline is not None:
+                deadline.check()
             if self.outward:
-                passable = list((walls == self.sticky).flatten())
-                group = utils.group(cast(Pos, walls.shape[::-1]), passable)[0]
-                position = random.choice(list(group))
+                position = utils.label_components(walls == self.sticky)\
+                    .choose(0, rng)
             else:
                 center = walls.shape[1] // 2, walls.shape[0] // 2
-                if random.randint(0, 1) == 0:
+                if rng.integers(2) == 0:
                     # Top/bottom
-                    x = random.randint(0, walls.shape[1] - 1)
-                    y = [0, walls.shape[0] - 1][random.randint(0, 1)]
+                    x = int(rng.integers(walls.shape[1]))
+                    y = [0, walls.shape[0] - 1][rng.integers(2)]
                 else:
                     # Left/right
-                    y = random.randint(0, walls.shape[0] - 1)
-                    x = [0, walls.shape[1] - 1][random.randint(0, 1)]
+                    y = int(rng.integers(walls.shape[0]))
+                    x = [0, walls.shape[1] - 1][rng.integers(2)]
                 position = (x, y)
                 dist = utils.diag_dist(position, center)
             while True:
-                direction = random.choice(list(utils.CardinalDirections))
-                x, y = position[0] + direction.value[0],\
-                        position[1] + direction.value[1]
+                if len(steps) == 0:
+                    steps = rng.integers(len(directions), size=256).tolist()
+                dx, dy = directions[steps.pop()]
+                x, y = position[0] + dx, position[1] + dy
                 if self.outward:
                     stuck = False
                     if x == 0 or y == 0 or x >= walls.shape[1] - 1\
@@ -277,29 +483,87 @@ class WallFeatureDLA:
                         break
                 position = x, y
 
+def _spanning_tree(points: npt.NDArray[np.float64],
+                   root: int) -> List[Tuple[int, int]]:
+    """Edges of a minimum spanning tree over the Manhattan distances between
+    points, using Prim's algorithm one row of distances at a time
+    """
+    in_tree = np.zeros(len(points), dtype=np.bool_)
+    best = np.full(len(points), np.inf)
+    parents = np.zeros(len(points), dtype=int)
+    best[root] = 0
+    edges: List[Tuple[int, int]] = []
+    for _ in range(len(points)):
+        i = int(np.argmin(np.where(in_tree, np.inf, best)))
+        in_tree[i] = True
+        if i != root:
+            edges.append((int(parents[i]), i))
+        dists = np.abs(points - points[i]).sum(axis=1)
+        closer = ~in_tree & (dists < best)
+        best[closer] = dists[closer]
+        parents[closer] = i
+    return edges
+
+def _nearest(cells: npt.NDArray[np.int64],
+             target: npt.NDArray[np.float64]) -> Pos:
+    x, y = cells[np.abs(cells - target).sum(axis=1).argmin()].tolist()
+    return x, y
+
 @dataclass
 class WallFeatureJoin:
     """Ensures connectedness between all passable groups of contiguous
     tiles. Basically makes sure the player can reach everywhere in the
     map.
+    Groups are labelled once and joined along a minimum spanning tree of
+    their centroids, each tunnel dug between the closest cells of the two
+    groups. Groups a tunnel passes through or next to are merged with
+    union-find, so tunnels to them are skipped.
     Superfluous on BSP maps where join is True
     """
     passable_classes: Set[int]
     inside: int
     outside: int
     border: int
-    def apply_feature(self, walls: WallGrid) -> None:
+    def apply_feature(self,
+                      walls: WallGrid,
+                      rng: Optional[np.random.Generator]=None,
+                      deadline: Optional[utils.Deadline]=None) -> None:
+        rng = np.random.default_rng(rng)
+        height, width = walls.shape
+        passable_values = np.array(sorted(self.passable_classes))
         while True:
-            passable = [i in self.passable_classes for i in walls.flatten()]
-            groups = utils.group(cast(Pos, walls.shape[::-1]), passable)
-            if len(groups) < 2:
+            if deadline is not None:
+                deadline.check()
+            components = utils.label_components(
+                np.isin(walls, passable_values))
+            if len(components) < 2:
                 break
-            i = random.randint(0, len(groups) - 2)
-            j = random.randint(i + 1, len(groups) - 1)
-            i_pos = random.choice(list(groups[i]))
-            j_pos = random.choice(list(groups[j]))
-            bsp.tunnel(walls, i_pos, j_pos,
-                       self.inside, self.outside, self.border)
+            labels = components.labels
+            # Cells of every group at once, sorted by group
+            flat = labels.ravel()
+            order = np.flatnonzero(flat >= 0)
+            order = order[np.argsort(flat[order], kind='stable')]
+            ys, xs = np.divmod(order, width)
+            cells = np.split(np.stack((xs, ys), axis=1),
+                             np.cumsum(components.sizes)[:-1])
+            centroids = np.stack(
+                (np.bincount(flat[order], xs), np.bincount(flat[order], ys)),
+                axis=1) / components.sizes[:, None]
+            joined = utils.UnionFind(len(components))
+            for i, j in _spanning_tree(centroids, components.largest()):
+                if joined.find(i) == joined.find(j):
+                    continue
+                i_pos = _nearest(cells[i], centroids[j])
+                j_pos = _nearest(cells[j], np.array(i_pos, dtype=float))
+                dug = bsp.tunnel(walls, i_pos, j_pos,
+                                 self.inside, self.outside, self.border, rng)
+                joined.union(i, j)
+                for x, y in dug:
+                    for nx, ny in ((x, y), (x - 1, y), (x + 1, y),
+                                   (x, y - 1), (x, y + 1)):
+                        if 0 <= nx < width and 0 <= ny < height\
+                                and labels[ny, nx] >= 0:
+                            joined.union(i, int(labels[ny, nx]))
 
 @dataclass
 class WallFeatureCA:
@@ -312,7 +576,13 @@ class WallFeatureCA:
     full: Set[int]
     iterations: int
     corners: bool
-    def apply_feature(self, walls: WallGrid) -> None:
+    def apply_feature(self,
+                      walls: WallGrid,
+                      rng: Optional[np.random.Generator]=None,
+                      deadline: Optional[utils.Deadline]=None) -> None:
+        # Quick enough to only check the deadline before starting
+        if deadline is not None:
+            deadline.check()
         cellular.run(
             walls, self.clear_below, self.fill_from,
             self.clear_with, self.fill_with, self.full,
@@ -320,7 +590,9 @@ class WallFeatureCA:
 
 class TileGenerator(Protocol):
     """Handles populating a grid with actual tiles"""
-    def assign_tiles(self, walls: WallGrid) -> TileGrid:
+    def assign_tiles(self,
+                     walls: WallGrid,
+                     rng: Optional[np.random.Generator]=None) -> TileGrid:
         pass
 
 def parse_tile_generator(source: Dict[str, Any]) -> TileGenerator:
@@ -330,12 +602,25 @@ def parse_tile_generator(source: Dict[str, Any]) -> TileGenerator:
     elif kind == 'white':
         classes = source['classes']
         return TileGeneratorWhiteNoise(classes)
+    elif kind == 'autotile':
+        rules: Dict[int, Tuple[Set[int], Sequence[int]]] = {}
+        for clazz, rule in source['classes'].items():
+            connects = set(rule.get('connects', [int(clazz)]))
+            variants = cast(Sequence[int], rule['variants'])
+            if len(variants) != len(AUTOTILE_MASKS):
+                raise ValueError(f'Autotile class {clazz} needs '
+                                 f'{len(AUTOTILE_MASKS)} variants')
+            rules[int(clazz)] = (connects, variants)
+        outside = cast(bool, source.get('outside', True))
+        return TileGeneratorAutotile(rules, outside)
     else:
         raise ValueError('f{kind} is not a valid tile generator type')
 
 class TileGeneratorPassThru:
     """Just converts tile classes to tiles"""
-    def assign_tiles(self, walls: WallGrid) -> TileGrid:
+    def assign_tiles(self,
+                     walls: WallGrid,
+                     rng: Optional[np.random.Generator]=None) -> TileGrid:
         return cast(TileGrid, walls)
 
 class TileGeneratorWhiteNoise:
@@ -353,12 +638,62 @@ class TileGeneratorWhiteNoise:
             probs = np.array(prob_lst, dtype=float)
             self.classes.append((tiles, probs/probs.sum()))
     
-    def assign_tiles(self, walls: WallGrid) -> TileGrid:
+    def assign_tiles(self,
+                     walls: WallGrid,
+                     rng: Optional[np.random.Generator]=None) -> TileGrid:
+        rng = np.random.default_rng(rng)
         tiles = np.zeros(walls.shape, dtype=np.int32)
-        for y in range(tiles.shape[0]):
-            for x in range(tiles.shape[1]):
-                clazz = self.classes[walls[y, x]]
-                tiles[y, x] = np.random.choice(clazz[0], p=clazz[1])
+        for clazz, (options, probs) in enumerate(self.classes):
+            cells = walls == clazz
+            count = int(cells.sum())
+            if count > 0:
+                tiles[cells] = rng.choice(options, size=count, p=probs)
+        return tiles
+
+# Bit of each side of a cell in an autotile mask
+AUTOTILE_UP = 1
+AUTOTILE_RIGHT = 2
+AUTOTILE_DOWN = 4
+AUTOTILE_LEFT = 8
+AUTOTILE_MASKS = range(16)
+
+def neighbor_masks(connected: npt.NDArray[np.bool_],
+                   outside: bool=True) -> npt.NDArray[np.int32]:
+    """Which of the orthogonal neighbors of each cell are connected, as
+    AUTOTILE_* bits
+    outside: whether cells past the edge of the grid count as connected
+    """
+    padded = np.pad(connected, 1, constant_values=outside).astype(np.int32)
+    return padded[:-2, 1:-1] * AUTOTILE_UP\
+        | padded[1:-1, 2:] * AUTOTILE_RIGHT\
+        | padded[2:, 1:-1] * AUTOTILE_DOWN\
+        | padded[1:-1, :-2] * AUTOTILE_LEFT
+
+class TileGeneratorAutotile:
+    """Picks the variant of a tile that matches which of its neighbors it
+    connects to, so walls get edges and corners
+    Classes without a rule are passed through as tiles
+    rules: for each class, the classes it connects to and the tile for
+        each of the 16 neighbor masks
+    outside: whether the edge of the map connects
+    """
+    def __init__(self,
+                 rules: Dict[int, Tuple[Set[int], Sequence[int]]],
+                 outside: bool=True):
+        self.rules = [(clazz,
+                       np.array(sorted(connects), dtype=np.int32),
+                       np.array(variants, dtype=np.int32))
+                      for clazz, (connects, variants) in rules.items()]
+        self.outside = outside
+    
+    def assign_tiles(self,
+                     walls: WallGrid,
+                     rng: Optional[np.random.Generator]=None) -> TileGrid:
+        tiles = walls.astype(np.int32)
+        for clazz, connects, variants in self.rules:
+            cells = walls == clazz
+            masks = neighbor_masks(np.isin(walls, connects), self.outside)
+            tiles[cells] = variants[masks[cells]]
         return tiles
 
 Predicates = Sequence[Tuple[str, str, Any, bool]]
@@ -381,6 +716,171 @@ def parse_exits(source: List[Dict[str, Any]]) -> List[ExitPlacer]:
         exits.append(ExitPlacer(key, weight, predicates, crange))
     return exits
 
+@dataclass
+class LevelLayout:
+    """Everything about a level that only depends on the map, so it can be
+    generated in another process and pickled back cheaply
+    """
+    seed: int
+    size: Pos
+    tiles: TileGrid
+    player_pos: Pos
+    key_item: Optional[str]
+    key_count: int
+    key_positions: List[Pos]
+    exit_pos: Pos
+    next_size: Pos
+    dummy_pos: Pos
+    # Positions to populate in order, until the populator runs out
+    boring_positions: List[Pos]
+    stats: GenerationStats = field(default_factory=GenerationStats)
+
+def _farthest(dists: utils.DistanceField, default: Pos) -> Pos:
+    farthest = dists.farthest()
+    return default if farthest is None else farthest[0]
+
+def _check_cancelled(deadline: Optional[utils.Deadline]) -> None:
+    if deadline is not None and deadline.cancelled():
+        raise utils.DeadlineExceeded('Deadline cancelled')
+
+@dataclass
+class LayoutGenerator:
+    """The parts of a WorldGenerator that build the map itself"""
+    wall_generator: WallGenerator
+    wall_features: Iterable[WallFeature]
+    tile_generator: TileGenerator
+    # Whether each tile is passable, from TileProperties
+    passable_tiles: npt.NDArray[np.bool_]
+    max_boredom: float = 16
+    # Builds the walls instead if wall_generator fails or runs out of time
+    fallback: Optional[WallGenerator] = None
+    
+    def generate_layout(self,
+                        size: Pos,
+                        key_item: Optional[str]=None,
+                        key_count: int=0,
+                        seed: Seed=None,
+                        deadline: Optional[utils.Deadline]=None)\
+            -> LevelLayout:
+        """Builds a level, which is the same for the same seed as long as
+        it's built before the deadline
+        deadline: when to give up on building the map itself, that is its
+            walls, wall features and tiles. The map is then rebuilt from the
+            fallback walls with no deadline, or without a fallback
+            DeadlineExceeded is raised. Placing things on the map carries on
+            past it. Cancelling it raises DeadlineExceeded from any stage.
+        """
+        seed = level_seed(seed)
+        rngs = stage_rngs(seed)
+        stats = GenerationStats()
+        logging.debug(f'Generating a new map that is {size[0]}x{size[1]} '
+                      f'with seed {seed}')
+        try:
+            tiles = self._generate_tiles(self.wall_generator,
+                                         size,
+                                         rngs,
+                                         stats,
+                                         deadline)
+        except (utils.DeadlineExceeded, wfc.CollapseError) as err:
+            if self.fallback is None\
+                    or (deadline is not None and deadline.cancelled()):
+                raise
+            logging.warning(f'Using fallback walls after {err!r}')
+            stats.count('fallbacks')
+            tiles = self._generate_tiles(self.fallback,
+                                         size,
+                                         stage_rngs(seed),
+                                         stats)
+        finally:
+            for name, amount in getattr(self.wall_generator,
+                                        'counts', {}).items():
+                stats.count(name, amount)
+        
+        # Make it fun
+        _check_cancelled(deadline)
+        with stats.timed('placement'):
+            passable = self.passable_tiles[tiles]
+            
+            components = utils.label_components(passable)
+            player_pos = components.choose(components.largest(),
+                                           rngs['layout'])
+        stats.count('groups', len(components))
+        
+        # Everything is placed as far as possible from the player and the
+        # paths to everything placed before it
+        _check_cancelled(deadline)
+        with stats.timed('distances'):
+            dists = utils.DistanceField(passable)
+            dists.add_sources((player_pos,))
+            furthest_away = _farthest(dists, player_pos)
+        
+        key_positions: List[Pos] = []
+        for _ in range(key_count if key_item is not None else 0):
+            _check_cancelled(deadline)
+            with stats.timed('keys'):
+                key_positions.append(furthest_away)
+                dists.add_sources(dists.trace(furthest_away))
+                furthest_away = _farthest(dists, player_pos)
+        logging.debug(f'Exit is at {furthest_away}')
+        w, h = size
+        w = min(w + int(rngs['layout'].integers(2)), MAX_SIZE)
+        h = min(h + int(rngs['layout'].integers(2)), MAX_SIZE)
+        _check_cancelled(deadline)
+        with stats.timed('exit'):
+            dists.add_sources(dists.trace(furthest_away))
+        
+        _check_cancelled(deadline)
+        with stats.timed('dummy'):
+            dists.exclude(utils.clear_blockage(dists.distances()))
+            dummy_pos = _farthest(dists, player_pos)
+        
+        boring_positions: List[Pos] = []
+        while True:
+            _check_cancelled(deadline)
+            with stats.timed('boring'):
+                farthest = dists.farthest()
+                if farthest is None or farthest[1] < self.max_boredom:
+                    break
+                boring_pos = farthest[0]
+                boring_positions.append(boring_pos)
+                dists.add_sources(dists.trace(boring_pos))
+        stats.count('boring_positions', len(boring_positions))
+        return LevelLayout(seed,
+                           size,
+                           tiles,
+                           player_pos,
+                           key_item,
+                           key_count,
+                           key_positions,
+                           furthest_away,
+                           (w, h),
+                           dummy_pos,
+                           boring_positions,
+                           stats)
+    
+    def _generate_tiles(self,
+                        wall_generator: WallGenerator,
+                        size: Pos,
+                        rngs: Dict[str, np.random.Generator],
+                        stats: GenerationStats,
+                        deadline: Optional[utils.Deadline]=None) -> TileGrid:
+        """Builds the map itself from wall_generator's walls"""
+        # Generate wall classes
+        with stats.timed('walls'):
+            walls = wall_generator.generate_walls(size, rngs['walls'],
+                                                  deadline)
+        
+        # Apply optional features
+        for i, feature in enumerate(self.wall_features):
+            with stats.timed(f'feature {i} {type(feature).__name__}'):
+                feature.apply_feature(walls, rngs['features'], deadline)
+        
+        # Fill in tiles
+        if deadline is not None:
+            deadline.check()
+        with stats.timed('tiles'):
+            return self.tile_generator.assign_tiles(walls, rngs['tiles'])
+
 @dataclass
 class WorldGenerator:
     """Holds the data for generating worlds"""
@@ -396,97 +896,184 @@ class WorldGenerator:
     vignette_color: Tuple[float, float, float, float] = (.2, .2, .2, 1)
     border: int = -1
     music: Optional[str] = None
+    name: str = ''
+    # Hash of the settings this was parsed from, for caching levels
+    config_hash: str = ''
+    # Walls to build instead when building a level takes over max_seconds
+    fallback: Optional[WallGenerator] = None
+    max_seconds: Optional[float] = None
+    tile_properties: dungeon.TileProperties = field(init=False)
+    
+    def __post_init__(self) -> None:
+        self.tile_properties = dungeon.tile_properties(self.tile_list)
+    
+    def layout_generator(self) -> LayoutGenerator:
+        return LayoutGenerator(self.wall_generator,
+                               self.wall_features,
+                               self.tile_generator,
+                               self.tile_properties.passable,
+                               self.max_boredom,
+                               self.fallback)
+    
+    def deadline(self) -> utils.Deadline:
+        """A deadline to build a level of this world by, which only expires
+        if there is a fallback to switch to
+        """
+        return utils.Deadline(self.max_seconds if self.fallback is not None
+                              else None)
+    
+    def choose_exit(self, seed: int) -> Tuple[Optional[str], int]:
+        """Picks which key item and how many of it the exit of the level
+        with this seed will need
+        """
+        rng = stage_rngs(seed)['exit']
+        choices = tuple(\
+            filter(\
+                lambda x: spawn.eval_preds(x.predicates), self.exits))
+        if len(choices) > 0:
+            weights = np.array([ex.weight for ex in choices], dtype=float)
+            choice = choices[rng.choice(len(choices),
+                                        p=weights/weights.sum())]
+            low, high = choice.count_range
+            return choice.key, int(rng.integers(low, high + 1))
+        return None, 0
+    
+    def exit_allowed(self, key_item: Optional[str], key_count: int) -> bool:
+        """Whether an exit needing this many of this key item could be
+        chosen now
+        """
+        choices = tuple(\
+            filter(\
+                lambda x: spawn.eval_preds(x.predicates), self.exits))
+        if len(choices) == 0:
+            return key_item is None
+        return any(ex.key == key_item
+                   and ex.count_range[0] <= key_count <= ex.count_range[1]
+                   for ex in choices)
+    
+    def run_seed(self,
+                 size: Pos,
+                 difficulty: Optional[int]=None) -> Optional[int]:
+        """Seed of the level of this size and difficulty in the current run,
+        or None when the run isn't seeded
+        """
+        run = assets.variables['seed']
+        if run is None:
+            return None
+        if difficulty is None:
+            difficulty = assets.variables['difficulty'] or 0
+        sequence = np.random.SeedSequence([run, difficulty, *size])
+        return int(sequence.generate_state(1, np.uint64)[0] >> 1)
+    
+    def level_key(self,
+                  size: Pos,
+                  seed: int,
+                  difficulty: Optional[int]=None) -> str:
+        if difficulty is None:
+            difficulty = assets.variables['difficulty'] or 0
+        return level_cache.level_key(self.name,
+                                     size,
+                                     difficulty,
+                                     seed,
+                                     self.config_hash)
     
     def generate_world(self,
                        size: Pos,
+                       seed: Seed=None,
+                       deadline: Optional[utils.Deadline]=None,
                        **kwargs)\
             -> dungeon.DungeonMapSpawner:
-        logging.debug(f'Generating a new map that is {size[0]}x{size[1]}')
-        # Generate wall classes
-        walls = self.wall_generator.generate_walls(size)
-        
-        # Apply optional features
-        for feature in self.wall_features:
-            feature.apply_feature(walls)
-        
-        # Fill in tiles
-        tiles = self.tile_generator.assign_tiles(walls)
-        
-        # Make it fun
-        passable_ids = set(map(lambda x: x[0],
-                           filter(lambda x: x[1].passable,
-                                  enumerate(self.tile_list))))
-        passable_vec = np.vectorize(passable_ids.__contains__)
-        passable = passable_vec(tiles)
-
-        costs = np.where(passable, 1, np.inf)
-        groups = utils.group(size, list(passable.flatten()))
-        group_no = max(enumerate(groups), key=lambda x: len(x[1]))[0]
-        group = groups[group_no]
-        player_pos = random.choice(list(group))
-        
-        spawner = dungeon.DungeonMapSpawner(size,
+        """Builds and populates a level
+        seed: makes the level the same every time given the same game
+            state, defaults to the seed of the current run. Levels with a
+            seed are cached on disk.
+        deadline: when to switch to the fallback walls, see
+            LayoutGenerator.generate_layout. Defaults to self.deadline().
+        """
+        if deadline is None:
+            deadline = self.deadline()
+        seed = self.run_seed(size) if seed is None else level_seed(seed)
+        stats = GenerationStats()
+        layout: Optional[LevelLayout] = None
+        if seed is not None:
+            key = self.level_key(size, seed)
+            with stats.timed('cache load'):
+                layout = level_cache.cache.load(key)
+            if layout is not None\
+                    and not self.exit_allowed(layout.key_item,
+                                              layout.key_count):
+                layout = None
+            stats.count('cache_hits', int(layout is not None))
+        if layout is None:
+            with stats.timed('layout'):
+                layout = gen_service.service.layout(self,
+                                                    size,
+                                                    seed,
+                                                    deadline)
+            if seed is not None:
+                with stats.timed('cache store'):
+                    level_cache.cache.store(key, layout)
+        # Stages of a layout built in the background took no time here
+        stats.update(layout.stats)
+        layout.stats = stats
+        spawner = self.populate_layout(layout, **kwargs)
+        logging.debug(f'Generated {self.name or self.display_name} at '
+                      f'{size[0]}x{size[1]} with seed {layout.seed}:\n'
+                      f'{stats}')
+        return spawner
+    
+    def prefetch(self, size: Pos, difficulty: Optional[int]=None) -> None:
+        """Starts building a level of this world in the background, unless
+        it's already cached
+        """
+        seed = self.run_seed(size, difficulty)
+        if seed is not None and os.path.exists(level_cache.cache.path(
+                self.level_key(size, seed, difficulty))):
+            return
+        gen_service.service.prefetch(self,
+                                     size,
+                                     level_seed(seed),
+                                     self.deadline())
+    
+    def populate_layout(self,
+                        layout: LevelLayout,
+                        **kwargs) -> dungeon.DungeonMapSpawner:
+        """Places the entities of a level, which depends on the game state
+        and so has to happen in this process
+        """
+        spawner = dungeon.DungeonMapSpawner(layout.size,
                                             self.tile_list,
-                                            player_pos,
-                                            tile_map=list(tiles.flatten()),
+                                            layout.player_pos,
+                                            tile_map=list(
+                                                layout.tiles.flatten()),
                                             spawns=[],
                                             vignette_color=self.vignette_color,
                                             border=self.border,
+                                            next_size=layout.next_size,
+                                            stats=layout.stats,
                                             **kwargs)
         
-        dists = utils.populate_djikstra(costs, (player_pos,))
-        furthest_away = cast(Tuple[int, int], divmod(
-            np.where(np.isinf(dists) | ~passable,
-                     -np.inf, dists).argmax(),
-            size[0])[::-1])
-        
-        key_item_nm: Optional[str] = None
         key_item: Optional[item.BaseItem] = None
-        key_count = 0
-        choices = tuple(\
-            filter(\
-                lambda x: spawn.eval_preds(x.predicates), self.exits))
-        if len(choices) > 0:
-            weights = np.array([ex.weight for ex in choices], dtype=float)
-            choice = np.random.choice(choices, p=weights/weights.sum()) # type: ignore
-            key_item_nm = choice.key
-            key_count = random.randint(*choice.count_range)
-        if key_item_nm is not None:
-            key_item = item.items[key_item_nm]
-            logging.debug(f'Level will require {key_item_nm} x{key_count}')
-            for _ in range(key_count):
+        key_count = layout.key_count
+        if layout.key_item is not None:
+            key_item = item.items[layout.key_item]
+            logging.debug(f'Level will require {layout.key_item} '
+                          f'x{key_count}')
+            for key_pos in layout.key_positions:
                 spawner.spawns.append((
-                    furthest_away, item_entity.KeyEntity,
-                    {'item': key_item_nm,
+                    key_pos, item_entity.KeyEntity,
+                    {'item': layout.key_item,
                      'needed': key_count}))
-                hot_path = utils.trace_djikstra(furthest_away, dists)
-                dists = utils.populate_djikstra(costs, hot_path, dists)
-                furthest_away = cast(Tuple[int, int], divmod(
-                    np.where(np.isinf(dists) | ~passable,
-                             -np.inf, dists).argmax(),
-                    size[0])[::-1])
-        logging.debug(f'Exit is at {furthest_away}')
-        w, h = size
-        w = min(w + random.randint(0, 1), MAX_SIZE)
-        h = min(h + random.randint(0, 1), MAX_SIZE)
-        spawner.spawns.append((furthest_away, lvl_entity.LadderEntity,
-                               {'size': (w, h), 'key_item': key_item,
+        spawner.spawns.append((layout.exit_pos, lvl_entity.LadderEntity,
+                               {'size': layout.next_size,
+                                'key_item': key_item,
                                 'key_count': key_count}))
-        hot_path = utils.trace_djikstra(furthest_away, dists)
-        dists = utils.populate_djikstra(costs, hot_path, dists)
-        
-        blocking = utils.clear_blockage(dists)
         self.populator.reset_counts()
         
         # Place tutorial dummy
         if assets.persists.get('tutorial', 0) < 6:
-            boring_pos = cast(Tuple[int, int], divmod(
-                np.where(np.isinf(dists)\
-                            | ~passable\
-                            | blocking,
-                         -np.inf, dists).argmax(),
-                size[0])[::-1])
-            spawner.spawns.append((boring_pos, slow_chaser.PursuantEnemy, {
+            spawner.spawns.append((layout.dummy_pos,
+                                   slow_chaser.PursuantEnemy, {
                 'anim': assets.Animations.instance.slow_chaser,
                 'action_cost': 1e10,
                 'attack': 0,
@@ -500,22 +1087,14 @@ class WorldGenerator:
                 ]
             }))
         
-        while True:
-            boring_pos = cast(Tuple[int, int], divmod(
-                np.where(np.isinf(dists)\
-                            | ~passable\
-                            | blocking,
-                         -np.inf, dists).argmax(),
-                size[0])[::-1])
-            boredom = dists[boring_pos[::-1]]
-            if not np.isfinite(boredom) or boredom < self.max_boredom:
-                break
-            chosen_spawn = self.populator.populate(boring_pos)
+        rng = stage_rngs(layout.seed)['populate']
+        for boring_pos in layout.boring_positions:
+            with layout.stats.timed('populate'):
+                chosen_spawn = self.populator.populate(boring_pos, rng)
             if chosen_spawn is None:
                 break
             spawner.spawns.append(chosen_spawn)
-            fun_path = utils.trace_djikstra(boring_pos, dists)
-            dists = utils.populate_djikstra(costs, fun_path, dists)
+        layout.stats.count('spawns', len(spawner.spawns))
         if self.music is not None:
             assets.Sounds.instance.play_music(self.music)
         return spawner
@@ -538,7 +1117,11 @@ def init_generators() -> None:
         border = value.get('border', -1)
         music = value.get('music', None)
         display_name = value.get('display', name.title())
-        world_generators[name] = WorldGenerator(
+        fallback = None
+        if 'fallback' in value:
+            fallback = parse_wall_generator(value['fallback'])
+        max_seconds = cast(Optional[float], value.get('max_seconds', None))
+        gen = WorldGenerator(
             wall_generator=wall_generator,
             wall_features=features,
             tile_generator=tile_generator,
@@ -549,4 +1132,11 @@ def init_generators() -> None:
             max_boredom=boredom,
             vignette_color=vignette,
             border=border,
-            music=music)
+            music=music,
+            name=name,
+            fallback=fallback,
+            max_seconds=max_seconds)
+        gen.config_hash = hashlib.sha1(json.dumps(
+            [value, gen.tile_properties.passable.tolist()],
+            sort_keys=True).encode()).hexdigest()
+        world_generators[name] = gen
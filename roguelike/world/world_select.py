@@ -123,6 +123,9 @@ class WorldSelect(ui.PoppableMenu):
                 assets.persists['current'].get(name, {})
             assets.variables['difficulty'] =\
                 current_save.get('difficulty', 0)
+            # Levels of a run come from its seed, so they can be cached
+            assets.variables['seed'] =\
+                current_save.get('seed', None) or world_gen.level_seed()
             
             gen = world_gen.world_generators[name]
             state = dungeon.DungeonMapState(tile_size=tile_size,
@@ -0,0 +1,22 @@
+import numpy as np
+
+from roguelike.world import (
+    bsp,
+    world_gen
+)
+
+walls = bsp.bsp((20, 12), (5, 5), 0, 1, 1, True, np.random.default_rng(3))
+print(walls)
+
+# Walls become 2 + their neighbor mask, floors stay 0
+autotile = world_gen.parse_tile_generator({
+    'kind': 'autotile',
+    'classes': {'1': {'variants': list(range(2, 18))}}
+})
+print(autotile.assign_tiles(walls))
+
+white = world_gen.parse_tile_generator({
+    'kind': 'white',
+    'classes': [[[0, 1], [2, 1]], [[1, 3], [3, 1]]]
+})
+print(white.assign_tiles(walls, np.random.default_rng(3)))
@@ -10,4 +10,8 @@ print(arr)
 
 arr = bsp.bsp(size, min_size, 0, 1, 2, True)
 print(arr)
-utils.save_grid(arr, 'box.png')
\ No newline at end of file
+utils.save_grid(arr, 'box.png')
+# Same seed, same map
+seeded = [bsp.bsp(size, min_size, 0, 1, 2, True, np.random.default_rng(7))
+          for _ in range(2)]
+assert (seeded[0] == seeded[1]).all()
@@ -0,0 +1,37 @@
+from roguelike.world import (
+    bsp, wfc
+)
+
+import numpy as np
+import time
+
+# Collapses a large map in chunks from a sample of rooms and corridors, whose
+# corridors run far enough to commit chunks to what fails several chunks on
+w, h = 256, 256
+sample_size = (24, 24)
+pattern = (3, 3)
+sample = np.asanyarray(bsp.bsp(sample_size, (6, 6), 0, 1, 1, True,
+                               np.random.default_rng(0)), dtype=int)
+pattern_f, pattern_b, pattern_ids, adj, weights =\
+    wfc.find_adjacencies(sample_size, sample, pattern, True)
+all_patterns = set(pattern_f.values())
+border = wfc.patterns_containing({1}, pattern_b)
+gen = wfc.WaveFunction([all_patterns, border], adj, pattern, weights)
+table = wfc.adjacency_table(adj, len(pattern_b))
+offsets = wfc.gen_offsets(pattern)
+map_classes = np.zeros((h, w), dtype=int)
+map_classes[[0, -1]] = 1
+map_classes[:, [0, -1]] = 1
+for seed in range(3):
+    start = time.perf_counter()
+    res = gen.wfc_chunked((w, h), map_classes.ravel(), (32, 32),
+                          rng=np.random.default_rng(seed), edge_class=1)
+    print(f'seed {seed}: {time.perf_counter() - start:.2f}s {gen.counts}')
+    grid = np.asanyarray(res).reshape((h, w))
+    assert (grid >= 0).all()
+    assert np.isin(grid[map_classes == 1], list(border)).all()
+    for offset_i, (dx, dy) in enumerate(offsets):
+        here = grid[max(0, -dy):h - max(0, dy), max(0, -dx):w - max(0, dx)]
+        there = grid[max(0, dy):h - max(0, -dy), max(0, dx):w - max(0, -dx)]
+        assert table[offset_i, here, there].all(),\
+            f'seed {seed} breaks adjacency at offset {(dx, dy)}'
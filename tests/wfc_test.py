@@ -48,4 +48,42 @@ res = gen.wfc_tile((w, h), map_classes)
 for i, r in enumerate(res):
     res[i] = pattern_b[r][0][0]
 for y in range(h):
-    print(res[y*w:y*w+w])
\ No newline at end of file
+    print(res[y*w:y*w+w])
+for engine in ('bitset', 'ac4', 'jit'):
+    print(engine)
+    res = gen.wfc_tile((w, h), map_classes, engine=engine)
+    for i, r in enumerate(res):
+        res[i] = pattern_b[r][0][0]
+    for y in range(h):
+        print(res[y*w:y*w+w])
+print('bitset, snapshot backtracking')
+res = gen.wfc_tile((w, h), map_classes, engine='bitset', backtrack='snapshot',
+                   budget=wfc.SolverBudget(snapshot_interval=4, max_seconds=10))
+for i, r in enumerate(res):
+    res[i] = pattern_b[r][0][0]
+for y in range(h):
+    print(res[y*w:y*w+w])
+print('bitset, chunked')
+res = gen.wfc_chunked((w, h), map_classes, (8, 8))
+for i, r in enumerate(res):
+    res[i] = pattern_b[r][0][0]
+for y in range(h):
+    print(res[y*w:y*w+w])
+print('bitset, history backtracking on a 3-colouring')
+# Neighbours must differ, which propagation alone can't keep from
+# contradicting, so this backtracks and sometimes restarts
+colours = 3
+colouring = wfc.WaveFunction([set(range(colours))],
+                             [[set(range(colours)) - {i}
+                               for i in range(colours)]
+                              for _ in wfc.gen_offsets(pattern)],
+                             pattern,
+                             np.ones(colours, dtype=np.int32))
+for seed in range(10):
+    res = colouring.wfc_tile((w, h), [0] * (w * h), engine='bitset',
+                             rng=np.random.default_rng(seed),
+                             budget=wfc.SolverBudget(max_contradictions=50,
+                                                     max_restarts=20))
+    print(colouring.counts)
+    grid = np.reshape(res, (h, w))
+    assert (grid[1:] != grid[:-1]).all() and (grid[:, 1:] != grid[:, :-1]).all()
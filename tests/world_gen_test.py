@@ -0,0 +1,34 @@
+import json
+import time
+
+import numpy as np
+
+from roguelike.engine import assets
+from roguelike.world import world_gen
+
+# Generating a 256x256 level of each world must stay well within this many
+# seconds. The WFC world's walls are collapsed without its fallback, so a
+# slow or failing solver can't hide behind BSP walls.
+BUDGETS = {'bspworld': 5, 'wfc': 10}
+
+with open(assets.asset_path('worldgen.json')) as file:
+    sources = json.load(file)
+
+for name, budget in BUDGETS.items():
+    source = sources[name]
+    layout_generator = world_gen.LayoutGenerator(
+        world_gen.parse_wall_generator(source['wall']),
+        list(map(world_gen.parse_wall_feature, source['features'])),
+        world_gen.parse_tile_generator(source['tile']),
+        np.array([True, False]),
+        source.get('boredom', 16))
+
+    # Warm up first so the jit solver's compile time isn't counted
+    layout_generator.generate_layout((32, 32), seed=7)
+    start = time.perf_counter()
+    layout = layout_generator.generate_layout((256, 256), 'Key', 2, seed=7)
+    elapsed = time.perf_counter() - start
+    print(layout.stats)
+    print(f'256x256 {name} level took {elapsed:.2f}s')
+    assert elapsed < budget, f'256x256 {name} level took over {budget}s'
+    assert max(layout.next_size) <= world_gen.MAX_SIZE